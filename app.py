@@ -1,61 +1,246 @@
-import sys
-from flask import Flask, request, abort, jsonify
+import os
+from flask import Flask, request, abort
 from werkzeug.exceptions import BadRequest, HTTPException, UnprocessableEntity, NotFound
 from flask_cors import CORS
-from auth import requires_auth
+from sqlalchemy.orm import selectinload, joinedload, noload
+from auth import requires_auth, all_of, jwks_store, get_auth0_settings, auth_metrics
+from caching import conditional, cached, create_response_cache
+from compression import setup_compression
+from instrumentation import log_exception, setup_metrics, timed
+from replicas import read_only, PRIMARY_READ_HEADER
+from idempotency import idempotent
 from datetime import datetime
+from sqlalchemy.exc import OperationalError, IntegrityError, DataError
+from listing import get_page_args, get_bool_arg, get_fields_args, column_options, paginate, stream_collection, \
+    get_int_arg, get_choice_arg, get_date_arg, get_sort_arg
 
 from models import setup_db, Actors, Movies, MAX_ACTOR_NAME_LENGTH, MIN_ACTOR_NAME_LENGTH, MIN_ACTOR_AGE, MAX_ACTOR_AGE, \
-    update, MAX_MOVIE_TITLE_LENGTH, MIN_MOVIE_TITLE_LENGTH
+    update, MAX_MOVIE_TITLE_LENGTH, MIN_MOVIE_TITLE_LENGTH, db, actors_movies, insert_many, bump_table_versions, add_links, \
+    remove_links, setup_migrations, env_setting, app_engines, pool_metrics
+from search import search, SEARCH_PAGE_SIZE, MAX_SEARCH_PAGE_SIZE
+from serialization import api_response
+from errors import SearchTimeout
+
+MAX_BULK_ITEMS = int(os.environ.get('MAX_BULK_ITEMS', 1000))
+
+
+def warm_up(app):
+    """
+    Read the Auth0 settings, fetch the signing keys and open the database connections ahead of the first
+    requests, which would otherwise wait for them. Failures are logged and left for the requests to retry.
+    :param app:
+    :return:
+    """
+    try:
+        get_auth0_settings()
+        jwks_store.preload()
+    except Exception:
+        log_exception('Could not fetch the signing keys while warming up')
+
+    warm_up_connections(app)
+
+
+def warm_up_connections(app):
+    """
+    Fill the connection pools of the app. A preloading gunicorn master closes the connections it opened before
+    forking, so each worker calls this again.
+    :param app:
+    :return:
+    """
+    for engine in app_engines(app):
+        size = engine.pool.size() if hasattr(engine.pool, 'size') else 1
+        connections = []
+        try:
+            # Check out the whole pool at once, so that each connection is a new one
+            for _ in range(size):
+                connections.append(engine.connect())
+        except Exception:
+            log_exception('Could not connect to the database while warming up')
+        finally:
+            for connection in connections:
+                connection.close()
 
 
 def create_app(test_config=None):
+    """
+    The application factory, e.g. for `gunicorn "app:create_app()"`
+    :param test_config: Settings that take the place of the env variables: metrics, compression, response_cache,
+    warm_up, and the arguments of setup_db()
+    :return:
+    """
     app = Flask(__name__)
-    if type(test_config) == dict:
-        app.db = setup_db(app, **test_config)
-    else:
-        app.db = setup_db(app)
+    test_config = dict(test_config) if type(test_config) == dict else {}
+    # First, so that the request timings include everything else
+    if test_config.pop('metrics', bool(env_setting('METRICS', bool))):
+        metrics = setup_metrics(app)
+        metrics.add_collector(auth_metrics)
+        metrics.add_collector(lambda: pool_metrics(app))
+    if test_config.pop('compression', env_setting('COMPRESSION', bool) is not False):
+        setup_compression(app)
+
+    app.response_cache = create_response_cache(test_config.pop('response_cache', os.environ.get('RESPONSE_CACHE')))
+    app.config['WARM_UP'] = warm = test_config.pop('warm_up', bool(env_setting('WARM_UP', bool)))
+    app.db = setup_db(app, **test_config)
+    if os.environ.get('FLASK_RUN_FROM_CLI') == 'true':
+        # Set by the flask command, for flask db
+        setup_migrations(app)
 
     CORS(
         app,
         origins='*',
         methods=['GET', 'POST', 'DELETE', 'PATCH'],
-        allow_headers=['Authorization', 'Content-Type']
+        allow_headers=['Authorization', 'Content-Type', PRIMARY_READ_HEADER],
+        expose_headers=[PRIMARY_READ_HEADER]
     )
 
     @app.after_request
     def after_request(response):
-        response.headers.add('Access-Control-Allow-Headers', 'Authorization, Content-Type')
+        response.headers.add('Access-Control-Allow-Headers', f'Authorization, Content-Type, {PRIMARY_READ_HEADER}')
         response.headers.add('Access-Control-Allow-Methods', 'GET, POST, DELETE, PATCH')
         return response
 
+    def actor_filters():
+        """
+        Read the filters of GET /actors from the query string
+        EXAMPLE
+            GET /actors?gender=f&age_min=20&age_max=40
+        :return: The SQL criteria
+        """
+        gender = get_choice_arg('gender', ['m', 'f'])
+        age_min = get_int_arg('age_min')
+        age_max = get_int_arg('age_max')
+
+        criteria = []
+        if gender is not None:
+            criteria.append(Actors.gender == gender)
+        if age_min is not None:
+            criteria.append(Actors.age >= age_min)
+        if age_max is not None:
+            criteria.append(Actors.age <= age_max)
+
+        return criteria
+
+    def movie_filters():
+        """
+        Read the filters of GET /movies from the query string.
+        release_after is inclusive and release_before is exclusive.
+        EXAMPLE
+            GET /movies?release_after=2020-01-01&release_before=2021-01-01&title_prefix=The
+        :return: The SQL criteria
+        """
+        release_after = get_date_arg('release_after')
+        release_before = get_date_arg('release_before')
+        title_prefix = request.args.get('title_prefix')
+
+        criteria = []
+        if release_after is not None:
+            criteria.append(Movies.release_date >= release_after)
+        if release_before is not None:
+            criteria.append(Movies.release_date < release_before)
+        if title_prefix:
+            criteria.append(Movies.title.startswith(title_prefix, autoescape=True))
+
+        return criteria
+
     @app.route('/actors')
     @requires_auth('get:actors')
+    @read_only
+    @cached
+    @conditional
     def get_actors():
+        sort = get_sort_arg(Actors)
+        after, limit = get_page_args(Actors, sort)
+        fields, include = get_fields_args(Actors)
+        criteria = actor_filters()
         try:
-            actors = Actors.query.order_by('id').all()
-            response = {
-                'actors': [actor.format() for actor in actors]
-            }
+            query = Actors.query.filter(*criteria).options(*column_options(Actors, fields))
+            if include:
+                query = query.options(selectinload(Actors.movies).lazyload(Movies.actors))
+            else:
+                query = query.options(noload(Actors.movies))
+
+            if get_bool_arg('stream'):
+                return stream_collection('actors', query, Actors, after, fields, include, sort)
+
+            actors, next_id = paginate(query, Actors, after, limit, sort)
+            with timed('serialization'):
+                response = {
+                    'actors': [actor.format(fields, include) for actor in actors],
+                    'next': next_id
+                }
         except Exception:
-            print(sys.exc_info())
+            log_exception()
             raise BadRequest
 
-        return jsonify(response)
+        return api_response(response)
 
     @app.route('/movies')
     @requires_auth('get:movies')
+    @read_only
+    @cached
+    @conditional
     def get_movies():
+        sort = get_sort_arg(Movies)
+        after, limit = get_page_args(Movies, sort)
+        fields, include = get_fields_args(Movies)
+        criteria = movie_filters()
         try:
-            movies = Movies.query.order_by('id').all()
-            response = {
-                'movies': [movie.format() for movie in movies]
-            }
+            query = Movies.query.filter(*criteria).options(*column_options(Movies, fields))
+            if include:
+                query = query.options(selectinload(Movies.actors))
+            else:
+                query = query.options(noload(Movies.actors))
+
+            if get_bool_arg('stream'):
+                return stream_collection('movies', query, Movies, after, fields, include, sort)
+
+            movies, next_id = paginate(query, Movies, after, limit, sort)
+            with timed('serialization'):
+                response = {
+                    'movies': [movie.format(fields, include) for movie in movies],
+                    'next': next_id
+                }
         except Exception:
-            print(sys.exc_info())
+            log_exception()
             raise BadRequest
 
-        return jsonify(response)
+        return api_response(response)
+
+    @app.route('/search')
+    @requires_auth(all_of('get:actors', 'get:movies'))
+    @read_only
+    @cached
+    @conditional
+    def search_cast():
+        """
+        Required: q, the text to search actor names and movie titles for
+        Optional: limit and offset
+        EXAMPLE
+            GET /search?q=car&limit=5
+        :return: The actors and movies that match, best first
+        """
+        q = request.args.get('q')
+        if q is None:
+            raise UnprocessableEntity(description='q must be present')
+
+        limit = min(get_int_arg('limit', minimum=1) or SEARCH_PAGE_SIZE, MAX_SEARCH_PAGE_SIZE)
+        offset = get_int_arg('offset', minimum=0) or 0
+        try:
+            results = search(q, limit + 1, offset)
+        except OperationalError as e:
+            log_exception()
+            if getattr(e.orig, 'pgcode', None) == '57014':
+                # query_canceled: the search ran past SEARCH_TIMEOUT
+                raise SearchTimeout
+            raise BadRequest
+        except Exception:
+            log_exception()
+            raise BadRequest
+
+        return api_response({
+            'results': results[:limit],
+            'next': offset + limit if len(results) > limit else None
+        })
 
     def validate_actor(name: str = None, gender: str = None, age: int = None, movies: list = None, updating: bool = False):
         check_name = True if name is not None else False
@@ -97,12 +282,12 @@ def create_app(test_config=None):
         if check_age:
             actor_data['age'] = age
 
-            if not isinstance(actor_data['age'], int):
+            if not isinstance(actor_data['age'], int) or isinstance(actor_data['age'], bool):
                 raise UnprocessableEntity(
                     description=f'Actor age must an integer'
                 )
 
-            if not (actor_data['age'] > MIN_ACTOR_AGE or actor_data['age'] < MAX_ACTOR_AGE):
+            if not MIN_ACTOR_AGE < actor_data['age'] < MAX_ACTOR_AGE:
                 raise UnprocessableEntity(
                     description=f'Actor age greater than {MIN_ACTOR_AGE} and less than {MAX_ACTOR_AGE}'
                 )
@@ -154,8 +339,190 @@ def create_app(test_config=None):
 
         return movie_data
 
+    def get_id_list(value, name: str):
+        """
+        Check that a relationship property is a list of ids
+        :return: The ids without duplicates
+        """
+        if not isinstance(value, list) or not all(isinstance(i, int) and not isinstance(i, bool) for i in value):
+            raise UnprocessableEntity(description=f'{name} must be a list of ids')
+
+        return list(dict.fromkeys(value))
+
+    def insert_each(model, rows: list):
+        """
+        Insert the rows in one statement, or if the database refuses that, one at a time, so that the rows it
+        refuses are known and the others are still inserted
+        :param model:
+        :param rows: Column values for each row
+        :return: The ids of the new rows in the order of rows, with None for each refused row
+        """
+        try:
+            with db.session.begin_nested():
+                return insert_many(model, rows)
+        except (IntegrityError, DataError):
+            pass
+
+        ids = []
+        for row in rows:
+            try:
+                with db.session.begin_nested():
+                    ids += insert_many(model, [row])
+            except (IntegrityError, DataError):
+                ids.append(None)
+
+        return ids
+
+    def refuse_bulk(key: str, errors: list):
+        return api_response({
+            'success': False,
+            key: [],
+            'errors': errors
+        }, 422)
+
+    def bulk_create(model, related_model, validate, props: list, link_column: str, related_link_column: str):
+        """
+        Validate and insert many entities, looking up all the related ids in one query and committing once
+        Required: a list of entities under the model's table name, e.g. {"actors": [...]}
+        Optional: atomic, true (the default) to create nothing when any entity is invalid, or false to create the
+        valid entities and report the invalid ones
+        :param model: The model of the entities
+        :param related_model: The model of the entities they are linked to
+        :param validate: validate_actor or validate_movie
+        :param props: The properties passed to validate
+        :param link_column: The actors_movies column for the new entities
+        :param related_link_column: The actors_movies column for the related entities
+        :return:
+        """
+        key = str(model.__table__.name)
+        relation = model.RELATION
+        items = request.get_json()[key]
+        atomic = request.get_json().get('atomic', True)
+
+        if not isinstance(items, list) or not items:
+            raise UnprocessableEntity(description=f'{key} must be a list of at least one entity')
+        if len(items) > MAX_BULK_ITEMS:
+            raise UnprocessableEntity(description=f'At most {MAX_BULK_ITEMS} {key} can be created at once')
+        if not isinstance(atomic, bool):
+            raise UnprocessableEntity(description='atomic must be true or false')
+
+        requested_ids = {
+            related_id
+            for item in items if isinstance(item, dict) and isinstance(item.get(relation), list)
+            for related_id in item[relation] if isinstance(related_id, int)
+        }
+        existing_ids = set()
+        if requested_ids:
+            existing_ids = {row.id for row in
+                            db.session.query(related_model.id).filter(related_model.id.in_(requested_ids))}
+
+        rows = []
+        related_ids = []
+        # The position in the request of each row
+        indexes = []
+        errors = []
+        for index, item in enumerate(items):
+            try:
+                if not isinstance(item, dict):
+                    raise UnprocessableEntity(description='Each entity must be an object')
+
+                entity_data = validate(**{prop: item.get(prop) for prop in props})
+                ids = get_id_list(item.get(relation, []), relation)
+                missing = [related_id for related_id in ids if related_id not in existing_ids]
+                if missing:
+                    raise UnprocessableEntity(
+                        description=f'{relation} not found: {", ".join(str(related_id) for related_id in missing)}'
+                    )
+            except UnprocessableEntity as e:
+                errors.append({'index': index, 'description': e.description})
+                continue
+            except Exception:
+                errors.append({'index': index, 'description': 'The entity could not be read'})
+                continue
+
+            rows.append(entity_data)
+            related_ids.append(ids)
+            indexes.append(index)
+
+        if errors and atomic:
+            return refuse_bulk(key, errors)
+
+        ids = insert_each(model, rows)
+        for index, entity_id in zip(indexes, ids):
+            if entity_id is None:
+                errors.append({'index': index, 'description': 'The database refused the entity'})
+        errors.sort(key=lambda error: error['index'])
+        if errors and atomic:
+            db.session.rollback()
+            return refuse_bulk(key, errors)
+
+        links = [
+            {link_column: entity_id, related_link_column: related_id}
+            for entity_id, entity_related_ids in zip(ids, related_ids) if entity_id is not None
+            for related_id in entity_related_ids
+        ]
+        if links:
+            db.session.execute(actors_movies.insert(), links)
+            bump_table_versions(db.session, {actors_movies.name})
+        update()
+
+        ids = [entity_id for entity_id in ids if entity_id is not None]
+        created = []
+        if ids:
+            created = model.query \
+                .options(selectinload(getattr(model, relation)).lazyload('*')) \
+                .filter(model.id.in_(ids)) \
+                .order_by(model.id) \
+                .all()
+
+        return api_response({
+            'success': not errors,
+            key: [entity.format() for entity in created],
+            'errors': errors
+        })
+
+    def change_links(model, entity_id: int, related_model, column: str, related_column: str, adding: bool):
+        """
+        Link an entity to, or unlink it from, the related entities whose ids are given, without loading
+        either side's collection
+        Required: a list of ids under the name of the relationship, e.g. {"actors": [1, 2]}
+        :param model: The model of the entity
+        :param entity_id:
+        :param related_model: The model of the related entities
+        :param column: The actors_movies column of the entity
+        :param related_column: The actors_movies column of the related entities
+        :param adding: True to link, False to unlink
+        :return:
+        """
+        relation = model.RELATION
+        related_ids = get_id_list(request.get_json()[relation], relation)
+
+        if db.session.query(model.id).filter(model.id == entity_id).first() is None:
+            raise NotFound
+
+        if adding:
+            existing_ids = {row.id for row in
+                            db.session.query(related_model.id).filter(related_model.id.in_(related_ids))}
+            missing = [related_id for related_id in related_ids if related_id not in existing_ids]
+            if missing:
+                raise UnprocessableEntity(
+                    description=f'{relation} not found: {", ".join(str(related_id) for related_id in missing)}'
+                )
+
+            changed = add_links(column, entity_id, related_column, related_ids)
+        else:
+            changed = remove_links(column, entity_id, related_column, related_ids)
+
+        update()
+        return api_response({
+            'success': True,
+            'id': entity_id,
+            'added' if adding else 'removed': changed
+        })
+
     @app.route('/actors', methods=['POST'])
     @requires_auth(permission='create:actors')
+    @idempotent
     def create_actor():
         """
         Required: name, gender, age
@@ -192,16 +559,19 @@ def create_app(test_config=None):
         except UnprocessableEntity:
             raise
         except Exception:
-            print(sys.exc_info())
+            log_exception()
             raise BadRequest
 
-        return jsonify(response)
+        return api_response(response)
 
     @app.route('/actors/<int:actor_id>', methods=['PATCH'])
     @requires_auth(permission='update:actors')
     def update_actor(actor_id):
         try:
-            actor = Actors.query.filter(Actors.id == actor_id).first_or_404()
+            actor = Actors.query \
+                .options(joinedload(Actors.movies).lazyload(Movies.actors)) \
+                .filter(Actors.id == actor_id) \
+                .first_or_404()
 
             actor_props = ['name', 'gender', 'age', 'movies']
             actor_data = {}
@@ -225,10 +595,10 @@ def create_app(test_config=None):
         except NotFound:
             raise
         except Exception:
-            print(sys.exc_info())
+            log_exception()
             raise BadRequest
 
-        return jsonify(response)
+        return api_response(response)
 
     @app.route('/actors/<int:actor_id>', methods=['DELETE'])
     @requires_auth(permission='delete:actors')
@@ -248,13 +618,14 @@ def create_app(test_config=None):
         except NotFound:
             raise
         except Exception:
-            print(sys.exc_info())
+            log_exception()
             raise BadRequest
 
-        return jsonify(response)
+        return api_response(response)
 
     @app.route('/movies', methods=['POST'])
     @requires_auth(permission='create:movies')
+    @idempotent
     def create_movie():
         try:
             required_props = [
@@ -285,16 +656,16 @@ def create_app(test_config=None):
         except UnprocessableEntity:
             raise
         except Exception:
-            print(sys.exc_info())
+            log_exception()
             raise BadRequest
 
-        return jsonify(response)
+        return api_response(response)
 
     @app.route('/movies/<movie_id>', methods=['PATCH'])
     @requires_auth(permission='update:movies')
     def update_movie(movie_id):
         try:
-            movie = Movies.query.filter(Movies.id == movie_id).first_or_404()
+            movie = Movies.query.options(joinedload(Movies.actors)).filter(Movies.id == movie_id).first_or_404()
             if not movie:
                 raise
 
@@ -320,10 +691,10 @@ def create_app(test_config=None):
         except NotFound:
             raise
         except Exception:
-            print(sys.exc_info())
+            log_exception()
             raise BadRequest
 
-        return jsonify(response)
+        return api_response(response)
 
     @app.route('/movies/<int:movie_id>', methods=['DELETE'])
     @requires_auth(permission='delete:movies')
@@ -339,10 +710,78 @@ def create_app(test_config=None):
         except NotFound:
             raise
         except Exception:
-            print(sys.exc_info())
+            log_exception()
             raise BadRequest
 
-        return jsonify(response)
+        return api_response(response)
+
+    @app.route('/actors/bulk', methods=['POST'])
+    @requires_auth(permission='create:actors')
+    @idempotent
+    def create_actors():
+        """
+        Required: actors, a list of objects with the properties of POST /actors
+        Optional: atomic
+        :return:
+        """
+        try:
+            return bulk_create(Actors, Movies, validate_actor, ['name', 'gender', 'age'], 'actor_id', 'movie_id')
+        except UnprocessableEntity:
+            raise
+        except Exception:
+            log_exception()
+            raise BadRequest
+
+    @app.route('/movies/bulk', methods=['POST'])
+    @requires_auth(permission='create:movies')
+    @idempotent
+    def create_movies():
+        """
+        Required: movies, a list of objects with the properties of POST /movies
+        Optional: atomic
+        :return:
+        """
+        try:
+            return bulk_create(Movies, Actors, validate_movie, ['title', 'release_date'], 'movie_id', 'actor_id')
+        except UnprocessableEntity:
+            raise
+        except Exception:
+            log_exception()
+            raise BadRequest
+
+    @app.route('/actors/<int:actor_id>/movies', methods=['POST', 'DELETE'])
+    @requires_auth(permission='update:actors')
+    def change_actor_movies(actor_id):
+        """
+        Required: movies, the ids of the movies to add the actor to or remove the actor from
+        :return:
+        """
+        try:
+            return change_links(Actors, actor_id, Movies, 'actor_id', 'movie_id', request.method == 'POST')
+        except UnprocessableEntity:
+            raise
+        except NotFound:
+            raise
+        except Exception:
+            log_exception()
+            raise BadRequest
+
+    @app.route('/movies/<int:movie_id>/actors', methods=['POST', 'DELETE'])
+    @requires_auth(permission='update:movies')
+    def change_movie_actors(movie_id):
+        """
+        Required: actors, the ids of the actors to add to or remove from the movie's cast
+        :return:
+        """
+        try:
+            return change_links(Movies, movie_id, Actors, 'movie_id', 'actor_id', request.method == 'POST')
+        except UnprocessableEntity:
+            raise
+        except NotFound:
+            raise
+        except Exception:
+            log_exception()
+            raise BadRequest
 
     # Error Handling
     @app.errorhandler(HTTPException)
@@ -357,12 +796,28 @@ def create_app(test_config=None):
         if hasattr(e, 'message'):
             response_body['message'] = e.message
 
-        return jsonify(response_body), code
+        response = api_response(response_body, code)
+        if getattr(e, 'retry_after', None) is not None:
+            response.headers['Retry-After'] = str(e.retry_after)
+        return response
+
+    if warm:
+        warm_up(app)
 
     return app
 
 
-APP = create_app()
+def __getattr__(name):
+    """
+    Build APP on first use rather than on import, for `gunicorn app:APP`
+    """
+    if name == 'APP':
+        global APP
+        APP = create_app()
+        return APP
+
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
 
 if __name__ == '__main__':
-    APP.run(host='0.0.0.0', port=8080)
+    create_app().run(host='0.0.0.0', port=8080)
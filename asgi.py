@@ -0,0 +1,257 @@
+"""
+An ASGI entry point that serves the routes of create_app() from an event loop, for any ASGI server:
+
+    uvicorn --factory asgi:create_asgi_app
+    gunicorn -k uvicorn.workers.UvicornWorker "asgi:create_asgi_app()"
+
+The event loop reads request bodies and writes responses, so a slow client only holds a coroutine. The views and
+their blocking database sessions run on a bounded pool of threads, and the signing keys are refreshed in the
+background, so no request waits on Auth0.
+"""
+import asyncio
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+from werkzeug.exceptions import RequestEntityTooLarge
+
+from auth import jwks_store
+from instrumentation import log_exception
+
+# Threads that run the views. More than the database pool size plus overflow only makes them wait for connections.
+ASGI_THREADS = int(os.environ.get('ASGI_THREADS', 15))
+# Largest request body held in memory, in bytes
+MAX_REQUEST_BODY = int(os.environ.get('MAX_REQUEST_BODY', 16 * 1024 * 1024))
+# Chunks of a streamed response buffered for a client that reads slower than they are produced
+RESPONSE_BUFFER = 16
+# The keys are fetched again after this fraction of the time until requests would find them stale: of
+# JWKS_CACHE_TTL after a fetch, and of JWKS_MIN_REFRESH_INTERVAL after a failed one
+KEY_REFRESH_FRACTION = 0.8
+# Seconds between fetches, at the least, should the keys be stale already
+KEY_MIN_REFRESH_DELAY = 1.0
+
+
+class ClientDisconnected(Exception):
+    pass
+
+
+def wsgi_environ(scope, body: bytes):
+    """
+    The WSGI environ of an ASGI HTTP request
+    :param scope:
+    :param body: The whole request body
+    :return:
+    """
+    server = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode().decode('latin-1'),
+        'PATH_INFO': scope['path'].encode().decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f'HTTP/{scope.get("http_version", "1.1")}',
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False
+    }
+    if scope.get('client'):
+        environ['REMOTE_ADDR'], environ['REMOTE_PORT'] = scope['client'][0], str(scope['client'][1])
+
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin-1').upper().replace('-', '_')
+        key = name if name in ('CONTENT_TYPE', 'CONTENT_LENGTH') else f'HTTP_{name}'
+        value = value.decode('latin-1')
+        environ[key] = f'{environ[key]},{value}' if key in environ else value
+
+    # The body has been read whole, whatever the client sent it with
+    environ['CONTENT_LENGTH'] = str(len(body))
+    environ.pop('HTTP_TRANSFER_ENCODING', None)
+
+    return environ
+
+
+class ASGIApp:
+    """
+    Serves a Flask app to an ASGI server, running it on a thread pool
+    """
+
+    def __init__(self, app, threads: int = ASGI_THREADS, refresh_keys: bool = True):
+        """
+        :param app: The Flask app
+        :param threads: Views that can run at once
+        :param refresh_keys: Whether to fetch the signing keys at startup and keep them fresh in the background
+        """
+        self.app = app
+        self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='asgi')
+        self.refresh_keys = refresh_keys
+        self._key_refresher = None
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'http':
+            self.start_key_refresher()
+            await self.http(scope, receive, send)
+        elif scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                # Accept requests once the keys are there
+                await self.fetch_keys()
+                self.start_key_refresher()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                if self._key_refresher is not None:
+                    self._key_refresher.cancel()
+                self.executor.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def fetch_keys(self):
+        """
+        Fetch the signing keys on another thread
+        :return: Seconds until they should be fetched again
+        """
+        if not self.refresh_keys:
+            return None
+
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, jwks_store.refresh)
+        except Exception:
+            log_exception('Could not fetch the signing keys')
+            return max(jwks_store.min_refresh_interval * KEY_REFRESH_FRACTION, KEY_MIN_REFRESH_DELAY)
+
+        # A failed fetch keeps the stale keys for the minimum refresh interval only, so it is retried before
+        # requests would have to
+        return max(jwks_store.expires_in() * KEY_REFRESH_FRACTION, KEY_MIN_REFRESH_DELAY)
+
+    def start_key_refresher(self):
+        if self.refresh_keys and self._key_refresher is None:
+            self._key_refresher = asyncio.ensure_future(self.keep_keys_fresh())
+
+    async def keep_keys_fresh(self):
+        while True:
+            await asyncio.sleep(await self.fetch_keys())
+
+    async def http(self, scope, receive, send):
+        app = self.app
+        chunks = []
+        size = 0
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return
+            size += len(message.get('body', b''))
+            if size > MAX_REQUEST_BODY:
+                app = self.too_large
+                chunks = []
+                break
+            chunks.append(message.get('body', b''))
+            if not message.get('more_body'):
+                break
+
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue(maxsize=RESPONSE_BUFFER)
+        disconnected = []
+        running = loop.run_in_executor(self.executor, self.run, app, wsgi_environ(scope, b''.join(chunks)), loop,
+                                       queue, disconnected)
+        try:
+            while True:
+                kind, data = await queue.get()
+                if kind == 'start':
+                    status, headers = data
+                    await send({
+                        'type': 'http.response.start',
+                        'status': int(status.split(' ', 1)[0]),
+                        'headers': [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                                    for name, value in headers]
+                    })
+                elif kind == 'body':
+                    await send({'type': 'http.response.body', 'body': data, 'more_body': True})
+                elif kind == 'error':
+                    raise RuntimeError('The response failed after it had started')
+                else:
+                    break
+            await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+        except BaseException:
+            # Stop the thread at its next chunk. Emptying the queue unblocks the chunk it may be putting.
+            disconnected.append(True)
+            while not queue.empty():
+                queue.get_nowait()
+            raise
+        await running
+
+    def run(self, app, environ, loop, queue, disconnected):
+        """
+        Run the WSGI app and iterate over its response on one thread, since sessions and streamed responses
+        are bound to the thread that started them
+        """
+        def put(kind, data=None):
+            if disconnected:
+                raise ClientDisconnected
+            asyncio.run_coroutine_threadsafe(queue.put((kind, data)), loop).result()
+
+        response = {'start': None, 'sent': False}
+
+        def start_response(status, headers, exc_info=None):
+            if exc_info is not None and response['sent']:
+                raise exc_info[1].with_traceback(exc_info[2])
+            response['start'] = (status, headers)
+
+        def send_start():
+            if not response['sent']:
+                put('start', response['start'])
+                response['sent'] = True
+
+        iterable = None
+        try:
+            iterable = app(environ, start_response)
+            for chunk in iterable:
+                if chunk:
+                    send_start()
+                    put('body', chunk)
+            send_start()
+            put('end')
+        except ClientDisconnected:
+            pass
+        except Exception:
+            log_exception()
+            try:
+                if response['sent']:
+                    # Too late for an error response, so the connection is dropped
+                    put('error')
+                else:
+                    response['start'] = ('500 INTERNAL SERVER ERROR', [('Content-Type', 'text/plain')])
+                    send_start()
+                    put('end')
+            except ClientDisconnected:
+                pass
+        finally:
+            if hasattr(iterable, 'close'):
+                iterable.close()
+
+    def too_large(self, environ, start_response):
+        with self.app.request_context(environ):
+            response = self.app.make_response(self.app.handle_http_exception(RequestEntityTooLarge()))
+        return response(environ, start_response)
+
+
+def create_asgi_app(app=None, **options):
+    """
+    The ASGI application factory
+    :param app: The Flask app, create_app() if not given
+    :param options: See ASGIApp
+    :return:
+    """
+    if app is None:
+        from app import create_app
+        app = create_app()
+
+    return ASGIApp(app, **options)
@@ -1,17 +1,373 @@
+import hashlib
 import json
 import os
-from flask import request
-from functools import wraps
+import threading
+import time
+from collections import OrderedDict
+from flask import request, g
+from functools import wraps, lru_cache
 from jose import jwt, JWTError
 from urllib.request import urlopen
 
 from werkzeug.exceptions import Unauthorized
 
-from errors import AuthHeaderMissing, AuthHeaderInvalid, PermissionsNotFound, TokenExpired
+from instrumentation import timed
+from errors import AuthHeaderMissing, AuthHeaderInvalid, PermissionsNotFound, TokenExpired, JWKSUnavailable
 
 auth0_settings_names = ['AUTH0_DOMAIN', 'ALGORITHMS', 'API_AUDIENCE']
-auth0_settings = {setting: os.environ[setting] for setting in auth0_settings_names}
-auth0_settings['ALGORITHMS'] = auth0_settings['ALGORITHMS'].split(',')
+
+# Seconds the signing keys are trusted before they are fetched again
+JWKS_CACHE_TTL = float(os.environ.get('JWKS_CACHE_TTL', 600))
+# Minimum seconds between two fetches, so tokens with made-up kids cannot hammer Auth0
+JWKS_MIN_REFRESH_INTERVAL = float(os.environ.get('JWKS_MIN_REFRESH_INTERVAL', 10))
+JWKS_FETCH_TIMEOUT = float(os.environ.get('JWKS_FETCH_TIMEOUT', 5))
+# Number of verified tokens kept per process. 0 turns the cache off.
+TOKEN_CACHE_SIZE = int(os.environ.get('TOKEN_CACHE_SIZE', 1024))
+
+
+@lru_cache(maxsize=None)
+def get_auth0_settings():
+    """
+    Read the Auth0 settings from the environment, the first time they are needed rather than on import
+    :return:
+    """
+    settings = {setting: os.environ[setting] for setting in auth0_settings_names}
+    settings['ALGORITHMS'] = settings['ALGORITHMS'].split(',')
+    settings['JWKS_URL'] = os.environ.get('JWKS_URL', f'https://{settings["AUTH0_DOMAIN"]}/.well-known/jwks.json')
+
+    return settings
+
+
+class JWKSKeyStore:
+    """
+    Process-wide cache of the JWKS signing keys, indexed by kid.
+
+    Keys are refetched once the TTL has passed or as soon as a token names an unknown kid. Only one
+    thread per process fetches at a time; the others wait for it and then use its result. If a refresh
+    fails, the last good keys keep being served.
+    """
+
+    def __init__(self, url=None, ttl=JWKS_CACHE_TTL, min_refresh_interval=JWKS_MIN_REFRESH_INTERVAL,
+                 timeout=JWKS_FETCH_TIMEOUT):
+        self.url = url
+        self.ttl = ttl
+        self.min_refresh_interval = min_refresh_interval
+        self.timeout = timeout
+
+        self._keys = {}
+        self._expires_at = 0.0
+        self._last_fetch = None
+        # Fetches tried, and key sets loaded, so far
+        self._attempts = 0
+        self._fetch_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._stats = {
+            'hits': 0,
+            'misses': 0,
+            'refreshes': 0,
+            'refresh_failures': 0
+        }
+
+    def _count(self, stat):
+        with self._stats_lock:
+            self._stats[stat] += 1
+
+    def stats(self):
+        """
+        Counters for key lookups and fetches in this process
+        :return:
+        """
+        with self._stats_lock:
+            stats = dict(self._stats)
+
+        stats['keys'] = len(self._keys)
+        return stats
+
+    def fetch(self):
+        """
+        Download and parse the JWKS document
+        :return: The RSA keys that can be used to verify a token, by kid
+        """
+        url = self.url or get_auth0_settings()['JWKS_URL']
+        with urlopen(url, timeout=self.timeout) as jsonurl:
+            jwks = json.loads(jsonurl.read())
+
+        keys = {}
+        for key in jwks['keys']:
+            try:
+                keys[key['kid']] = {
+                    'kty': key['kty'],
+                    'kid': key['kid'],
+                    'use': key['use'],
+                    'n': key['n'],
+                    'e': key['e']
+                }
+            except KeyError:
+                continue
+
+        return keys
+
+    def load(self, keys):
+        """
+        Replace the cached keys, e.g. with keys fetched ahead of time
+        :param keys: Keys by kid, as returned by fetch()
+        :return:
+        """
+        with self._fetch_lock:
+            self._store(keys)
+
+    def _store(self, keys):
+        self._keys = keys
+        self._expires_at = time.monotonic() + self.ttl
+        self._attempts += 1
+
+    def refresh(self, attempt=None):
+        """
+        Fetch the keys unless another thread has tried to since the given attempt was read. Whether that
+        fetch succeeded or failed, the threads that waited for it use its outcome instead of fetching again.
+        :param attempt: The number of fetch attempts when the caller found the keys lacking
+        :return: The current keys by kid
+        """
+        if attempt is None:
+            attempt = self._attempts
+
+        with self._fetch_lock:
+            if self._attempts != attempt:
+                # Someone else fetched, or failed to, while we were waiting for the lock
+                if not self._keys:
+                    raise JWKSUnavailable
+                return self._keys
+
+            self._last_fetch = time.monotonic()
+            try:
+                keys = self.fetch()
+            except Exception:
+                self._attempts += 1
+                self._count('refresh_failures')
+                if not self._keys:
+                    raise JWKSUnavailable
+
+                # Keep the stale keys and try again after the minimum interval
+                self._expires_at = self._last_fetch + self.min_refresh_interval
+                return self._keys
+
+            self._store(keys)
+            self._count('refreshes')
+            return keys
+
+    def expires_in(self):
+        """
+        :return: Seconds until the keys are stale: the TTL after a fetch, or the minimum refresh interval after a
+        failed one
+        """
+        return max(self._expires_at - time.monotonic(), 0.0)
+
+    def preload(self):
+        """
+        Fetch the keys now, unless fresh ones are cached
+        :return:
+        """
+        if time.monotonic() >= self._expires_at:
+            self.refresh()
+
+    def get_key(self, kid):
+        """
+        Get the signing key for a kid, refreshing the keys when they are stale or the kid is unknown
+        :param kid:
+        :return: The key, or None if the JWKS does not have it
+        """
+        attempt = self._attempts
+        keys = self._keys
+        if time.monotonic() >= self._expires_at:
+            keys = self.refresh(attempt)
+            attempt = self._attempts
+
+        if kid in keys:
+            self._count('hits')
+            return keys[kid]
+
+        self._count('misses')
+        if self._last_fetch is not None and time.monotonic() - self._last_fetch < self.min_refresh_interval:
+            return None
+
+        return self.refresh(attempt).get(kid)
+
+
+class VerifiedToken:
+    """
+    The payload of a token that passed verification, with its permissions claim compiled into a set
+    """
+    __slots__ = ('payload', 'permissions')
+
+    def __init__(self, payload):
+        self.payload = payload
+        permissions = payload.get('permissions')
+        self.permissions = frozenset(permissions) if isinstance(permissions, (list, tuple)) else None
+
+
+class Permissions:
+    """
+    A permission requirement, compiled once when an endpoint is decorated.
+
+    Checking it costs one set lookup per required permission no matter how many permissions the token has.
+    """
+    __slots__ = ('required', 'any')
+
+    def __init__(self, required, any=False):
+        self.required = frozenset(required)
+        self.any = any
+
+    def allows(self, granted: frozenset):
+        if self.any:
+            return not self.required.isdisjoint(granted)
+        return self.required.issubset(granted)
+
+    def __str__(self):
+        return (' or ' if self.any else ' and ').join(sorted(self.required))
+
+
+def all_of(*permissions):
+    """
+    Require every one of the permissions
+    EXAMPLE
+        @requires_auth(all_of('get:actors', 'get:movies'))
+    """
+    return Permissions(permissions)
+
+
+def any_of(*permissions):
+    """
+    Require at least one of the permissions
+    EXAMPLE
+        @requires_auth(any_of('update:actors', 'update:movies'))
+    """
+    return Permissions(permissions, any=True)
+
+
+def compile_permissions(permission):
+    """
+    Turn the permission argument of requires_auth into a Permissions requirement
+    :param permission: A permission name, a list of names that are all required, or a Permissions object
+    :return:
+    """
+    if isinstance(permission, Permissions):
+        return permission
+    if isinstance(permission, str):
+        return all_of(permission)
+    return all_of(*permission)
+
+
+class VerifiedTokenCache:
+    """
+    Bounded LRU of tokens whose signature and claims have already been verified.
+
+    Entries are keyed by the SHA-256 of the token and dropped once the token's exp has passed, so
+    an expired or evicted token goes through full verification again.
+    """
+
+    def __init__(self, maxsize=TOKEN_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {
+            'hits': 0,
+            'misses': 0,
+            'expirations': 0,
+            'evictions': 0
+        }
+
+    @staticmethod
+    def key(token):
+        return hashlib.sha256(token.encode()).digest()
+
+    def stats(self):
+        """
+        Counters for lookups in this process
+        :return:
+        """
+        with self._lock:
+            stats = dict(self._stats)
+            stats['size'] = len(self._entries)
+
+        return stats
+
+    def get(self, token):
+        """
+        Get a token that was already verified
+        :param token:
+        :return: The VerifiedToken, or None if the token has to be verified
+        """
+        if self.maxsize <= 0:
+            return None
+
+        key = self.key(token)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._stats['misses'] += 1
+                return None
+
+            expires_at, verified = entry
+            if expires_at <= time.time():
+                del self._entries[key]
+                self._stats['expirations'] += 1
+                self._stats['misses'] += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self._stats['hits'] += 1
+            return verified
+
+    def put(self, token, verified: VerifiedToken):
+        """
+        Remember a verified token until its exp
+        :param token:
+        :param verified:
+        :return:
+        """
+        expires_at = verified.payload.get('exp')
+        if self.maxsize <= 0 or not isinstance(expires_at, (int, float)):
+            return
+
+        key = self.key(token)
+        with self._lock:
+            self._entries[key] = (expires_at, verified)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self._stats['evictions'] += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+# Fetches from JWKS_URL
+jwks_store = JWKSKeyStore()
+token_cache = VerifiedTokenCache()
+
+
+def auth_metrics():
+    """
+    The counters of the signing key store and of the verified token cache, for Metrics.add_collector()
+    :return:
+    """
+    jwks = jwks_store.stats()
+    tokens = token_cache.stats()
+    return [
+        ('jwks_lookups_total', 'counter', 'Signing key lookups, by whether the kid was cached',
+         [({'result': 'hit'}, jwks['hits']), ({'result': 'miss'}, jwks['misses'])]),
+        ('jwks_fetches_total', 'counter', 'Fetches of the signing keys, by outcome',
+         [({'result': 'success'}, jwks['refreshes']), ({'result': 'failure'}, jwks['refresh_failures'])]),
+        ('jwks_keys', 'gauge', 'Signing keys cached', [({}, jwks['keys'])]),
+        ('token_cache_lookups_total', 'counter', 'Verified token cache lookups, by whether the token was cached',
+         [({'result': 'hit'}, tokens['hits']), ({'result': 'miss'}, tokens['misses'])]),
+        ('token_cache_expirations_total', 'counter', 'Cached tokens dropped once their exp passed',
+         [({}, tokens['expirations'])]),
+        ('token_cache_evictions_total', 'counter', 'Cached tokens dropped to make room for others',
+         [({}, tokens['evictions'])]),
+        ('token_cache_size', 'gauge', 'Verified tokens cached', [({}, tokens['size'])])
+    ]
 
 # Much of the following is from BasicFlaskAuth
 
@@ -38,36 +394,31 @@ def get_token_auth_header():
     return token
 
 
-def check_permissions(permission, payload):
-    if 'permissions' not in payload:
+def check_permissions(permission, verified: VerifiedToken):
+    """
+    :param permission: A Permissions requirement
+    :param verified: The token to check
+    :return:
+    """
+    if verified.permissions is None:
         raise PermissionsNotFound
 
-    if permission not in payload['permissions']:
+    if not permission.allows(verified.permissions):
         raise Unauthorized(description=f'Permission {permission} not found.')
     return True
 
 
 def verify_decode_jwt(token):
-    jsonurl = urlopen(f'https://{auth0_settings["AUTH0_DOMAIN"]}/.well-known/jwks.json')
-    jwks = json.loads(jsonurl.read())
     try:
         unverified_header = jwt.get_unverified_header(token)
     except JWTError:
         raise AuthHeaderInvalid(description='Could not decode auth token')
-    rsa_key = {}
     if 'kid' not in unverified_header:
         raise AuthHeaderInvalid(description='Authorization malformed.')
 
-    for key in jwks['keys']:
-        if key['kid'] == unverified_header['kid']:
-            rsa_key = {
-                'kty': key['kty'],
-                'kid': key['kid'],
-                'use': key['use'],
-                'n': key['n'],
-                'e': key['e']
-            }
+    rsa_key = jwks_store.get_key(unverified_header['kid'])
     if rsa_key:
+        auth0_settings = get_auth0_settings()
         try:
             payload = jwt.decode(
                 token,
@@ -89,13 +440,36 @@ def verify_decode_jwt(token):
     raise AuthHeaderInvalid(description='Unable to find the appropriate key.')
 
 
+def get_verified_token():
+    """
+    Verify the token of the current request, once per request and once per token while it is cached
+    :return: The VerifiedToken
+    """
+    verified = g.get('verified_token')
+    if verified is None:
+        token = get_token_auth_header()
+        verified = token_cache.get(token)
+        if verified is None:
+            verified = VerifiedToken(verify_decode_jwt(token))
+            token_cache.put(token, verified)
+        g.verified_token = verified
+
+    return verified
+
+
 def requires_auth(permission=''):
+    """
+    :param permission: A permission name, a list of names that are all required, or the result of any_of()
+    or all_of()
+    :return:
+    """
+    permission = compile_permissions(permission)
+
     def requires_auth_decorator(f):
         @wraps(f)
         def wrapper(*args, **kwargs):
-            token = get_token_auth_header()
-            payload = verify_decode_jwt(token)
-            check_permissions(permission, payload)
+            with timed('auth'):
+                check_permissions(permission, get_verified_token())
             return f(*args, **kwargs)
 
         return wrapper
@@ -0,0 +1,187 @@
+"""
+Slow clients against sync workers and against the ASGI mode of asgi.py.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_async --clients 200 --requests 2000 --client-delay 50
+
+Every client sends its request and reads its response over --client-delay milliseconds in total, like a mobile
+client on a slow network, and then sends the next one. With sync workers, as gunicorn runs them, a worker is busy
+for as long as its client, so only --workers clients are served at once. In the ASGI mode the event loop waits for
+the clients and the views run on --threads threads. Both run the same app in this process, on a temporary SQLite
+database seeded as bench_load does, with the same random requests for a given --seed, so runs can be compared.
+To compare real servers, run bench_load with --url against gunicorn and against uvicorn instead.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import statistics
+import tempfile
+import threading
+import time
+
+os.environ.setdefault('DATABASE_URL', f'sqlite:///{os.path.join(tempfile.mkdtemp(), "bench.db")}')
+os.environ.setdefault('AUTH0_DOMAIN', 'casting.local')
+os.environ.setdefault('ALGORITHMS', 'RS256')
+os.environ.setdefault('API_AUDIENCE', 'casting')
+
+from werkzeug.test import EnvironBuilder
+
+import auth
+from benchmarks.bench_load import seed
+from local_auth import LocalAuth
+
+
+def plan(requests: int, actors: int, movies: int):
+    """
+    The paths to request, the same for every mode
+    """
+    return [random.choice([
+        f'/actors?after_id={random.randint(0, actors)}',
+        f'/movies?after_id={random.randint(0, movies)}',
+        '/movies?sort=-release_date&limit=5',
+        f'/search?q=Actor%20{random.randint(1, actors)}'
+    ]) for _ in range(requests)]
+
+
+def run_sync(app, paths: list, token: str, clients: int, workers: int, delay: float):
+    """
+    Each client holds a worker while it sends and reads
+    :return: (seconds, latencies)
+    """
+    slots = threading.Semaphore(workers)
+    pending = list(reversed(paths))
+    lock = threading.Lock()
+    latencies = []
+    failures = []
+
+    def client():
+        while True:
+            with lock:
+                if not pending:
+                    return
+                path = pending.pop()
+            start = time.perf_counter()
+            with slots:
+                time.sleep(delay / 2)
+                environ = EnvironBuilder(path=path, headers={'Authorization': f'Bearer {token}'}).get_environ()
+                status = []
+                body = b''.join(app(environ, lambda *response: status.append(response[0])))
+                time.sleep(delay / 2)
+            with lock:
+                latencies.append(time.perf_counter() - start)
+                if not status[0].startswith('200'):
+                    failures.append((path, body))
+
+    threads = [threading.Thread(target=client) for _ in range(clients)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert not failures, failures[:3]
+
+    return time.perf_counter() - start, latencies
+
+
+def run_asgi(app, paths: list, token: str, clients: int, threads: int, delay: float):
+    """
+    The event loop waits for the clients, and only the views take threads
+    :return: (seconds, latencies)
+    """
+    from asgi import create_asgi_app
+
+    asgi_app = create_asgi_app(app, threads=threads, refresh_keys=False)
+    pending = list(reversed(paths))
+    latencies = []
+
+    async def request(path):
+        path, _, query = path.partition('?')
+        scope = {
+            'type': 'http', 'http_version': '1.1', 'method': 'GET', 'scheme': 'http', 'path': path,
+            'query_string': query.encode(), 'headers': [(b'authorization', f'Bearer {token}'.encode())]
+        }
+        sent = []
+
+        async def receive():
+            await asyncio.sleep(delay / 2)
+            return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+        async def send(message):
+            sent.append(message)
+            if message['type'] == 'http.response.body' and not message.get('more_body'):
+                await asyncio.sleep(delay / 2)
+
+        await asgi_app(scope, receive, send)
+        assert sent[0]['status'] == 200, (path, sent)
+
+    async def client():
+        while pending:
+            path = pending.pop()
+            start = time.perf_counter()
+            await request(path)
+            latencies.append(time.perf_counter() - start)
+
+    async def main():
+        await asyncio.gather(*[client() for _ in range(clients)])
+
+    start = time.perf_counter()
+    asyncio.run(main())
+    asgi_app.executor.shutdown()
+
+    return time.perf_counter() - start, latencies
+
+
+def summary(seconds: float, latencies: list):
+    quantiles = statistics.quantiles(latencies, n=100)
+    return {
+        'requests_per_second': len(latencies) / seconds,
+        'p50_ms': quantiles[49] * 1e3,
+        'p95_ms': quantiles[94] * 1e3,
+        'p99_ms': quantiles[98] * 1e3
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--actors', type=int, default=500)
+    parser.add_argument('--movies', type=int, default=200)
+    parser.add_argument('--cast', type=int, default=5, help='Actors per movie')
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--clients', type=int, default=200, help='Clients connected at once')
+    parser.add_argument('--client-delay', type=float, default=50,
+                        help='Milliseconds each client takes to send a request and read the response')
+    parser.add_argument('--workers', type=int, default=4, help='Sync workers')
+    parser.add_argument('--threads', type=int, default=4, help='Threads of the ASGI mode')
+    parser.add_argument('--seed', type=int, default=1, help='Random seed, so runs request the same things')
+    parser.add_argument('--json', help='Write the results to this file')
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    local = LocalAuth(os.environ['AUTH0_DOMAIN'], os.environ['API_AUDIENCE'])
+    auth.jwks_store.load(local.keys())
+    token = local.mint_token('CA')
+    app = seed(args.actors, args.movies, args.cast)
+    paths = plan(args.requests, args.actors, args.movies)
+    delay = args.client_delay / 1e3
+
+    print(f'{args.requests} requests from {args.clients} clients that take {args.client_delay:g} ms each, '
+          f'{args.workers} sync workers, {args.threads} ASGI threads')
+    results = {
+        f'sync ({args.workers} workers)': summary(*run_sync(app, paths, token, args.clients, args.workers, delay)),
+        f'asgi ({args.threads} threads)': summary(*run_asgi(app, paths, token, args.clients, args.threads, delay))
+    }
+    print(f'{"mode":22}{"req/s":>10}{"p50 ms":>10}{"p95 ms":>10}{"p99 ms":>10}')
+    for mode, result in results.items():
+        print(f'{mode:22}{result["requests_per_second"]:10.1f}{result["p50_ms"]:10.1f}{result["p95_ms"]:10.1f}'
+              f'{result["p99_ms"]:10.1f}')
+
+    if args.json:
+        with open(args.json, 'w') as output:
+            json.dump({'settings': vars(args), 'results': results}, output, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+"""
+Auth overhead per request, with the verified-token cache on and off.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_auth --requests 2000
+
+Tokens are signed by a local key pair, so neither Auth0 nor a database is needed.
+"""
+import argparse
+import os
+import time
+
+os.environ.setdefault('AUTH0_DOMAIN', 'casting.local')
+os.environ.setdefault('ALGORITHMS', 'RS256')
+os.environ.setdefault('API_AUDIENCE', 'casting')
+
+from flask import Flask, g
+
+import auth
+from local_auth import LocalAuth
+
+
+def run(requests: int, cache_size: int, token: str):
+    """
+    Time requires_auth over the same bearer token
+    :return: Microseconds per request
+    """
+    auth.token_cache.maxsize = cache_size
+    auth.token_cache.clear()
+
+    app = Flask(__name__)
+    view = auth.requires_auth('get:actors')(lambda: None)
+    headers = {'Authorization': f'Bearer {token}'}
+
+    with app.test_request_context(headers=headers):
+        start = time.perf_counter()
+        for _ in range(requests):
+            # Each request starts without a verified token
+            g.pop('verified_token', None)
+            view()
+        elapsed = time.perf_counter() - start
+
+    return elapsed / requests * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--cache-size', type=int, default=auth.TOKEN_CACHE_SIZE or 1024)
+    args = parser.parse_args()
+
+    settings = auth.get_auth0_settings()
+    local = LocalAuth(settings['AUTH0_DOMAIN'], settings['API_AUDIENCE'])
+    auth.jwks_store.load(local.keys())
+    token = local.mint_token('CA')
+
+    off = run(args.requests, 0, token)
+    on = run(args.requests, args.cache_size, token)
+
+    print(f'requests per run: {args.requests}')
+    print(f'token cache off: {off:10.1f} us/request')
+    print(f'token cache on:  {on:10.1f} us/request  ({off / on:.1f}x)')
+    print(f'token cache stats: {auth.token_cache.stats()}')
+
+
+if __name__ == '__main__':
+    main()
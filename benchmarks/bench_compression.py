@@ -0,0 +1,78 @@
+"""
+Response sizes and times of each format and content coding that clients can negotiate: JSON or MessagePack, sent
+as it is, gzip or brotli.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_compression --actors 1000 --movies 500 --cast 5 --repeats 50
+
+The requests go through the app in this process, on a temporary SQLite database seeded as bench_load does, so the
+times are those of the server alone, without the network that the smaller bodies save. MessagePack and brotli are
+left out when msgpack and brotli are not installed. The levels are those of GZIP_LEVEL and BROTLI_QUALITY.
+"""
+import argparse
+import json
+import os
+import tempfile
+import time
+
+os.environ.setdefault('DATABASE_URL', f'sqlite:///{os.path.join(tempfile.mkdtemp(), "bench.db")}')
+os.environ.setdefault('AUTH0_DOMAIN', 'casting.local')
+os.environ.setdefault('ALGORITHMS', 'RS256')
+os.environ.setdefault('API_AUDIENCE', 'casting')
+
+import auth
+from benchmarks.bench_load import seed
+from compression import encodings, GZIP_LEVEL, BROTLI_QUALITY
+from local_auth import LocalAuth
+from serialization import JSON_MIMETYPE, MSGPACK_MIMETYPE, msgpack
+
+PATHS = ['/actors?limit=10', '/actors?limit=100', '/movies?limit=100', '/search?q=Actor%201']
+
+
+def measure(client, path: str, headers: dict, repeats: int):
+    """
+    :return: (body bytes, mean milliseconds per request)
+    """
+    body = client.get(path, headers=headers).get_data()
+    start = time.perf_counter()
+    for _ in range(repeats):
+        client.get(path, headers=headers).get_data()
+    return len(body), (time.perf_counter() - start) / repeats * 1e3
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--actors', type=int, default=1000)
+    parser.add_argument('--movies', type=int, default=500)
+    parser.add_argument('--cast', type=int, default=5, help='Actors per movie')
+    parser.add_argument('--repeats', type=int, default=50)
+    parser.add_argument('--json', help='Write the results to this file')
+    args = parser.parse_args()
+
+    local = LocalAuth(os.environ['AUTH0_DOMAIN'], os.environ['API_AUDIENCE'])
+    auth.jwks_store.load(local.keys())
+    token = local.mint_token('CA')
+    client = seed(args.actors, args.movies, args.cast).test_client()
+
+    mimetypes = [JSON_MIMETYPE] + ([MSGPACK_MIMETYPE] if msgpack is not None else [])
+    codings = ['identity'] + list(reversed(encodings()))
+    print(f'{args.actors} actors, {args.movies} movies, {args.cast} actors per movie, gzip level {GZIP_LEVEL}, '
+          f'brotli quality {BROTLI_QUALITY}')
+    print(f'{"path":22}{"format":22}{"coding":>10}{"bytes":>10}{"ms":>8}')
+    rows = []
+    for path in PATHS:
+        for mimetype in mimetypes:
+            for coding in codings:
+                headers = {'Authorization': f'Bearer {token}', 'Accept': mimetype, 'Accept-Encoding': coding}
+                size, milliseconds = measure(client, path, headers, args.repeats)
+                rows.append({'path': path, 'format': mimetype, 'coding': coding, 'bytes': size, 'ms': milliseconds})
+                print(f'{path:22}{mimetype:22}{coding:>10}{size:10d}{milliseconds:8.2f}')
+
+    if args.json:
+        with open(args.json, 'w') as output:
+            json.dump({'settings': vars(args), 'results': rows}, output, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,142 @@
+"""
+The gunicorn profiles of gunicorn.conf.py under the same load: sync, gthread and gevent workers, and gthread without
+preloading.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_gunicorn --workers 2 --requests 2000 --concurrency 32
+
+Each profile gets a freshly seeded database and a gunicorn server started with gunicorn.conf.py, which bench_load
+then sends the same requests to. Reported are the seconds until the server answered, throughput and latency over all
+routes, and the memory of the master and workers (PSS, Linux only). Profiles whose worker class is not installed
+are skipped. By default the database is a temporary SQLite file, where concurrent writes from several workers wait
+for each other; set DATABASE_URL to compare on PostgreSQL.
+"""
+import argparse
+import http.client
+import importlib.util
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+os.environ.setdefault('DATABASE_URL', f'sqlite:///{os.path.join(tempfile.mkdtemp(), "bench.db")}')
+os.environ.setdefault('AUTH0_DOMAIN', 'casting.local')
+os.environ.setdefault('ALGORITHMS', 'RS256')
+os.environ.setdefault('API_AUDIENCE', 'casting')
+
+from benchmarks.bench_load import seed, run, percentiles, LoadState
+from local_auth import LocalAuth
+
+PROFILES = {
+    'sync': {'GUNICORN_WORKER_CLASS': 'sync'},
+    'gthread': {'GUNICORN_WORKER_CLASS': 'gthread'},
+    'gthread-no-preload': {'GUNICORN_WORKER_CLASS': 'gthread', 'GUNICORN_PRELOAD': 'false'},
+    'gevent': {'GUNICORN_WORKER_CLASS': 'gevent'}
+}
+
+
+def wait_until_serving(port: int, timeout: float = 30):
+    """
+    :return: Seconds until the server answered
+    """
+    start = time.perf_counter()
+    while time.perf_counter() - start < timeout:
+        connection = http.client.HTTPConnection('127.0.0.1', port, timeout=1)
+        try:
+            connection.request('GET', '/actors')
+            connection.getresponse().read()
+            return time.perf_counter() - start
+        except OSError:
+            time.sleep(0.05)
+        finally:
+            connection.close()
+
+    raise TimeoutError(f'gunicorn did not answer on port {port}')
+
+
+def memory(pid: int):
+    """
+    The proportional set size of a process and its children, in MiB, or None where /proc does not tell
+    """
+    try:
+        with open(f'/proc/{pid}/task/{pid}/children') as children_file:
+            pids = [pid] + [int(child) for child in children_file.read().split()]
+        total = 0
+        for process in pids:
+            with open(f'/proc/{process}/smaps_rollup') as smaps:
+                total += sum(int(line.split()[1]) for line in smaps if line.startswith('Pss:'))
+        return total / 1024
+    except OSError:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--profiles', default=','.join(PROFILES), help='Comma separated, of ' + ', '.join(PROFILES))
+    parser.add_argument('--workers', type=int, help="Workers per server, else gunicorn.conf.py's default")
+    parser.add_argument('--actors', type=int, default=1000)
+    parser.add_argument('--movies', type=int, default=500)
+    parser.add_argument('--cast', type=int, default=5, help='Actors per movie')
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--routes', help='Only request the routes whose name contains this text, e.g. GET')
+    parser.add_argument('--port', type=int, default=8089)
+    parser.add_argument('--seed', type=int, default=1, help='Random seed, so runs request the same things')
+    parser.add_argument('--json', help='Write the results to this file')
+    args = parser.parse_args()
+
+    local = LocalAuth(os.environ['AUTH0_DOMAIN'], os.environ['API_AUDIENCE'])
+    jwks_server, jwks_url = local.serve_jwks()
+    tokens = {role: local.mint_token(role) for role in ('CA', 'CD', 'EP')}
+    environ = {**os.environ, 'JWKS_URL': jwks_url, 'GUNICORN_BIND': f'127.0.0.1:{args.port}'}
+    if args.workers:
+        environ['WEB_CONCURRENCY'] = str(args.workers)
+
+    print(f'{args.actors} actors, {args.movies} movies, {args.cast} actors per movie, {args.requests} requests, '
+          f'{args.concurrency} concurrent')
+    print(f'{"profile":20} {"boot s":>7} {"req/s":>8} {"errors":>7} {"p50 ms":>8} {"p95 ms":>8} {"p99 ms":>8} '
+          f'{"MiB":>7}')
+    rows = []
+    for profile in args.profiles.split(','):
+        worker_class = PROFILES[profile]['GUNICORN_WORKER_CLASS']
+        if worker_class == 'gevent' and importlib.util.find_spec('gevent') is None:
+            print(f'{profile:20} skipped, gevent is not installed')
+            continue
+
+        random.seed(args.seed)
+        seed(args.actors, args.movies, args.cast)
+        server = subprocess.Popen([sys.executable, '-c', 'from gunicorn.app.wsgiapp import run; run()',
+                                   '--config', 'gunicorn.conf.py', 'app:create_app()'],
+                                  env={**environ, **PROFILES[profile]}, stdout=subprocess.DEVNULL,
+                                  stderr=subprocess.DEVNULL)
+        try:
+            boot = wait_until_serving(args.port)
+            results, elapsed = run(f'http://127.0.0.1:{args.port}', tokens, LoadState(args.actors, args.movies),
+                                   args.requests, args.concurrency, args.routes)
+            mib = memory(server.pid)
+        finally:
+            server.terminate()
+            server.wait()
+
+        latencies = [latency for route_latencies, _ in results.values() for latency in route_latencies]
+        errors = sum(count for _, route_errors in results.values() for count in route_errors.values())
+        p50, p95, p99 = percentiles(latencies)
+        row = {'profile': profile, 'boot_seconds': boot, 'throughput': len(latencies) / elapsed, 'errors': errors,
+               'p50_ms': p50, 'p95_ms': p95, 'p99_ms': p99, 'memory_mib': mib}
+        rows.append(row)
+        print(f'{profile:20} {boot:7.2f} {row["throughput"]:8.1f} {errors:7d} {p50:8.2f} {p95:8.2f} {p99:8.2f} '
+              f'{mib if mib is not None else float("nan"):7.1f}')
+
+    jwks_server.shutdown()
+
+    if args.json:
+        with open(args.json, 'w') as output:
+            json.dump({'settings': vars(args), 'profiles': rows}, output, indent=2)
+
+
+if __name__ == '__main__':
+    main()
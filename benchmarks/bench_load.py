@@ -0,0 +1,332 @@
+"""
+Load test of every route of the API, with tokens signed by a local key pair whose JWKS is served on localhost,
+so neither Auth0 nor network access is needed.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_load --actors 1000 --movies 500 --cast 5 --requests 5000 --concurrency 16
+
+By default the app runs in this process on a temporary SQLite database. Set DATABASE_URL to load test another
+database; it is dropped and seeded first. To load test a server that is already running, such as gunicorn, pass
+its --url and a fixed --jwks-port, start the server with JWKS_URL=http://127.0.0.1:<jwks-port>/.well-known/jwks.json
+and the same DATABASE_URL, AUTH0_DOMAIN and API_AUDIENCE as this script.
+
+Throughput and the p50, p95 and p99 latencies are reported per route. --json writes them to a file, to compare runs.
+"""
+import argparse
+import http.client
+import json
+import os
+import random
+import statistics
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+from urllib.parse import urlsplit
+
+os.environ.setdefault('DATABASE_URL', f'sqlite:///{os.path.join(tempfile.mkdtemp(), "bench.db")}')
+os.environ.setdefault('AUTH0_DOMAIN', 'casting.local')
+os.environ.setdefault('ALGORITHMS', 'RS256')
+os.environ.setdefault('API_AUDIENCE', 'casting')
+
+from local_auth import LocalAuth
+
+
+class Scenario:
+    """
+    One route of the API and how to build requests for it
+    """
+
+    def __init__(self, name: str, role: str, weight: int, build):
+        """
+        :param name: The method and route, as reported
+        :param role: The role whose token is sent
+        :param weight: How often the route is requested relative to the others
+        :param build: Called with the LoadState, returns (method, path, body), or None when it cannot run yet
+        """
+        self.name = name
+        self.role = role
+        self.weight = weight
+        self.build = build
+
+
+class LoadState:
+    """
+    The ids the requests can use: the seeded rows, which are never deleted, and the rows created during the run
+    """
+
+    def __init__(self, actors: int, movies: int):
+        self.actors = actors
+        self.movies = movies
+        self.created = {'actors': [], 'movies': []}
+        self._lock = threading.Lock()
+
+    def actor_id(self):
+        return random.randint(1, self.actors)
+
+    def movie_id(self):
+        return random.randint(1, self.movies)
+
+    def add_created(self, entity_type: str, ids):
+        with self._lock:
+            self.created[entity_type].extend(ids)
+
+    def pop_created(self, entity_type: str):
+        with self._lock:
+            return self.created[entity_type].pop() if self.created[entity_type] else None
+
+
+def new_actor():
+    return {'name': f'Load Actor {random.randint(0, 10 ** 6)}', 'gender': random.choice('mf'),
+            'age': random.randint(18, 90)}
+
+
+def new_movie():
+    return {'title': f'Load Movie {random.randint(0, 10 ** 6)}',
+            'release_date': datetime(2000, 1, 1).timestamp() + random.randint(0, 20 * 365) * 86400}
+
+
+def delete_created(entity_type: str):
+    def build(state):
+        entity_id = state.pop_created(entity_type)
+        return None if entity_id is None else ('DELETE', f'/{entity_type}/{entity_id}', None)
+
+    return build
+
+
+SCENARIOS = [
+    Scenario('GET /actors', 'CA', 20, lambda state: ('GET', '/actors?limit=50', None)),
+    Scenario('GET /movies', 'CA', 20, lambda state: ('GET', '/movies?limit=50', None)),
+    Scenario('GET /actors filtered', 'CA', 5,
+             lambda state: ('GET', f'/actors?gender=f&age_min={random.randint(18, 60)}&sort=-age&limit=20', None)),
+    Scenario('GET /movies filtered', 'CA', 5,
+             lambda state: ('GET', '/movies?release_after=2005-01-01&sort=-release_date&fields=id,title', None)),
+    Scenario('GET /search', 'CA', 10,
+             lambda state: ('GET', f'/search?q={random.choice(["Actor", "Movie"])}%20{random.randint(1, 99)}', None)),
+    Scenario('POST /actors', 'CD', 5, lambda state: ('POST', '/actors', new_actor())),
+    Scenario('POST /movies', 'EP', 5, lambda state: ('POST', '/movies', new_movie())),
+    Scenario('POST /actors/bulk', 'CD', 1,
+             lambda state: ('POST', '/actors/bulk', {'actors': [new_actor() for _ in range(10)]})),
+    Scenario('POST /movies/bulk', 'EP', 1,
+             lambda state: ('POST', '/movies/bulk', {'movies': [new_movie() for _ in range(10)]})),
+    Scenario('PATCH /actors/<id>', 'CD', 5,
+             lambda state: ('PATCH', f'/actors/{state.actor_id()}', {'age': random.randint(18, 90)})),
+    Scenario('PATCH /movies/<id>', 'CD', 5,
+             lambda state: ('PATCH', f'/movies/{state.movie_id()}', {'title': f'Movie {random.randint(0, 999)}'})),
+    Scenario('DELETE /actors/<id>', 'CD', 3, delete_created('actors')),
+    Scenario('DELETE /movies/<id>', 'EP', 3, delete_created('movies')),
+    Scenario('POST /actors/<id>/movies', 'CD', 3,
+             lambda state: ('POST', f'/actors/{state.actor_id()}/movies', {'movies': [state.movie_id()]})),
+    Scenario('DELETE /actors/<id>/movies', 'CD', 2,
+             lambda state: ('DELETE', f'/actors/{state.actor_id()}/movies', {'movies': [state.movie_id()]})),
+    Scenario('POST /movies/<id>/actors', 'CD', 3,
+             lambda state: ('POST', f'/movies/{state.movie_id()}/actors', {'actors': [state.actor_id()]})),
+    Scenario('DELETE /movies/<id>/actors', 'CD', 2,
+             lambda state: ('DELETE', f'/movies/{state.movie_id()}/actors', {'actors': [state.actor_id()]})),
+]
+
+
+def seed(actors: int, movies: int, cast: int):
+    """
+    Recreate the tables and add actors, movies and cast actors per movie
+    """
+    from app import create_app
+    from models import db, Actors, Movies, actors_movies
+
+    app = create_app({'database_path': os.environ['DATABASE_URL']})
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        start = datetime(2000, 1, 1)
+        db.session.execute(Actors.__table__.insert(), [
+            {'name': f'Actor {i}', 'gender': 'mf'[i % 2], 'age': 18 + i % 70} for i in range(actors)
+        ])
+        db.session.execute(Movies.__table__.insert(), [
+            {'title': f'Movie {i}', 'release_date': start + timedelta(days=i * 7)} for i in range(movies)
+        ])
+        if actors:
+            db.session.execute(actors_movies.insert(), [
+                {'movie_id': movie + 1, 'actor_id': (movie * cast + offset) % actors + 1}
+                for movie in range(movies) for offset in range(min(cast, actors))
+            ])
+        db.session.commit()
+
+    return app
+
+
+def start_app(app):
+    """
+    Serve the app from a threaded server in the background
+    :return: Its URL
+    """
+    from werkzeug.serving import make_server, WSGIRequestHandler
+
+    class QuietHandler(WSGIRequestHandler):
+        def log_request(self, *args, **kwargs):
+            pass
+
+    server = make_server('127.0.0.1', 0, app, threaded=True, request_handler=QuietHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f'http://127.0.0.1:{server.server_port}'
+
+
+def worker(url: str, tokens: dict, state: LoadState, scenarios, weights, remaining: list, lock, results: dict):
+    parts = urlsplit(url)
+    while True:
+        with lock:
+            if remaining[0] <= 0:
+                return
+            remaining[0] -= 1
+
+        request = None
+        for _ in range(100):
+            scenario = random.choices(scenarios, weights)[0]
+            request = scenario.build(state)
+            if request is not None:
+                break
+        else:
+            # Only deletes were picked, and nothing is left to delete
+            return
+        method, path, body = request
+
+        headers = {'Authorization': f'Bearer {tokens[scenario.role]}'}
+        if body is not None:
+            body = json.dumps(body)
+            headers['Content-Type'] = 'application/json'
+
+        start = time.perf_counter()
+        connection = http.client.HTTPConnection(parts.hostname, parts.port, timeout=60)
+        try:
+            connection.request(method, path, body=body, headers=headers)
+            response = connection.getresponse()
+            data = response.read()
+            status = response.status
+        except OSError:
+            data, status = b'', 0
+        finally:
+            connection.close()
+        elapsed = time.perf_counter() - start
+
+        if status == 200 and method == 'POST' and scenario.name in ('POST /actors', 'POST /movies',
+                                                                   'POST /actors/bulk', 'POST /movies/bulk'):
+            entity_type = scenario.name.split('/')[1]
+            state.add_created(entity_type, [entity['id'] for entity in json.loads(data)[entity_type]])
+
+        with lock:
+            latencies, errors = results.setdefault(scenario.name, ([], {}))
+            latencies.append(elapsed)
+            if not 200 <= status < 300:
+                errors[status] = errors.get(status, 0) + 1
+
+
+def run(url: str, tokens: dict, state: LoadState, requests: int, concurrency: int, routes: str = None):
+    """
+    Send the requests from concurrent clients
+    :param routes: Only request the routes whose name contains this text
+    :return: (latencies and errors by route, seconds)
+    """
+    scenarios = [scenario for scenario in SCENARIOS if not routes or routes in scenario.name]
+    weights = [scenario.weight for scenario in scenarios]
+    remaining = [requests]
+    lock = threading.Lock()
+    results = {}
+
+    threads = [
+        threading.Thread(target=worker, args=(url, tokens, state, scenarios, weights, remaining, lock, results))
+        for _ in range(concurrency)
+    ]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return results, time.perf_counter() - start
+
+
+def percentiles(latencies):
+    """
+    :return: p50, p95 and p99 in milliseconds
+    """
+    if len(latencies) < 2:
+        return [latencies[0] * 1e3] * 3 if latencies else [0.0] * 3
+    quantiles = statistics.quantiles(latencies, n=100, method='inclusive')
+    return [quantiles[49] * 1e3, quantiles[94] * 1e3, quantiles[98] * 1e3]
+
+
+def report(results: dict, elapsed: float):
+    rows = []
+    for name in [scenario.name for scenario in SCENARIOS] + ['total']:
+        if name == 'total':
+            latencies = [latency for latencies, _ in results.values() for latency in latencies]
+            errors = {}
+            for _, route_errors in results.values():
+                for status, count in route_errors.items():
+                    errors[status] = errors.get(status, 0) + count
+        elif name in results:
+            latencies, errors = results[name]
+        else:
+            continue
+
+        p50, p95, p99 = percentiles(latencies)
+        rows.append({
+            'route': name,
+            'requests': len(latencies),
+            'errors': errors,
+            'throughput': len(latencies) / elapsed,
+            'p50_ms': p50,
+            'p95_ms': p95,
+            'p99_ms': p99
+        })
+
+    print(f'{"route":30} {"requests":>8} {"errors":>7} {"req/s":>8} {"p50 ms":>8} {"p95 ms":>8} {"p99 ms":>8}')
+    for row in rows:
+        print(f'{row["route"]:30} {row["requests"]:8d} {sum(row["errors"].values()):7d} {row["throughput"]:8.1f} '
+              f'{row["p50_ms"]:8.2f} {row["p95_ms"]:8.2f} {row["p99_ms"]:8.2f}')
+    for row in rows:
+        if row['errors'] and row['route'] != 'total':
+            print(f'{row["route"]} errors by status: {row["errors"]}')
+
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--actors', type=int, default=1000)
+    parser.add_argument('--movies', type=int, default=500)
+    parser.add_argument('--cast', type=int, default=5, help='Actors per movie')
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--routes', help='Only request the routes whose name contains this text, e.g. GET')
+    parser.add_argument('--url', help='Load test a running server instead of one in this process')
+    parser.add_argument('--jwks-port', type=int, default=0, help='Port to serve the JWKS on, 0 for any')
+    parser.add_argument('--seed', type=int, default=1, help='Random seed, so runs request the same things')
+    parser.add_argument('--json', help='Write the results to this file')
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    local = LocalAuth(os.environ['AUTH0_DOMAIN'], os.environ['API_AUDIENCE'])
+    jwks_server, jwks_url = local.serve_jwks(port=args.jwks_port)
+    # Read by auth on first use
+    os.environ['JWKS_URL'] = jwks_url
+
+    app = seed(args.actors, args.movies, args.cast)
+    url = args.url or start_app(app)
+    tokens = {role: local.mint_token(role) for role in ('CA', 'CD', 'EP')}
+
+    print(f'{args.actors} actors, {args.movies} movies, {args.cast} actors per movie, {args.requests} requests, '
+          f'{args.concurrency} concurrent, against {url}')
+    results, elapsed = run(url, tokens, LoadState(args.actors, args.movies), args.requests, args.concurrency,
+                           args.routes)
+
+    rows = report(results, elapsed)
+    jwks_server.shutdown()
+
+    if args.json:
+        with open(args.json, 'w') as output:
+            json.dump({'settings': vars(args), 'elapsed': elapsed, 'routes': rows}, output, indent=2)
+
+
+if __name__ == '__main__':
+    main()
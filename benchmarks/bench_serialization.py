@@ -0,0 +1,124 @@
+"""
+Serialization of GET /actors and GET /movies responses for a wide cast graph, where every movie has many actors
+and every actor plays in many movies.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_serialization --movies 200 --actors 200 --cast 50
+
+The rows are loaded once from a temporary SQLite database, so only formatting and JSON encoding are timed.
+"legacy" is format() as it was before entities were formatted once per request, encoded with the standard
+json module.
+"""
+import argparse
+import os
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from flask import json
+
+DATABASE = os.path.join(tempfile.mkdtemp(), 'bench.db')
+os.environ.setdefault('DATABASE_URL', f'sqlite:///{DATABASE}')
+os.environ.setdefault('AUTH0_DOMAIN', 'casting.local')
+os.environ.setdefault('ALGORITHMS', 'RS256')
+os.environ.setdefault('API_AUDIENCE', 'casting')
+
+from sqlalchemy.orm import selectinload
+
+from app import create_app
+from models import db, Actors, Movies, actors_movies
+from serialization import dumps, orjson
+
+
+def legacy_movie(movie):
+    return {
+        'id': movie.id,
+        'title': movie.title,
+        'release_date': movie.release_date.strftime('%c'),
+        'actors': [{
+            'id': actor.id,
+            'name': actor.name,
+            'gender': 'Male' if actor.gender == 'm' else 'Female',
+            'age': actor.age
+        } for actor in movie.actors]
+    }
+
+
+def legacy_actor(actor):
+    return {
+        'id': actor.id,
+        'name': actor.name,
+        'gender': 'Male' if actor.gender == 'm' else 'Female',
+        'age': actor.age,
+        'movies': [{
+            'id': movie.id,
+            'title': movie.title,
+            'release_date': movie.release_date.strftime('%c')
+        } for movie in actor.movies]
+    }
+
+
+def seed(movies: int, actors: int, cast: int):
+    """
+    Add movies that each have cast actors, picked round-robin
+    """
+    start = datetime(2000, 1, 1)
+    db.session.execute(Movies.__table__.insert(), [
+        {'title': f'Movie {i}', 'release_date': start + timedelta(days=i % 365)} for i in range(movies)
+    ])
+    db.session.execute(Actors.__table__.insert(), [
+        {'name': f'Actor {i}', 'gender': 'mf'[i % 2], 'age': 20 + i % 60} for i in range(actors)
+    ])
+    db.session.execute(actors_movies.insert(), [
+        {'movie_id': movie + 1, 'actor_id': (movie + offset) % actors + 1}
+        for movie in range(movies) for offset in range(min(cast, actors))
+    ])
+    db.session.commit()
+
+
+def run(app, repeats: int, rows, format_legacy, key: str):
+    """
+    :return: Milliseconds per response (legacy, current)
+    """
+    start = time.perf_counter()
+    for _ in range(repeats):
+        json.dumps({key: [format_legacy(row) for row in rows], 'next': None})
+    legacy = (time.perf_counter() - start) / repeats * 1e3
+
+    start = time.perf_counter()
+    for _ in range(repeats):
+        # A new request each time, so no fragments are carried over
+        with app.test_request_context():
+            dumps({key: [row.format() for row in rows], 'next': None})
+    current = (time.perf_counter() - start) / repeats * 1e3
+
+    return legacy, current
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--movies', type=int, default=200)
+    parser.add_argument('--actors', type=int, default=200)
+    parser.add_argument('--cast', type=int, default=50, help='Actors per movie')
+    parser.add_argument('--repeats', type=int, default=20)
+    args = parser.parse_args()
+
+    app = create_app({'database_path': os.environ['DATABASE_URL']})
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        seed(args.movies, args.actors, args.cast)
+
+        movies = Movies.query.options(selectinload(Movies.actors)).order_by(Movies.id).all()
+        actors = Actors.query.options(selectinload(Actors.movies).lazyload(Movies.actors)).order_by(Actors.id).all()
+
+        print(f'{args.movies} movies, {args.actors} actors, {args.cast} actors per movie, '
+              f'JSON encoder: {"orjson" if orjson is not None else "json"}')
+        for key, rows, format_legacy in [('movies', movies, legacy_movie), ('actors', actors, legacy_actor)]:
+            legacy, current = run(app, args.repeats, rows, format_legacy, key)
+            print(f'GET /{key:6}  legacy: {legacy:8.2f} ms  current: {current:8.2f} ms  ({legacy / current:.1f}x)')
+
+
+if __name__ == '__main__':
+    main()
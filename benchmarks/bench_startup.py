@@ -0,0 +1,96 @@
+"""
+Worker startup: how long importing the app and create_app() take, and how long the first request waits, with and
+without warming up.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_startup --runs 5
+
+Each run is a new Python process, so nothing is cached between them. The signing keys are served by a local JWKS
+server with --jwks-delay milliseconds of latency, standing in for Auth0, and the data is a temporary SQLite
+database. Median milliseconds are reported.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+os.environ.setdefault('AUTH0_DOMAIN', 'casting.local')
+os.environ.setdefault('ALGORITHMS', 'RS256')
+os.environ.setdefault('API_AUDIENCE', 'casting')
+
+from local_auth import LocalAuth
+
+STEPS = ('import', 'create_app', 'first_request')
+
+
+def child(warm_up: bool, token: str):
+    """
+    Start the app in this process and time each step
+    :return: Milliseconds by step
+    """
+    start = time.perf_counter()
+    from app import create_app
+    imported = time.perf_counter()
+    app = create_app({'database_path': os.environ['DATABASE_URL'], 'warm_up': warm_up})
+    created = time.perf_counter()
+    response = app.test_client().get('/actors', headers={'Authorization': f'Bearer {token}'})
+    answered = time.perf_counter()
+    assert response.status_code == 200, response.get_data(as_text=True)
+
+    return {
+        'import': (imported - start) * 1e3,
+        'create_app': (created - imported) * 1e3,
+        'first_request': (answered - created) * 1e3
+    }
+
+
+def run(warm_up: bool, token: str):
+    output = subprocess.run(
+        [sys.executable, '-m', 'benchmarks.bench_startup', '--child', '--token', token] + (['--warm-up'] * warm_up),
+        check=True, capture_output=True, text=True
+    ).stdout
+
+    return json.loads(output.splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--jwks-delay', type=float, default=100, help='Latency of the JWKS server in milliseconds')
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--warm-up', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--token', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(child(args.warm_up, args.token)))
+        return
+
+    database = os.path.join(tempfile.mkdtemp(), 'startup.db')
+    os.environ.setdefault('DATABASE_URL', f'sqlite:///{database}')
+    local = LocalAuth(os.environ['AUTH0_DOMAIN'], os.environ['API_AUDIENCE'])
+    jwks_server, os.environ['JWKS_URL'] = local.serve_jwks(delay=args.jwks_delay / 1e3)
+
+    from app import create_app
+    app = create_app({'database_path': os.environ['DATABASE_URL']})
+    with app.app_context():
+        app.db.create_all()
+
+    token = local.mint_token('CA')
+    print(f'{args.runs} runs, JWKS latency {args.jwks_delay:g} ms, median ms')
+    print(f'{"":10}' + ''.join(f'{step:>15}' for step in STEPS))
+    for warm_up in (False, True):
+        timings = [run(warm_up, token) for _ in range(args.runs)]
+        medians = [statistics.median(timing[step] for timing in timings) for step in STEPS]
+        print(f'{"warm" if warm_up else "cold":10}' + ''.join(f'{median:15.1f}' for median in medians))
+
+    jwks_server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
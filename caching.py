@@ -0,0 +1,314 @@
+"""
+HTTP caching for the read endpoints: conditional requests, and an optional cache of whole responses
+"""
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from functools import wraps
+
+from flask import request, make_response, Response, current_app, g, has_app_context
+from sqlalchemy.exc import SQLAlchemyError
+
+from instrumentation import log_exception
+from models import db, get_table_versions, VERSIONED_TABLES, table_change_listeners
+from serialization import response_mimetype, vary_on_format
+
+RESPONSE_CACHE_SIZE = int(os.environ.get('RESPONSE_CACHE_SIZE', 512))
+# Upper bound on how long an entry is kept, should an invalidation ever be lost
+RESPONSE_CACHE_TTL = int(os.environ.get('RESPONSE_CACHE_TTL', 300))
+RESPONSE_CACHE_PREFIX = 'casting:'
+
+# Response headers that are stored with a cached body
+CACHED_HEADERS = ('Content-Type', 'ETag', 'Last-Modified', 'Cache-Control', 'Vary')
+
+
+def request_table_versions():
+    """
+    The table versions, read at most once per request
+    :return:
+    """
+    if 'table_versions' not in g:
+        g.table_versions = get_table_versions()
+    return g.table_versions
+
+
+def collection_validators(mimetype: str = None):
+    """
+    Compute the ETag and Last-Modified time of a collection response from the table versions, without
+    running the collection query. The ETag also depends on the query string and the response format, so that
+    each page, field selection and format has its own.
+    :param mimetype: The format of the body. The one the client asked for if not given.
+    :return: (etag, last_modified)
+    """
+    versions = request_table_versions()
+    tag = '.'.join(str(versions[name][0]) for name in VERSIONED_TABLES)
+    digest = hashlib.sha1(request.query_string + (mimetype or response_mimetype()).encode()).hexdigest()[:12]
+    last_modified = max(versions[name][1] for name in VERSIONED_TABLES)
+
+    return f'{tag}-{digest}', last_modified
+
+
+def is_not_modified(etag, last_modified):
+    """
+    Evaluate If-None-Match, or If-Modified-Since when there is no If-None-Match
+    :param etag:
+    :param last_modified:
+    :return:
+    """
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag)
+
+    if_modified_since = request.if_modified_since
+    if if_modified_since is not None and last_modified is not None:
+        if if_modified_since.tzinfo is None:
+            if_modified_since = if_modified_since.replace(tzinfo=timezone.utc)
+        return last_modified.replace(microsecond=0) <= if_modified_since
+
+    return False
+
+
+def not_modified_response(etag, last_modified):
+    response = Response(status=304)
+    set_validators(response, etag, last_modified)
+    # The same Vary as the response it stands for, so that shared caches validate each format separately
+    return vary_on_format(response)
+
+
+def set_validators(response, etag, last_modified):
+    response.set_etag(etag, weak=True)
+    # HTTP dates only have whole seconds. A time in the current second could be followed by another
+    # change in the same second that clients would never see, so it is left out until it has passed.
+    if last_modified is not None and datetime.now(timezone.utc) - last_modified >= timedelta(seconds=1):
+        response.last_modified = last_modified
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+
+
+def conditional(f):
+    """
+    Answer conditional GETs of a collection endpoint with 304 Not Modified when none of the versioned
+    tables changed, before the view runs its query or serializes anything
+    """
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        try:
+            etag, last_modified = collection_validators()
+        except SQLAlchemyError:
+            # e.g. table_versions has not been migrated yet
+            log_exception('Could not read the table versions')
+            db.session.rollback()
+            return f(*args, **kwargs)
+
+        if is_not_modified(etag, last_modified):
+            return not_modified_response(etag, last_modified)
+
+        response = make_response(f(*args, **kwargs))
+        if response.status_code == 200:
+            if response.mimetype != response_mimetype():
+                # Streamed collections are JSON whatever the client asked for
+                etag, last_modified = collection_validators(response.mimetype)
+            set_validators(response, etag, last_modified)
+
+        return response
+
+    return wrapper
+
+
+class LRUBackend:
+    """
+    In-process LRU of responses.
+
+    Entries are keyed by the table versions in the database, so a write made by any worker is seen
+    by the next read here, at the cost of one primary key lookup per read.
+    """
+
+    # Entries are keyed by the versions read along with the data, so they can be filled from a replica
+    versioned = True
+
+    def __init__(self, maxsize=RESPONSE_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def generations(self, tables):
+        versions = request_table_versions()
+        return [versions[table][0] for table in tables]
+
+    def invalidate(self, tables):
+        # Writes already changed the table versions the keys are made of
+        pass
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+
+class SharedBackend:
+    """
+    Responses in a store shared by every worker, such as Redis.
+
+    Entries are keyed by generation counters kept in the same store, and writes increment the counters of
+    the tables they change, so reads do not touch the database at all.
+    :param client: Any object with the get, set(ex=), mget and incr methods of a redis.Redis client
+    """
+
+    versioned = False
+
+    def __init__(self, client):
+        self.client = client
+
+    @classmethod
+    def from_url(cls, url):
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError('The redis package is needed for a shared response cache: pip install redis')
+
+        return cls(redis.Redis.from_url(url))
+
+    @staticmethod
+    def generation_key(table):
+        return f'{RESPONSE_CACHE_PREFIX}generation:{table}'
+
+    def generations(self, tables):
+        return [int(generation or 0) for generation in self.client.mget([self.generation_key(t) for t in tables])]
+
+    def invalidate(self, tables):
+        for table in sorted(tables):
+            self.client.incr(self.generation_key(table))
+
+    def get(self, key):
+        return self.client.get(key)
+
+    def set(self, key, value, ttl):
+        self.client.set(key, value, ex=ttl)
+
+
+class ResponseCache:
+    """
+    Cache of whole responses of the read endpoints, keyed by endpoint, query string and the generations
+    of the tables the responses are built from
+    """
+
+    def __init__(self, backend, ttl=RESPONSE_CACHE_TTL, tables=VERSIONED_TABLES):
+        self.backend = backend
+        self.ttl = ttl
+        self.tables = tables
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, mimetype: str = None):
+        """
+        :param mimetype: The format of the body. The one the client asked for if not given.
+        :return:
+        """
+        generations = '.'.join(str(generation) for generation in self.backend.generations(self.tables))
+        digest = hashlib.sha1(request.query_string + (mimetype or response_mimetype()).encode()).hexdigest()
+        return f'{RESPONSE_CACHE_PREFIX}response:{request.endpoint}:{generations}:{digest}'
+
+    def get(self, key):
+        value = self.backend.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        meta, body = value.split(b'\n', 1)
+        meta = json.loads(meta)
+        return vary_on_format(Response(body, status=meta['status'], headers=meta['headers']))
+
+    def set(self, key, response):
+        meta = {
+            'status': response.status_code,
+            'headers': [(name, response.headers[name]) for name in CACHED_HEADERS if name in response.headers]
+        }
+        self.backend.set(key, json.dumps(meta).encode() + b'\n' + response.get_data(), self.ttl)
+
+    def invalidate(self, tables):
+        self.backend.invalidate(tables)
+
+
+def create_response_cache(setting):
+    """
+    :param setting: 'memory' for an in-process cache, a redis:// URL for a shared cache, a backend object,
+    or None to turn caching off
+    :return: A ResponseCache, or None
+    """
+    if not setting:
+        return None
+    if setting == 'memory':
+        return ResponseCache(LRUBackend())
+    if isinstance(setting, str):
+        return ResponseCache(SharedBackend.from_url(setting))
+
+    return ResponseCache(setting)
+
+
+def invalidate_response_cache(tables):
+    cache = getattr(current_app, 'response_cache', None) if has_app_context() else None
+    if cache is None:
+        return
+
+    try:
+        cache.invalidate(tables)
+    except Exception:
+        log_exception('Could not invalidate the response cache')
+
+
+table_change_listeners.append(invalidate_response_cache)
+
+
+def cached(f):
+    """
+    Serve a read endpoint from the app's response cache, if it has one.
+    Conditional requests are answered from the cached ETag.
+    """
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        cache = current_app.response_cache
+        if cache is None:
+            return f(*args, **kwargs)
+
+        try:
+            key = cache.key()
+            response = cache.get(key)
+        except Exception:
+            # The cache is an optimization: when it is unavailable, the database answers
+            log_exception('Response cache unavailable')
+            db.session.rollback()
+            return f(*args, **kwargs)
+
+        if response is not None:
+            etag, _ = response.get_etag()
+            if etag is not None and is_not_modified(etag, response.last_modified):
+                return not_modified_response(etag, response.last_modified)
+            return response
+
+        if not cache.backend.versioned:
+            # A lagging replica could put old data under the new generations, so misses are read from the primary
+            g.db_read_only = False
+
+        response = make_response(f(*args, **kwargs))
+        # Only under the key of the format it is in, which a streamed collection may not be
+        if response.status_code == 200 and not response.is_streamed and response.mimetype == response_mimetype():
+            try:
+                cache.set(key, response)
+            except Exception:
+                log_exception('Could not store the response in the cache')
+
+        return response
+
+    return wrapper
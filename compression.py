@@ -0,0 +1,131 @@
+"""
+gzip and brotli compression of the responses, negotiated with the client's Accept-Encoding header.
+brotli is used when the client accepts it and `brotli` is installed.
+"""
+import os
+import zlib
+
+from flask import request
+
+from instrumentation import timed
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Smaller bodies are sent as they are: they fit in a packet or two, and compressing them costs more than it saves
+COMPRESS_MIN_SIZE = int(os.environ.get('COMPRESS_MIN_SIZE', 1024))
+# 1 to 9. Higher levels make responses only a little smaller for much more time.
+GZIP_LEVEL = int(os.environ.get('GZIP_LEVEL', 6))
+# 0 to 11. Levels above 5 are meant for static files that are compressed once.
+BROTLI_QUALITY = int(os.environ.get('BROTLI_QUALITY', 4))
+
+COMPRESSIBLE_MIMETYPES = {'application/json', 'application/msgpack', 'text/html', 'text/plain'}
+# wbits for a gzip header and trailer around the deflate stream
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+
+def encodings():
+    """
+    The content codings that can be produced, preferred first
+    """
+    return ('br', 'gzip') if brotli is not None else ('gzip',)
+
+
+def compress(body: bytes, coding: str, gzip_level: int = GZIP_LEVEL, brotli_quality: int = BROTLI_QUALITY):
+    """
+    :param body:
+    :param coding: 'br' or 'gzip'
+    :param gzip_level:
+    :param brotli_quality:
+    :return: The compressed body
+    """
+    if coding == 'br':
+        return brotli.compress(body, quality=brotli_quality)
+
+    compressor = zlib.compressobj(gzip_level, zlib.DEFLATED, GZIP_WBITS)
+    return compressor.compress(body) + compressor.flush()
+
+
+def compress_stream(chunks, coding: str, gzip_level: int = GZIP_LEVEL, brotli_quality: int = BROTLI_QUALITY):
+    """
+    Compress a streamed body chunk by chunk. Each chunk is flushed, so that the client can decode what has
+    been sent so far.
+    :param chunks: The encoded chunks of the body
+    :param coding: 'br' or 'gzip'
+    :param gzip_level:
+    :param brotli_quality:
+    :return: The compressed chunks
+    """
+    if coding == 'br':
+        compressor = brotli.Compressor(quality=brotli_quality)
+        for chunk in chunks:
+            data = compressor.process(chunk) + compressor.flush()
+            if data:
+                yield data
+        yield compressor.finish()
+        return
+
+    compressor = zlib.compressobj(gzip_level, zlib.DEFLATED, GZIP_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def compress_response(response, min_size: int = COMPRESS_MIN_SIZE):
+    """
+    Compress a response in the best coding that the client accepts, if it is large enough to be worth it
+    :param response:
+    :param min_size: Bodies smaller than this many bytes are left as they are. Streamed bodies are always
+    compressed, since their size is not known.
+    :return: The response
+    """
+    if response.status_code == 304:
+        # The same Vary as the response it stands for
+        response.vary.add('Accept-Encoding')
+    if response.status_code < 200 or response.status_code in (204, 206, 304) or request.method == 'HEAD' \
+            or response.direct_passthrough or 'Content-Encoding' in response.headers \
+            or response.mimetype not in COMPRESSIBLE_MIMETYPES:
+        return response
+
+    # The response depends on Accept-Encoding even when it is sent as it is
+    response.vary.add('Accept-Encoding')
+    coding = request.accept_encodings.best_match(encodings())
+    if coding is None:
+        return response
+
+    if response.is_streamed:
+        original = response.response
+        response.response = compress_stream(response.iter_encoded(), coding)
+        if hasattr(original, 'close'):
+            response.call_on_close(original.close)
+        response.headers.pop('Content-Length', None)
+    else:
+        body = response.get_data()
+        if len(body) < min_size:
+            return response
+        with timed('serialization'):
+            response.set_data(compress(body, coding))
+
+    response.headers['Content-Encoding'] = coding
+    if response.headers.get('ETag', '').startswith('"'):
+        # The compressed bytes differ from the uncompressed ones that a strong ETag would promise
+        etag, _ = response.get_etag()
+        response.set_etag(etag, weak=True)
+
+    return response
+
+
+def setup_compression(app, min_size: int = COMPRESS_MIN_SIZE):
+    """
+    Compress the responses of the app. Call it after setup_metrics(), so that the timings include the compression.
+    :param app:
+    :param min_size: See compress_response()
+    :return:
+    """
+    @app.after_request
+    def compress_after_request(response):
+        return compress_response(response, min_size)
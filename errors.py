@@ -1,4 +1,4 @@
-from werkzeug.exceptions import BadRequest, Unauthorized, NotFound
+from werkzeug.exceptions import BadRequest, Unauthorized, NotFound, ServiceUnavailable, UnprocessableEntity, Conflict
 
 
 class TokenExpired(BadRequest):
@@ -21,6 +21,33 @@ class AuthHeaderInvalid(BadRequest):
     description = 'Authorization header must start with "Bearer".'
 
 
+class JWKSUnavailable(ServiceUnavailable):
+    message = 'jwks_unavailable'
+    description = 'The signing keys for the auth token could not be fetched.'
+
+
+class SearchTimeout(ServiceUnavailable):
+    message = 'search_timeout'
+    description = 'The search took too long. Try a longer query.'
+
+
+class IdempotencyKeyReused(UnprocessableEntity):
+    message = 'idempotency_key_reused'
+    description = 'The Idempotency-Key was already used for a different request.'
+
+
+class IdempotentRequestUnknown(Conflict):
+    message = 'idempotency_outcome_unknown'
+    description = 'A request with this Idempotency-Key was processed, but its response was not saved.'
+
+
+class IdempotentRequestInProgress(Conflict):
+    message = 'idempotency_request_in_progress'
+    description = 'A request with this Idempotency-Key is still being processed. Retry it shortly.'
+    # Seconds, sent in the Retry-After header
+    retry_after = 1
+
+
 class DrinkNotFound(NotFound):
     message = 'not_found'
     description = 'Drink not found'
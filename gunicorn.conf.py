@@ -0,0 +1,128 @@
+"""
+Gunicorn settings. gunicorn reads this file by itself when started from the repository root:
+
+    gunicorn "app:create_app()"
+
+Each setting can be overridden by the env variables below, and by gunicorn's own command line options.
+"""
+import logging
+import multiprocessing
+import os
+import shutil
+import tempfile
+
+CPUS = multiprocessing.cpu_count()
+
+# gthread, gevent, or sync. gevent needs `pip install gevent psycogreen`.
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'gthread')
+
+if worker_class == 'gevent':
+    # Before the app is imported, so that its locks and sockets are cooperative in the preloading master too
+    from gevent import monkey
+    monkey.patch_all()
+    try:
+        from psycogreen.gevent import patch_psycopg
+        patch_psycopg()
+    except ImportError:
+        logging.getLogger('gunicorn.error').warning('psycogreen is not installed, so every query blocks its worker')
+
+# Heroku sets WEB_CONCURRENCY for the size of the dyno. Sync workers serve one request at a time, so more of them
+# are needed to keep the CPUs busy.
+workers = int(os.environ.get('WEB_CONCURRENCY', CPUS * 2 + 1 if worker_class == 'sync' else CPUS + 1))
+# Requests each gthread worker serves at once. Keep it within the database pool size plus overflow.
+threads = int(os.environ.get('GUNICORN_THREADS', 4)) if worker_class == 'gthread' else 1
+# Connections each gevent worker serves at once
+worker_connections = int(os.environ.get('GUNICORN_WORKER_CONNECTIONS', 1000))
+
+bind = os.environ.get('GUNICORN_BIND', f'0.0.0.0:{os.environ.get("PORT", 8080)}')
+# Seconds to hold an idle connection open for the client's next request
+keepalive = int(os.environ.get('GUNICORN_KEEPALIVE', 5))
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 30))
+graceful_timeout = int(os.environ.get('GUNICORN_GRACEFUL_TIMEOUT', 30))
+
+# Import the app once in the master and fork the workers from it, which starts them faster and shares the memory
+# of the imported code. With WARM_UP=1 the signing keys are fetched once for all the workers, and each worker opens
+# its own database connections once it is forked.
+preload_app = os.environ.get('GUNICORN_PRELOAD', 'true').lower() in ('1', 'true', 'yes')
+
+# Replace each worker after this many requests, plus up to the jitter so that they are not all replaced at once, to
+# contain memory growth. 0 turns it off.
+max_requests = int(os.environ.get('GUNICORN_MAX_REQUESTS', 1000))
+max_requests_jitter = int(os.environ.get('GUNICORN_MAX_REQUESTS_JITTER', max_requests // 10))
+
+# The heartbeat files of the workers, on a memory file system where there is one, so that a slow disk does not get
+# workers killed
+if os.path.isdir('/dev/shm'):
+    worker_tmp_dir = '/dev/shm'
+
+# Where the workers share their metrics, so that /metrics adds up those of all of them rather than reporting the one
+# worker that serves it. Set before the app is imported, since instrumentation reads it then. An empty METRICS_DIR
+# keeps the metrics per worker.
+default_metrics_dir = 'METRICS_DIR' not in os.environ
+os.environ.setdefault('METRICS_DIR', os.path.join(
+    '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir(), f'casting-metrics-{os.getpid()}'
+))
+
+
+def flask_app(app):
+    # asgi.ASGIApp wraps it
+    return getattr(app, 'app', app)
+
+
+def loaded_app(server):
+    """
+    The Flask app loaded by the master when it is preloaded, else None
+    """
+    return flask_app(getattr(server.app, 'callable', None))
+
+
+def on_starting(server):
+    # The counters of a previous run would add to those of this one
+    from instrumentation import clear_metrics_dir
+    clear_metrics_dir()
+
+
+def on_exit(server):
+    from instrumentation import clear_metrics_dir, METRICS_DIR
+    if default_metrics_dir:
+        shutil.rmtree(METRICS_DIR, ignore_errors=True)
+    else:
+        clear_metrics_dir()
+
+
+def when_ready(server):
+    # The master does not serve requests, so it closes the connections that warming up opened
+    app = loaded_app(server)
+    if app is not None:
+        from models import dispose_engines
+        dispose_engines(app)
+
+
+def post_fork(server, worker):
+    # Connections inherited from the master would be shared by all the workers
+    app = loaded_app(server)
+    if app is not None:
+        from models import dispose_engines
+        dispose_engines(app)
+
+
+def post_worker_init(worker):
+    # The master closed the connections that warming up opened, so the worker opens its own before its first request
+    app = flask_app(getattr(worker, 'wsgi', None))
+    if worker.cfg.preload_app and getattr(app, 'config', {}).get('WARM_UP'):
+        from app import warm_up_connections
+        warm_up_connections(app)
+
+
+def worker_exit(server, worker):
+    # Save the requests served since the last write, before the master archives the worker's counters
+    app = flask_app(getattr(worker, 'wsgi', None))
+    metrics = getattr(app, 'extensions', {}).get('metrics')
+    if metrics is not None and metrics.directory is not None:
+        metrics.write_snapshot()
+
+
+def child_exit(server, worker):
+    # The counters of the worker keep counting towards the totals on /metrics. Its gauges are dropped.
+    from instrumentation import mark_process_dead
+    mark_process_dead(worker.pid)
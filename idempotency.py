@@ -0,0 +1,254 @@
+"""
+Idempotency-Key support for the create endpoints, so that retried requests do not create duplicates
+"""
+import hashlib
+import os
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from functools import wraps
+
+from flask import request, g, make_response, current_app, has_request_context
+from sqlalchemy import event, select, func, and_
+from werkzeug.exceptions import UnprocessableEntity
+
+from auth import get_verified_token
+from instrumentation import log_exception
+from errors import IdempotencyKeyReused, IdempotentRequestUnknown, IdempotentRequestInProgress
+from models import db, idempotency_keys
+from serialization import api_response, dumps, loads, response_mimetype, vary_on_format, JSON_MIMETYPE, \
+    MSGPACK_MIMETYPE
+
+IDEMPOTENCY_HEADER = 'Idempotency-Key'
+# Seconds a response is kept for retries
+IDEMPOTENCY_KEY_TTL = int(os.environ.get('IDEMPOTENCY_KEY_TTL', 24 * 60 * 60))
+# Seconds between deletions of expired keys by each worker
+IDEMPOTENCY_PURGE_INTERVAL = int(os.environ.get('IDEMPOTENCY_PURGE_INTERVAL', 60 * 60))
+# Seconds a duplicate waits for the response of a request that has created its entities but not stored its response
+# yet. On PostgreSQL the lock on the key is released in between. It is answered with 409 and Retry-After after that.
+IDEMPOTENCY_RESPONSE_WAIT = float(os.environ.get('IDEMPOTENCY_RESPONSE_WAIT', 5))
+# Seconds after which a key recorded without a response is taken to have lost it, e.g. to a worker killed in between
+IDEMPOTENCY_PENDING_TIMEOUT = float(os.environ.get('IDEMPOTENCY_PENDING_TIMEOUT', 30))
+# Seconds between reads of the key while waiting
+IDEMPOTENCY_POLL_INTERVAL = 0.05
+MAX_IDEMPOTENCY_KEY_LENGTH = 255
+
+# Serialize requests with the same key within a process, when the database has no advisory locks
+_local_locks = [threading.Lock() for _ in range(64)]
+_last_purge = 0
+_purge_lock = threading.Lock()
+
+
+class Claim:
+    """
+    A request with an Idempotency-Key that is being processed
+    """
+
+    def __init__(self, key: str, owner: str, fingerprint: str):
+        self.key = key
+        self.owner = owner
+        self.fingerprint = fingerprint
+        self.recorded = False
+
+    @property
+    def lock_id(self):
+        digest = hashlib.sha256(f'{self.owner}\n{self.key}'.encode()).digest()
+        return int.from_bytes(digest[:8], 'big', signed=True)
+
+    @property
+    def condition(self):
+        return and_(idempotency_keys.c.key == self.key, idempotency_keys.c.owner == self.owner)
+
+
+def request_fingerprint():
+    """
+    A hash of what the request asks for, to tell retries from other requests that reuse a key
+    :return:
+    """
+    digest = hashlib.sha256()
+    for part in (request.method.encode(), request.path.encode(), request.get_data()):
+        digest.update(part)
+        digest.update(b'\n')
+    return digest.hexdigest()
+
+
+def lock_key_in_transaction(claim: Claim):
+    """
+    Take a PostgreSQL advisory lock on the key on the session's own connection. It is released when the session's
+    transaction ends, so no second connection is held while the request is processed.
+    :param claim:
+    :return:
+    """
+    if db.engine.dialect.name == 'postgresql':
+        db.session.execute(select([func.pg_advisory_xact_lock(claim.lock_id)]))
+
+
+@contextmanager
+def key_lock(claim: Claim):
+    """
+    Hold a lock on the key while the request is processed, so that a concurrent duplicate waits and then
+    replays the response. On PostgreSQL, the advisory lock serializes duplicates across workers until the
+    transaction that records the claim commits. A duplicate that gets the lock before the response is stored
+    reads the key again until it is, in idempotent().
+    """
+    if db.engine.dialect.name == 'postgresql':
+        lock_key_in_transaction(claim)
+        yield
+        return
+
+    with _local_locks[claim.lock_id % len(_local_locks)]:
+        yield
+
+
+def purge_expired_keys(now: datetime):
+    """
+    Delete expired keys, at most once per IDEMPOTENCY_PURGE_INTERVAL
+    :param now:
+    :return:
+    """
+    global _last_purge
+    with _purge_lock:
+        if time.monotonic() - _last_purge < IDEMPOTENCY_PURGE_INTERVAL:
+            return
+        _last_purge = time.monotonic()
+
+    db.session.execute(idempotency_keys.delete().where(idempotency_keys.c.expires_at < now))
+
+
+@event.listens_for(db.session, 'before_commit')
+def record_claim(session):
+    """
+    Record the key in the same transaction as the entities the request creates. Should the response be lost
+    afterwards, retries are refused instead of creating the entities again.
+    """
+    claim = g.get('idempotency_claim') if has_request_context() else None
+    if claim is None or claim.recorded:
+        return
+
+    claim.recorded = True
+    session.execute(idempotency_keys.insert().values(
+        key=claim.key,
+        owner=claim.owner,
+        fingerprint=claim.fingerprint,
+        expires_at=datetime.now(timezone.utc) + timedelta(seconds=IDEMPOTENCY_KEY_TTL)
+    ))
+
+
+def response_pending(row):
+    """
+    Whether the request that recorded a key without a response may still store it: it was recorded less than
+    IDEMPOTENCY_PENDING_TIMEOUT seconds ago
+    :param row:
+    :return:
+    """
+    expires_at = row.expires_at
+    if expires_at.tzinfo is None:
+        # SQLite drops the time zone of the UTC times that record_claim() stores
+        expires_at = expires_at.replace(tzinfo=timezone.utc)
+    recorded_at = expires_at - timedelta(seconds=IDEMPOTENCY_KEY_TTL)
+
+    return datetime.now(timezone.utc) - recorded_at < timedelta(seconds=IDEMPOTENCY_PENDING_TIMEOUT)
+
+
+def find_key(claim: Claim, now: datetime):
+    """
+    :return: The row of the key, unless it has expired
+    """
+    return db.session.execute(
+        select([idempotency_keys]).where(claim.condition).where(idempotency_keys.c.expires_at >= now)
+    ).first()
+
+
+def replay(row):
+    """
+    Answer a retry from the stored response
+    :param row:
+    :return:
+    """
+    if row.fingerprint != request_fingerprint():
+        raise IdempotencyKeyReused
+    if row.body is None:
+        raise IdempotentRequestInProgress if response_pending(row) else IdempotentRequestUnknown
+
+    if response_mimetype() == JSON_MIMETYPE:
+        response = vary_on_format(current_app.response_class(row.body, status=row.status, mimetype=JSON_MIMETYPE))
+    else:
+        response = api_response(loads(row.body), row.status)
+    response.headers['Idempotent-Replayed'] = 'true'
+    return response
+
+
+def idempotent(f):
+    """
+    Let clients retry a create request safely by sending an Idempotency-Key header.
+    The first request with a key runs and its successful response is stored. Later requests with the same
+    key and body get the stored response without running the view again.
+    Keys are scoped to the token's subject and kept for IDEMPOTENCY_KEY_TTL seconds.
+    """
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        key = request.headers.get(IDEMPOTENCY_HEADER)
+        if key is None:
+            return f(*args, **kwargs)
+
+        if not key or len(key) > MAX_IDEMPOTENCY_KEY_LENGTH:
+            raise UnprocessableEntity(
+                description=f'{IDEMPOTENCY_HEADER} must be between 1 and {MAX_IDEMPOTENCY_KEY_LENGTH} characters'
+            )
+
+        claim = Claim(key, str(get_verified_token().payload.get('sub', '')), request_fingerprint())
+        deadline = time.monotonic() + IDEMPOTENCY_RESPONSE_WAIT
+        while True:
+            with key_lock(claim):
+                now = datetime.now(timezone.utc)
+                row = find_key(claim, now)
+                if row is None:
+                    return run_claimed(claim, now, f, *args, **kwargs)
+                db.session.rollback()
+
+            # The request with the key has created its entities and is about to store its response
+            if row.body is not None or row.fingerprint != claim.fingerprint or not response_pending(row) \
+                    or time.monotonic() >= deadline:
+                return replay(row)
+            time.sleep(IDEMPOTENCY_POLL_INTERVAL)
+
+    return wrapper
+
+
+def run_claimed(claim: Claim, now: datetime, f, *args, **kwargs):
+    """
+    Run the view for the first request with a key, under the lock on the key, and store its response
+    :param claim:
+    :param now:
+    :param f: The view
+    :return: The response
+    """
+    try:
+        # An expired key can be used again. Deleted in the transaction that records the claim, since
+        # committing here would release the lock.
+        with db.session.begin_nested():
+            db.session.execute(idempotency_keys.delete().where(claim.condition))
+            purge_expired_keys(now)
+    except Exception:
+        log_exception('Could not delete expired idempotency keys')
+
+    g.idempotency_claim = claim
+    try:
+        response = make_response(f(*args, **kwargs))
+    finally:
+        g.pop('idempotency_claim', None)
+
+    if claim.recorded and 200 <= response.status_code < 300:
+        # Stored as JSON, so that a retry can be answered in the format that it asks for
+        body = response.get_data()
+        if response.mimetype == MSGPACK_MIMETYPE:
+            body = dumps(loads(body, MSGPACK_MIMETYPE))
+        lock_key_in_transaction(claim)
+        db.session.execute(
+            idempotency_keys.update().where(claim.condition)
+            .values(status=response.status_code, body=body.decode())
+        )
+        db.session.commit()
+
+    return response
@@ -0,0 +1,434 @@
+"""
+Opt-in timing of requests, split into auth, database, serialization and total time, with query counts.
+The measurements are exported in the Prometheus text format on /metrics and sent back in a Server-Timing header.
+With METRICS_DIR set, the worker processes share their metrics through files in that directory, so that /metrics
+reports those of all the workers whichever one serves it.
+"""
+import bisect
+import glob
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import g, request, has_request_context, Response
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+logger = logging.getLogger('casting')
+
+# Statements that take at least this many milliseconds are counted and logged as slow
+SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS', 100))
+# Upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+PHASES = ('auth', 'db', 'serialization', 'total')
+METRICS_PREFIX = 'casting'
+# A directory where each worker process writes its metrics, for /metrics to add them up. Unset, each process
+# reports its own.
+METRICS_DIR = os.environ.get('METRICS_DIR') or None
+# Seconds between writes of a worker's metrics to METRICS_DIR, while it serves requests
+METRICS_WRITE_INTERVAL = float(os.environ.get('METRICS_WRITE_INTERVAL', 1))
+# The counters of the workers that have exited, in METRICS_DIR
+METRICS_ARCHIVE = 'archive.json'
+
+_listening = False
+_listen_lock = threading.Lock()
+
+
+class RequestTiming:
+    """
+    What the current request has spent its time on so far
+    """
+    __slots__ = ('start', 'phases', 'queries', 'slow_queries', 'slow_query_ms')
+
+    def __init__(self, slow_query_ms: float = SLOW_QUERY_MS):
+        self.start = time.perf_counter()
+        self.slow_query_ms = slow_query_ms
+        self.phases = dict.fromkeys(PHASES, 0.0)
+        self.queries = 0
+        self.slow_queries = 0
+
+    def server_timing(self):
+        """
+        :return: The value of the Server-Timing header, with durations in milliseconds
+        """
+        metrics = []
+        for phase in PHASES:
+            metric = f'{phase};dur={self.phases[phase] * 1e3:.2f}'
+            if phase == 'db':
+                metric += f';desc="{self.queries} queries ({self.slow_queries} slow)"'
+            metrics.append(metric)
+
+        return ', '.join(metrics)
+
+
+def request_timing():
+    """
+    :return: The RequestTiming of the current request, or None when requests are not timed
+    """
+    return g.get('request_timing') if has_request_context() else None
+
+
+@contextmanager
+def timed(phase: str):
+    """
+    Add the time spent in the block to a phase of the current request
+    :param phase: One of PHASES
+    """
+    timing = request_timing()
+    if timing is None:
+        yield
+        return
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timing.phases[phase] += time.perf_counter() - start
+
+
+def log_exception(message: str = 'Request failed'):
+    """
+    Log the exception being handled, along with the request it happened in
+    :param message:
+    :return:
+    """
+    if has_request_context():
+        logger.exception('%s: %s %s', message, request.method, request.path)
+    else:
+        logger.exception(message)
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(names, values):
+    return ','.join(f'{name}="{escape_label(value)}"' for name, value in zip(names, values))
+
+
+@contextmanager
+def directory_lock(directory: str, exclusive: bool):
+    """
+    Lock the metrics directory against other processes, so that /metrics never reads the counters of an exited
+    worker twice, or not at all, while they are moved to the archive
+    """
+    if fcntl is None:
+        yield
+        return
+
+    with open(os.path.join(directory, '.lock'), 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def read_snapshot(path: str):
+    """
+    :param path:
+    :return: The snapshot written by save_snapshot(), or None if it is missing or being replaced
+    """
+    try:
+        with open(path) as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return None
+
+
+def save_snapshot(path: str, snapshot: dict):
+    """
+    Replace a snapshot file at once, so that readers never see half of it
+    """
+    temporary = f'{path}.{os.getpid()}.tmp'
+    with open(temporary, 'w') as file:
+        json.dump(snapshot, file)
+    os.replace(temporary, path)
+
+
+def merge_snapshots(snapshots):
+    """
+    Add up the metrics of several processes. Counters and histograms are summed. Gauges only make sense per
+    process, so they are labelled with its pid, and dropped for the exited workers of the archive.
+    :param snapshots: As returned by Metrics.snapshot()
+    :return: A snapshot of them all, with no pid
+    """
+    merged = {'pid': None, 'durations': {}, 'requests': {}, 'queries': {}, 'series': {}}
+    for snapshot in snapshots:
+        for field in ('durations', 'requests', 'queries'):
+            for key, values in snapshot[field]:
+                key = tuple(key)
+                if isinstance(values, list):
+                    total = merged[field].get(key)
+                    merged[field][key] = values if total is None else [a + b for a, b in zip(total, values)]
+                else:
+                    merged[field][key] = merged[field].get(key, 0) + values
+
+        for name, kind, description, samples in snapshot['series']:
+            if kind == 'gauge' and snapshot['pid'] is None:
+                continue
+            _, _, _, totals = merged['series'].setdefault(name, (name, kind, description, {}))
+            for labels, value in samples:
+                if kind == 'gauge':
+                    labels = {**labels, 'pid': snapshot['pid']}
+                key = tuple(labels.items())
+                totals[key] = totals.get(key, 0) + value
+
+    for field in ('durations', 'requests', 'queries'):
+        merged[field] = sorted(merged[field].items())
+    merged['series'] = [(name, kind, description, [(dict(key), value) for key, value in totals.items()])
+                        for name, kind, description, totals in merged['series'].values()]
+    return merged
+
+
+def mark_process_dead(pid: int, directory: str = METRICS_DIR):
+    """
+    Move the counters of an exited worker to the archive, where they keep counting towards the totals, and drop
+    its gauges. Called by the gunicorn master.
+    :param pid:
+    :param directory:
+    :return:
+    """
+    if directory is None or not os.path.exists(os.path.join(directory, f'{pid}.json')):
+        return
+
+    path = os.path.join(directory, f'{pid}.json')
+
+    archive = os.path.join(directory, METRICS_ARCHIVE)
+    with directory_lock(directory, exclusive=True):
+        snapshots = [snapshot for snapshot in (read_snapshot(archive), read_snapshot(path)) if snapshot is not None]
+        merged = merge_snapshots(snapshots)
+        merged['series'] = [series for series in merged['series'] if series[1] != 'gauge']
+        save_snapshot(archive, merged)
+        os.remove(path)
+
+
+def clear_metrics_dir(directory: str = METRICS_DIR):
+    """
+    Delete the metrics of a previous run of the server, which would otherwise add to those of this one
+    """
+    if directory is None:
+        return
+
+    for path in glob.glob(os.path.join(directory, '*.json')):
+        os.remove(path)
+
+
+class Metrics:
+    """
+    The request metrics of one process
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS, directory: str = METRICS_DIR,
+                 write_interval: float = METRICS_WRITE_INTERVAL):
+        self.buckets = buckets
+        self.directory = directory
+        self.write_interval = write_interval
+        self._lock = threading.Lock()
+        # (route, method, phase): [count per bucket..., count above the last bucket, sum]
+        self._durations = {}
+        # (route, method, status): count
+        self._requests = {}
+        # (route, method): [queries, slow queries]
+        self._queries = {}
+        self._collectors = []
+        # Whether there are requests that are not in the snapshot file yet
+        self._changed = False
+        # The process the snapshot writer runs in. Workers forked from a preloading master start their own.
+        self._writer_pid = None
+
+    def add_collector(self, collect):
+        """
+        Export more series along with the request metrics
+        :param collect: A function that returns the current series, as a list of
+        (name, 'counter' or 'gauge', description, [(labels, value), ...]), where labels is a dict
+        :return:
+        """
+        self._collectors.append(collect)
+
+    def observe(self, route: str, method: str, status: int, timing: RequestTiming):
+        with self._lock:
+            self._requests[(route, method, status)] = self._requests.get((route, method, status), 0) + 1
+
+            queries = self._queries.setdefault((route, method), [0, 0])
+            queries[0] += timing.queries
+            queries[1] += timing.slow_queries
+
+            for phase, seconds in timing.phases.items():
+                histogram = self._durations.get((route, method, phase))
+                if histogram is None:
+                    histogram = self._durations[(route, method, phase)] = [0] * (len(self.buckets) + 1) + [0.0]
+                histogram[bisect.bisect_left(self.buckets, seconds)] += 1
+                histogram[-1] += seconds
+
+            self._changed = True
+            if self.directory is not None and self._writer_pid != os.getpid():
+                self._writer_pid = os.getpid()
+                threading.Thread(target=self._write_periodically, name='metrics-writer', daemon=True).start()
+
+    def snapshot(self):
+        """
+        :return: The metrics of this process, in a form that can be stored as JSON and merged with those of others
+        """
+        with self._lock:
+            snapshot = {
+                'pid': os.getpid(),
+                'durations': [(key, list(histogram)) for key, histogram in sorted(self._durations.items())],
+                'requests': sorted(self._requests.items()),
+                'queries': [(key, list(counts)) for key, counts in sorted(self._queries.items())]
+            }
+            self._changed = False
+
+        snapshot['series'] = [series for collect in self._collectors for series in collect()]
+        return snapshot
+
+    def write_snapshot(self):
+        """
+        Write the metrics of this process to the metrics directory
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        save_snapshot(os.path.join(self.directory, f'{os.getpid()}.json'), self.snapshot())
+
+    def _write_periodically(self):
+        while True:
+            time.sleep(self.write_interval)
+            if self._changed:
+                try:
+                    self.write_snapshot()
+                except Exception:
+                    log_exception('Could not write the metrics')
+
+    def render(self):
+        """
+        :return: The metrics in the Prometheus text exposition format, of every worker when there is a metrics
+        directory, else of this process
+        """
+        if self.directory is None:
+            return self.render_snapshot(self.snapshot(), per_process=False)
+
+        self.write_snapshot()
+        with directory_lock(self.directory, exclusive=False):
+            snapshots = [read_snapshot(path) for path in glob.glob(os.path.join(self.directory, '*.json'))]
+        return self.render_snapshot(merge_snapshots([snapshot for snapshot in snapshots if snapshot is not None]))
+
+    def render_snapshot(self, snapshot: dict, per_process: bool = True):
+        """
+        :param snapshot: As returned by snapshot() or merge_snapshots()
+        :param per_process: Whether the gauges are labelled by pid
+        :return: The metrics in the Prometheus text exposition format
+        """
+        lines = []
+        name = f'{METRICS_PREFIX}_request_duration_seconds'
+        lines += [f'# HELP {name} Time spent on requests, by phase', f'# TYPE {name} histogram']
+        for key, histogram in snapshot['durations']:
+            labels = format_labels(('route', 'method', 'phase'), key)
+            cumulative = 0
+            for bound, count in zip(self.buckets, histogram):
+                cumulative += count
+                lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+            count = cumulative + histogram[len(self.buckets)]
+            lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {count}')
+            lines.append(f'{name}_sum{{{labels}}} {histogram[-1]}')
+            lines.append(f'{name}_count{{{labels}}} {count}')
+
+        name = f'{METRICS_PREFIX}_requests_total'
+        lines += [f'# HELP {name} Requests, by response status', f'# TYPE {name} counter']
+        for key, count in snapshot['requests']:
+            lines.append(f'{name}{{{format_labels(("route", "method", "status"), key)}}} {count}')
+
+        for index, (name, description) in enumerate([
+            (f'{METRICS_PREFIX}_db_queries_total', 'SQL statements run by requests'),
+            (f'{METRICS_PREFIX}_db_slow_queries_total', 'SQL statements that took at least the slow threshold')
+        ]):
+            lines += [f'# HELP {name} {description}', f'# TYPE {name} counter']
+            for key, counts in snapshot['queries']:
+                lines.append(f'{name}{{{format_labels(("route", "method"), key)}}} {counts[index]}')
+
+        for name, kind, description, samples in snapshot['series']:
+            name = f'{METRICS_PREFIX}_{name}'
+            if kind == 'gauge' and per_process:
+                description += ', per worker process'
+            lines += [f'# HELP {name} {description}', f'# TYPE {name} {kind}']
+            for labels, value in samples:
+                lines.append(f'{name}{{{format_labels(labels, labels.values())}}} {value}' if labels
+                             else f'{name} {value}')
+
+        return '\n'.join(lines) + '\n'
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if context is not None:
+        context._query_start = time.perf_counter()
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    start = getattr(context, '_query_start', None)
+    timing = request_timing()
+    if start is None or timing is None:
+        return
+
+    seconds = time.perf_counter() - start
+    timing.phases['db'] += seconds
+    timing.queries += 1
+    if seconds * 1e3 >= timing.slow_query_ms:
+        timing.slow_queries += 1
+        logger.warning('Slow statement (%.1f ms) in %s %s: %s', seconds * 1e3, request.method, request.path,
+                       statement)
+
+
+def listen_to_engines():
+    """
+    Time the statements of every engine, the replicas' included
+    """
+    global _listening
+    with _listen_lock:
+        if _listening:
+            return
+        event.listen(Engine, 'before_cursor_execute', before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', after_cursor_execute)
+        _listening = True
+
+
+def setup_metrics(app, slow_query_ms: float = SLOW_QUERY_MS):
+    """
+    Time every request of the app and serve the metrics on /metrics.
+    Call it before anything else adds after_request functions, so that the total includes them.
+    :param app:
+    :param slow_query_ms: Statements that take at least this long are counted as slow
+    :return: The Metrics
+    """
+    metrics = Metrics()
+    app.extensions['metrics'] = metrics
+    listen_to_engines()
+
+    @app.before_request
+    def start_timing():
+        if request.endpoint != 'metrics':
+            g.request_timing = RequestTiming(slow_query_ms)
+
+    @app.after_request
+    def record_timing(response):
+        timing = g.pop('request_timing', None)
+        if timing is None:
+            return response
+
+        timing.phases['total'] = time.perf_counter() - timing.start
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        metrics.observe(route, request.method, response.status_code, timing)
+        response.headers['Server-Timing'] = timing.server_timing()
+
+        return response
+
+    @app.route('/metrics', endpoint='metrics')
+    def metrics_view():
+        return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+    return metrics
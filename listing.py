@@ -0,0 +1,345 @@
+"""
+Helpers shared by the collection endpoints, GET /actors and GET /movies
+"""
+import base64
+import binascii
+import json
+import os
+import re
+from datetime import datetime
+
+from flask import request, Response, stream_with_context, g
+from sqlalchemy import or_, and_
+from sqlalchemy.orm import load_only
+from werkzeug.exceptions import UnprocessableEntity
+
+from serialization import dumps, vary_on_format
+
+DEFAULT_PAGE_SIZE = int(os.environ.get('DEFAULT_PAGE_SIZE', 50))
+MAX_PAGE_SIZE = int(os.environ.get('MAX_PAGE_SIZE', 200))
+# Rows fetched from the database cursor, and written to the response, at a time when streaming
+STREAM_BATCH_SIZE = int(os.environ.get('STREAM_BATCH_SIZE', 500))
+
+# A calendar date, optionally followed by a time. A bare year like 2020 is rejected rather than taken for a timestamp.
+ISO_DATE = re.compile(r'\d{4}-\d{2}-\d{2}([T ].*)?$')
+
+
+def get_int_arg(name: str, minimum: int = None):
+    """
+    Read an integer query parameter
+    :param name:
+    :param minimum: The smallest value allowed
+    :return: The value, or None if the parameter is not present
+    """
+    value = request.args.get(name)
+    if value is None or value == '':
+        return None
+
+    try:
+        value = int(value)
+    except ValueError:
+        raise UnprocessableEntity(description=f'{name} must be an integer')
+
+    if minimum is not None and value < minimum:
+        raise UnprocessableEntity(description=f'{name} must be at least {minimum}')
+
+    return value
+
+
+def get_choice_arg(name: str, allowed):
+    """
+    Read a query parameter that must be one of a few values
+    :param name:
+    :param allowed:
+    :return: The value, or None if the parameter is not present
+    """
+    value = request.args.get(name)
+    if value is None or value == '':
+        return None
+
+    value = value.strip().lower()
+    if value not in allowed:
+        raise UnprocessableEntity(description=f'{name} must be one of {", ".join(allowed)}')
+
+    return value
+
+
+def get_date_arg(name: str):
+    """
+    Read a date query parameter, given in ISO 8601 format, e.g. 2020-03-22 or 2020-03-22T22:23:11, or as a
+    timestamp prefixed with @, like the release_date of a new movie, e.g. @1584915791
+    :param name:
+    :return: The datetime, or None if the parameter is not present
+    """
+    value = request.args.get(name)
+    if value is None or value == '':
+        return None
+
+    try:
+        if value.startswith('@'):
+            return datetime.fromtimestamp(float(value[1:]))
+        if ISO_DATE.match(value):
+            return datetime.fromisoformat(value)
+    except (ValueError, OverflowError, OSError):
+        pass
+
+    raise UnprocessableEntity(
+        description=f'{name} must be an ISO 8601 date, e.g. 2020-03-22, or a timestamp prefixed with @, e.g. @1584915791'
+    )
+
+
+def get_sort_arg(model):
+    """
+    Read the sort parameter: one of model.SORTS, prefixed with - for descending order.
+    EXAMPLE
+        GET /movies?sort=-release_date
+    :param model: The model class being listed
+    :return: (field, descending), or None to sort by id
+    """
+    value = request.args.get('sort')
+    if value is None or value == '':
+        return None
+
+    value = value.strip()
+    field = value.lstrip('-')
+    if field not in model.SORTS:
+        raise UnprocessableEntity(
+            description=f'sort must be one of {", ".join(model.SORTS)}, optionally prefixed with - for descending order'
+        )
+
+    return field, value.startswith('-')
+
+
+def get_bool_arg(name: str):
+    """
+    Read a flag from the query string, e.g. ?stream=1 or ?stream=true
+    :param name:
+    :return:
+    """
+    return request.args.get(name, '').lower() in ('1', 'true', 'yes')
+
+
+def get_list_arg(name: str, allowed):
+    """
+    Read a comma separated list from the query string
+    :param name:
+    :param allowed: The values the list may contain
+    :return: The set of values, or None if the parameter is not present
+    """
+    value = request.args.get(name)
+    if value is None:
+        return None
+
+    values = {item.strip() for item in value.split(',') if item.strip()}
+    unknown = values - set(allowed)
+    if unknown:
+        raise UnprocessableEntity(
+            description=f'{name} must be a comma separated list of {", ".join(allowed)}. '
+                        f'Unknown: {", ".join(sorted(unknown))}'
+        )
+
+    return values
+
+
+def get_fields_args(model):
+    """
+    Read the sparse fieldset parameters, fields and include, from the query string.
+    Without either parameter all columns are returned and the relationship is embedded, as it always was.
+    Once fields is given, the relationship is only embedded if include names it.
+    EXAMPLE
+        GET /actors?fields=id,name&include=movies
+    :param model: The model class being listed
+    :return: (fields, include) where fields is a tuple in model.FIELDS order, or None for every column
+    """
+    requested = get_list_arg('fields', model.FIELDS)
+    included = get_list_arg('include', [model.RELATION])
+
+    fields = None
+    if requested is not None:
+        if not requested:
+            raise UnprocessableEntity(description=f'fields must name at least one of {", ".join(model.FIELDS)}')
+        fields = tuple(field for field in model.FIELDS if field in requested)
+
+    if included is None:
+        include = fields is None
+    else:
+        include = model.RELATION in included
+
+    return fields, include
+
+
+def column_options(model, fields):
+    """
+    Query options that only load the requested columns, plus the id the pages are ordered by
+    :param model:
+    :param fields: As returned by get_fields_args()
+    :return:
+    """
+    if fields is None:
+        return []
+
+    return [load_only(*{'id', *fields})]
+
+
+def encode_cursor(value, row_id: int):
+    """
+    The next cursor of a page sorted by another column than id: the last row's value of that column and its id
+    :param value:
+    :param row_id:
+    :return: An opaque URL safe string
+    """
+    if isinstance(value, datetime):
+        value = value.isoformat()
+
+    return base64.urlsafe_b64encode(json.dumps([value, row_id]).encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor: str, column):
+    """
+    Read a cursor made by encode_cursor()
+    :param cursor:
+    :param column: The column the pages are sorted by
+    :return: (value, id)
+    """
+    try:
+        value, row_id = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        if column.type.python_type is datetime:
+            value = datetime.fromisoformat(value)
+        if not isinstance(value, column.type.python_type) or isinstance(value, bool) \
+                or not isinstance(row_id, int) or isinstance(row_id, bool):
+            raise ValueError
+    except (ValueError, TypeError, binascii.Error):
+        raise UnprocessableEntity(description='after must be the next cursor of the previous page')
+
+    return value, row_id
+
+
+def get_page_args(model, sort: tuple = None):
+    """
+    Read the keyset pagination parameters from the query string: after, the next cursor of the previous page,
+    or after_id, and limit.
+    after_id still works with a sort, but then the row must still exist, since the page starts after its value of
+    the sort column.
+    The limit defaults to DEFAULT_PAGE_SIZE and is capped at MAX_PAGE_SIZE.
+    :param model: The model class being listed
+    :param sort: As returned by get_sort_arg()
+    :return: (after, limit) where after is an id in id order, (value, id) in another order, or None
+    """
+    field, _ = sort or ('id', False)
+    column = getattr(model, field)
+    limit = get_int_arg('limit', minimum=1)
+    if limit is None:
+        limit = DEFAULT_PAGE_SIZE
+    limit = min(limit, MAX_PAGE_SIZE)
+
+    cursor = request.args.get('after')
+    if cursor:
+        value, after_id = decode_cursor(cursor, column)
+        return (after_id if field == 'id' else (value, after_id)), limit
+
+    after_id = get_int_arg('after_id', minimum=0)
+    if after_id is None or field == 'id':
+        return after_id, limit
+
+    row = model.query.with_entities(column).filter(model.id == after_id).first()
+    if row is None:
+        raise UnprocessableEntity(
+            description=f'{model.__name__} {after_id} no longer exists: continue from the next cursor with after'
+        )
+
+    return (row[0], after_id), limit
+
+
+def order_query(query, model, after=None, sort: tuple = None):
+    """
+    Order a query by the sort field, then by id, and seek past the last row of the previous page
+    :param query:
+    :param model: The model class being listed
+    :param after: As returned by get_page_args()
+    :param sort: As returned by get_sort_arg()
+    :return:
+    """
+    field, descending = sort or ('id', False)
+    column = getattr(model, field)
+
+    if after is not None:
+        if field == 'id':
+            query = query.filter(model.id < after if descending else model.id > after)
+        else:
+            value, after_id = after
+            query = query.filter(or_(
+                column < value if descending else column > value,
+                and_(column == value, model.id > after_id)
+            ))
+
+    if field == 'id':
+        return query.order_by(model.id.desc() if descending else model.id)
+
+    return query.order_by(column.desc() if descending else column, model.id)
+
+
+def paginate(query, model, after=None, limit: int = DEFAULT_PAGE_SIZE, sort: tuple = None):
+    """
+    Get one page of a query, seeking past the previous page on an index instead of skipping rows with OFFSET
+    :param query:
+    :param model: The model class whose id the page is ordered by
+    :param after: As returned by get_page_args()
+    :param limit: The page size
+    :param sort: As returned by get_sort_arg(), or None for primary key order
+    :return: (rows, next) where next is the after_id of the following page in id order, its after cursor in
+    another order, or None on the last page
+    """
+    rows = order_query(query, model, after, sort).limit(limit + 1).all()
+    if len(rows) > limit:
+        rows = rows[:limit]
+        field, _ = sort or ('id', False)
+        if field == 'id':
+            return rows, rows[-1].id
+        return rows, encode_cursor(getattr(rows[-1], field), rows[-1].id)
+
+    return rows, None
+
+
+def stream_collection(key: str, query, model, after=None, fields: tuple = None, include: bool = True,
+                      sort: tuple = None, batch_size: int = STREAM_BATCH_SIZE):
+    """
+    Stream every row of a query, in the same order as its pages, as the JSON body {key: [...], "next": null}.
+
+    The rows are read from a server-side cursor batch_size at a time and each batch is written out as soon
+    as it is serialized, so memory use does not grow with the size of the table.
+    The first batch is fetched before returning, so that database errors can still be turned into an error
+    response.
+    :param key: The name of the list in the response
+    :param query:
+    :param model: The model class whose id the rows are ordered by
+    :param after: As returned by get_page_args()
+    :param fields: The columns to include, as for Model.format()
+    :param include: Whether to embed the relationship
+    :param sort: As returned by get_sort_arg()
+    :param batch_size:
+    :return: A streaming Response
+    """
+    rows = iter(order_query(query, model, after, sort).yield_per(batch_size))
+    first = next(rows, None)
+
+    def generate():
+        chunk = [dumps(first.format(fields, include))] if first is not None else []
+        yield f'{{"{key}": ['.encode() + b','.join(chunk)
+        separator = b',' if chunk else b''
+
+        chunk = []
+        for row in rows:
+            chunk.append(dumps(row.format(fields, include)))
+            if len(chunk) >= batch_size:
+                yield separator + b','.join(chunk)
+                separator = b','
+                chunk = []
+                # Keep memory flat: the fragments of one batch are rarely embedded in the next
+                g.pop('fragments', None)
+
+        if chunk:
+            yield separator + b','.join(chunk)
+        yield b'], "next": null}\n'
+
+    # Always JSON, but a 304 instead of it depends on the format the client asked for, see caching.conditional()
+    return vary_on_format(Response(stream_with_context(generate()), mimetype='application/json'))
@@ -0,0 +1,124 @@
+"""
+A local stand-in for Auth0: an RSA key pair, the JWKS document for it and access tokens signed with it.
+This lets the benchmarks and tests run without network access or Auth0 credentials.
+"""
+import base64
+import json
+import threading
+import time
+import uuid
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from Crypto.PublicKey import RSA
+from jose import jwt
+
+ROLE_PERMISSIONS = {
+    'CA': ['get:actors', 'get:movies'],
+    'CD': ['get:actors', 'get:movies', 'create:actors', 'update:actors', 'delete:actors', 'update:movies'],
+    'EP': ['get:actors', 'get:movies', 'create:actors', 'update:actors', 'delete:actors', 'create:movies',
+           'update:movies', 'delete:movies']
+}
+
+
+def b64_uint(value: int):
+    """
+    Encode an unsigned integer as base64url without padding, as JWKs do
+    :param value:
+    :return:
+    """
+    raw = value.to_bytes((value.bit_length() + 7) // 8, 'big')
+    return base64.urlsafe_b64encode(raw).rstrip(b'=').decode()
+
+
+class LocalAuth:
+    def __init__(self, domain: str, audience: str, kid: str = 'local', bits: int = 2048):
+        """
+        :param domain: The Auth0 domain the tokens claim to be issued by
+        :param audience: The API audience of the tokens
+        :param kid: The key ID put in the JWKS and the token headers
+        :param bits: RSA key size
+        """
+        self.domain = domain
+        self.audience = audience
+        self.kid = kid
+        self.key = RSA.generate(bits)
+        self.private_pem = self.key.exportKey('PEM').decode()
+
+    def jwks(self):
+        """
+        The JWKS document for the public key
+        :return:
+        """
+        return {
+            'keys': [{
+                'alg': 'RS256',
+                'kty': 'RSA',
+                'use': 'sig',
+                'kid': self.kid,
+                'n': b64_uint(self.key.n),
+                'e': b64_uint(self.key.e)
+            }]
+        }
+
+    def keys(self):
+        """
+        The public keys by kid, in the form JWKSKeyStore.load() takes
+        :return:
+        """
+        return {
+            key['kid']: {prop: key[prop] for prop in ['kty', 'kid', 'use', 'n', 'e']}
+            for key in self.jwks()['keys']
+        }
+
+    def serve_jwks(self, host: str = '127.0.0.1', port: int = 0, delay: float = 0):
+        """
+        Serve the JWKS document over HTTP from a background thread, for JWKS_URL
+        :param host:
+        :param port: 0 for any free port
+        :param delay: Seconds to wait before answering, to stand in for a distant Auth0
+        :return: (server, url). Call server.shutdown() to stop it.
+        """
+        body = json.dumps(self.jwks()).encode()
+
+        class JWKSHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                time.sleep(delay)
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), JWKSHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+        return server, f'http://{host}:{server.server_port}/.well-known/jwks.json'
+
+    def mint_token(self, role: str = None, permissions: list = None, expires_in: int = 3600, **claims):
+        """
+        Sign an access token
+        :param role: 'CA', 'CD' or 'EP', to use the permissions of that role
+        :param permissions: The permissions claim, if no role is given
+        :param expires_in: Seconds until the token expires. Negative values give an expired token.
+        :param claims: Any other claims to set
+        :return:
+        """
+        if permissions is None:
+            permissions = ROLE_PERMISSIONS[role.upper()] if role else []
+
+        now = int(time.time())
+        payload = {
+            'iss': f'https://{self.domain}/',
+            'sub': f'local|{role or "user"}',
+            'aud': self.audience,
+            'iat': now,
+            'exp': now + expires_in,
+            'jti': uuid.uuid4().hex,
+            'permissions': permissions
+        }
+        payload.update(claims)
+
+        return jwt.encode(payload, self.private_pem, algorithm='RS256', headers={'kid': self.kid})
@@ -1,12 +1,12 @@
 from flask_script import Manager
-from flask_migrate import Migrate, MigrateCommand
+from flask_migrate import MigrateCommand
 
 from app import create_app
-from models import db
+from models import setup_migrations
 
 app = create_app()
 
-migrate = Migrate(app, db)
+migrate = setup_migrations(app)
 manager = Manager(app)
 
 manager.add_command('db', MigrateCommand)
@@ -0,0 +1,36 @@
+"""Add search indexes
+
+Revision ID: 5b8e2f6c1a93
+Revises: e3f7a91c5d28
+Create Date: 2026-10-18 15:47:05.112874
+
+"""
+from alembic import op
+from models import SEARCH_INDEXES
+
+
+# revision identifiers, used by Alembic.
+revision = '5b8e2f6c1a93'
+down_revision = 'e3f7a91c5d28'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    if op.get_context().dialect.name != 'postgresql':
+        return
+
+    op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    with op.get_context().autocommit_block():
+        for name, table, column in SEARCH_INDEXES:
+            op.create_index(name, table, [column], postgresql_using='gin', postgresql_ops={column: 'gin_trgm_ops'},
+                            postgresql_concurrently=True)
+
+
+def downgrade():
+    if op.get_context().dialect.name != 'postgresql':
+        return
+
+    with op.get_context().autocommit_block():
+        for name, table, column in reversed(SEARCH_INDEXES):
+            op.drop_index(name, table_name=table, postgresql_concurrently=True)
@@ -0,0 +1,31 @@
+"""Add table versions
+
+Revision ID: 9c1d4e2b7a05
+Revises: 4328388afa62
+Create Date: 2026-10-18 10:12:41.518204
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from models import VERSIONED_TABLES
+
+
+# revision identifiers, used by Alembic.
+revision = '9c1d4e2b7a05'
+down_revision = '4328388afa62'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    table_versions = op.create_table('table_versions',
+    sa.Column('name', sa.String(50), nullable=False),
+    sa.Column('version', sa.Integer(), server_default='0', nullable=False),
+    sa.Column('changed_at', sa.DateTime(timezone=True), server_default=sa.text('now()'), nullable=False),
+    sa.PrimaryKeyConstraint('name')
+    )
+    op.bulk_insert(table_versions, [{'name': name} for name in VERSIONED_TABLES])
+
+
+def downgrade():
+    op.drop_table('table_versions')
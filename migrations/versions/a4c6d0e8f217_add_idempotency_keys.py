@@ -0,0 +1,34 @@
+"""Add idempotency keys
+
+Revision ID: a4c6d0e8f217
+Revises: 5b8e2f6c1a93
+Create Date: 2026-10-18 17:20:33.905716
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a4c6d0e8f217'
+down_revision = '5b8e2f6c1a93'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('idempotency_keys',
+    sa.Column('key', sa.String(255), nullable=False),
+    sa.Column('owner', sa.String(255), nullable=False),
+    sa.Column('fingerprint', sa.String(64), nullable=False),
+    sa.Column('status', sa.SmallInteger(), nullable=True),
+    sa.Column('body', sa.Text(), nullable=True),
+    sa.Column('expires_at', sa.DateTime(timezone=True), nullable=False),
+    sa.PrimaryKeyConstraint('key', 'owner')
+    )
+    op.create_index(op.f('ix_idempotency_keys_expires_at'), 'idempotency_keys', ['expires_at'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_idempotency_keys_expires_at'), table_name='idempotency_keys')
+    op.drop_table('idempotency_keys')
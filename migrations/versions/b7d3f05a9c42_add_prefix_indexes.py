@@ -0,0 +1,35 @@
+"""Add prefix indexes
+
+Revision ID: b7d3f05a9c42
+Revises: a4c6d0e8f217
+Create Date: 2026-10-18 19:12:48.305127
+
+"""
+from alembic import op
+from models import PREFIX_INDEXES
+
+
+# revision identifiers, used by Alembic.
+revision = 'b7d3f05a9c42'
+down_revision = 'a4c6d0e8f217'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    if op.get_context().dialect.name != 'postgresql':
+        return
+
+    with op.get_context().autocommit_block():
+        for name, table, column in PREFIX_INDEXES:
+            op.create_index(name, table, [column], postgresql_ops={column: 'text_pattern_ops'},
+                            postgresql_concurrently=True)
+
+
+def downgrade():
+    if op.get_context().dialect.name != 'postgresql':
+        return
+
+    with op.get_context().autocommit_block():
+        for name, table, column in reversed(PREFIX_INDEXES):
+            op.drop_index(name, table_name=table, postgresql_concurrently=True)
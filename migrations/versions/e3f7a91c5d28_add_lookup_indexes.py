@@ -0,0 +1,38 @@
+"""Add lookup indexes
+
+Revision ID: e3f7a91c5d28
+Revises: 9c1d4e2b7a05
+Create Date: 2026-10-18 14:02:17.640391
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'e3f7a91c5d28'
+down_revision = '9c1d4e2b7a05'
+branch_labels = None
+depends_on = None
+
+# (index name, table, column). The primary key of actors_movies starts with actor_id, so looking up the
+# actors of a movie needs an index of its own.
+INDEXES = [
+    ('ix_actors_movies_movie_id', 'actors_movies', 'movie_id'),
+    ('ix_actors_name', 'actors', 'name'),
+    ('ix_movies_title', 'movies', 'title'),
+    ('ix_movies_release_date', 'movies', 'release_date'),
+]
+
+
+def upgrade():
+    # CREATE INDEX CONCURRENTLY does not lock the tables against writes while the index is built,
+    # but cannot run inside a transaction
+    with op.get_context().autocommit_block():
+        for name, table, column in INDEXES:
+            op.create_index(name, table, [column], postgresql_concurrently=True)
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        for name, table, column in reversed(INDEXES):
+            op.drop_index(name, table_name=table, postgresql_concurrently=True)
@@ -1,13 +1,21 @@
 import os
 import json
-from sqlalchemy import Column, String, Integer, DateTime, Enum, text, SmallInteger, CheckConstraint
+import threading
+import time
+from datetime import datetime, timezone
+from functools import lru_cache
+from itertools import chain
+from sqlalchemy import Column, String, Integer, DateTime, Enum, text, SmallInteger, CheckConstraint, event, inspect, \
+    select, DDL
+from sqlalchemy import exc
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import QueuePool
 from sqlalchemy.sql import func
-from flask_sqlalchemy import SQLAlchemy
-from flask_migrate import Migrate
+from flask import g, has_request_context
 
-database_path = os.environ['DATABASE_URL']
+from replicas import RoutingSQLAlchemy, setup_replicas, track_writes, committed_write
 
-db = SQLAlchemy()
+db = RoutingSQLAlchemy()
 MIN_ACTOR_AGE = 0
 MAX_ACTOR_AGE = 150
 MIN_ACTOR_NAME_LENGTH = 3
@@ -15,22 +23,203 @@ MAX_ACTOR_NAME_LENGTH = 100
 MIN_MOVIE_TITLE_LENGTH = 1
 MAX_MOVIE_TITLE_LENGTH = 100
 
-def setup_db(app, database_path=database_path):
+class InstrumentedQueuePool(QueuePool):
+    """
+    A QueuePool that records how long checkouts wait for a connection
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._stats_lock = threading.Lock()
+        self._wait_stats = {
+            'checkouts': 0,
+            'timeouts': 0,
+            'wait_seconds_total': 0.0,
+            'wait_seconds_max': 0.0
+        }
+
+    def _do_get(self):
+        start = time.perf_counter()
+        timed_out = False
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            timed_out = True
+            raise
+        finally:
+            wait = time.perf_counter() - start
+            with self._stats_lock:
+                self._wait_stats['checkouts'] += 1
+                self._wait_stats['timeouts'] += timed_out
+                self._wait_stats['wait_seconds_total'] += wait
+                self._wait_stats['wait_seconds_max'] = max(self._wait_stats['wait_seconds_max'], wait)
+
+    def stats(self):
+        """
+        The pool's size and usage, and how long checkouts have waited
+        :return:
+        """
+        with self._stats_lock:
+            stats = dict(self._wait_stats)
+
+        stats.update({
+            'size': self.size(),
+            'checked_out': self.checkedout(),
+            'overflow': max(self.overflow(), 0),
+            'max_overflow': self._max_overflow
+        })
+        return stats
+
+
+def env_setting(name: str, cast):
+    value = os.environ.get(name)
+    if value is None or value == '':
+        return None
+    if cast is bool:
+        return value.lower() in ('1', 'true', 'yes')
+    return cast(value)
+
+
+def engine_options(database_path, pool_size: int = None, max_overflow: int = None, pool_timeout: float = None,
+                   pool_recycle: int = None, pool_pre_ping: bool = None, statement_timeout: int = None):
+    """
+    The create_engine options for the connection pool settings. Settings that are not given fall back to
+    the DATABASE_POOL_SIZE, DATABASE_MAX_OVERFLOW, DATABASE_POOL_TIMEOUT, DATABASE_POOL_RECYCLE,
+    DATABASE_POOL_PRE_PING and DATABASE_STATEMENT_TIMEOUT env variables, then to SQLAlchemy's defaults.
+    :param database_path:
+    :param pool_size: Connections kept open per worker
+    :param max_overflow: Connections opened beyond pool_size when they are all in use
+    :param pool_timeout: Seconds to wait for a connection before giving up
+    :param pool_recycle: Seconds after which a connection is replaced
+    :param pool_pre_ping: Whether to test connections before using them
+    :param statement_timeout: Milliseconds after which PostgreSQL cancels a statement
+    :return:
+    """
+    settings = {
+        'pool_size': (pool_size, 'DATABASE_POOL_SIZE', int),
+        'max_overflow': (max_overflow, 'DATABASE_MAX_OVERFLOW', int),
+        'pool_timeout': (pool_timeout, 'DATABASE_POOL_TIMEOUT', float),
+        'pool_recycle': (pool_recycle, 'DATABASE_POOL_RECYCLE', int),
+        'pool_pre_ping': (pool_pre_ping, 'DATABASE_POOL_PRE_PING', bool),
+        'statement_timeout': (statement_timeout, 'DATABASE_STATEMENT_TIMEOUT', int)
+    }
+    settings = {
+        name: value if value is not None else env_setting(env_name, cast)
+        for name, (value, env_name, cast) in settings.items()
+    }
+
+    backend = make_url(database_path).get_backend_name()
+    options = {}
+    if backend != 'sqlite':
+        # SQLite uses pools that are not sized
+        options['poolclass'] = InstrumentedQueuePool
+        for name in ['pool_size', 'max_overflow', 'pool_timeout']:
+            if settings[name] is not None:
+                options[name] = settings[name]
+
+    for name in ['pool_recycle', 'pool_pre_ping']:
+        if settings[name] is not None:
+            options[name] = settings[name]
+
+    if settings['statement_timeout'] and backend in ('postgres', 'postgresql'):
+        options['connect_args'] = {'options': f'-c statement_timeout={settings["statement_timeout"]}'}
+
+    return options
+
+
+def setup_db(app, database_path=None, replica_paths=None, recent_writers=None, **pool_settings):
     """
     binds a flask application and a SQLAlchemy service
     :param app:
-    :param database_path:
+    :param database_path: Read from the DATABASE_URL env variable if not given
+    :param replica_paths: Database URLs of read replicas, see setup_replicas()
+    :param recent_writers: Where to remember the clients that wrote, see setup_replicas()
+    :param pool_settings: Connection pool settings, see engine_options()
     :return:
     """
-    migrate = Migrate(app, db)
+    if database_path is None:
+        database_path = os.environ['DATABASE_URL']
+
     app.config["SQLALCHEMY_DATABASE_URI"] = database_path
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options(database_path, **pool_settings)
+    setup_replicas(app, db, replica_paths, recent_writers)
     db.app = app
     db.init_app(app)
 
     return db
 
 
+def setup_migrations(app):
+    """
+    Register Flask-Migrate for the `flask db` commands. Only they need it, and importing it takes longer
+    than importing the rest of the app.
+    :param app:
+    :return:
+    """
+    from flask_migrate import Migrate
+
+    return Migrate(app, db)
+
+
+def named_engines(app):
+    """
+    :param app:
+    :return: (name, engine) for each of the app's engines: 'primary', then the replicas by bind name
+    """
+    binds = [None] + list(app.config.get('SQLALCHEMY_BINDS') or {})
+    return [(bind or 'primary', db.get_engine(app, bind=bind)) for bind in binds]
+
+
+def app_engines(app):
+    """
+    :param app:
+    :return: The app's engines: the primary's, then the replicas'
+    """
+    return [engine for _, engine in named_engines(app)]
+
+
+def dispose_engines(app):
+    """
+    Close the pooled connections of the app's engines, e.g. so that forked workers do not share them
+    :param app:
+    :return:
+    """
+    for engine in app_engines(app):
+        engine.dispose()
+
+
+# (series, type, description, InstrumentedQueuePool.stats() key)
+POOL_SERIES = (
+    ('db_pool_size', 'gauge', 'Connections the pool keeps open', 'size'),
+    ('db_pool_checked_out', 'gauge', 'Connections in use', 'checked_out'),
+    ('db_pool_overflow', 'gauge', 'Connections open beyond the pool size', 'overflow'),
+    ('db_pool_max_overflow', 'gauge', 'Connections that can be opened beyond the pool size', 'max_overflow'),
+    ('db_pool_checkouts_total', 'counter', 'Connections checked out of the pool', 'checkouts'),
+    ('db_pool_timeouts_total', 'counter', 'Checkouts that gave up after waiting the pool timeout', 'timeouts'),
+    ('db_pool_wait_seconds_total', 'counter', 'Time spent waiting for a connection', 'wait_seconds_total'),
+    ('db_pool_wait_seconds_max', 'gauge', 'Longest wait for a connection', 'wait_seconds_max')
+)
+
+
+def pool_metrics(app):
+    """
+    The connection pool stats of each of the app's engines, replicas included, for Metrics.add_collector().
+    Only InstrumentedQueuePools, which every database but SQLite uses, have them.
+    :param app:
+    :return:
+    """
+    pools = [(name, engine.pool.stats()) for name, engine in named_engines(app)
+             if isinstance(engine.pool, InstrumentedQueuePool)]
+    if not pools:
+        return []
+
+    return [
+        (series, kind, description, [({'engine': name}, stats[key]) for name, stats in pools])
+        for series, kind, description, key in POOL_SERIES
+    ]
+
+
 def update():
     """
     updates a new model for the database
@@ -42,6 +231,32 @@ def update():
     db.session.commit()
 
 
+def insert_many(model, rows):
+    """
+    inserts many rows of a model in one statement, without committing
+    On databases that can return the new ids from a multi-row INSERT (PostgreSQL) a single
+    INSERT ... VALUES (...), (...) RETURNING id is used, otherwise the ORM inserts them in one flush.
+    EXAMPLE
+        ids = insert_many(Actors, [{'name': 'Ada', 'gender': 'f', 'age': 30}])
+    :param model: The model class
+    :param rows: Column values for each row
+    :return: The ids of the new rows, in the order of rows
+    """
+    if not rows:
+        return []
+
+    if db.session.get_bind().dialect.name == 'postgresql':
+        table = model.__table__
+        ids = [row[0] for row in db.session.execute(table.insert().values(rows).returning(table.c.id))]
+        bump_table_versions(db.session, {table.name})
+        return ids
+
+    instances = [model(**row) for row in rows]
+    db.session.add_all(instances)
+    db.session.flush()
+    return [instance.id for instance in instances]
+
+
 class Model:
     def insert(self):
         """
@@ -65,8 +280,53 @@ class Model:
         db.session.delete(self)
         db.session.commit()
 
-    def format(self):
-        return {}
+    # The columns that format() can return, in order, and the relationship it embeds
+    FIELDS = ()
+    RELATION = None
+    # The columns the collection can be sorted by
+    SORTS = ('id',)
+
+    def format_field(self, field):
+        return getattr(self, field)
+
+    def format_fields(self, fields=None):
+        """
+        :param fields: The columns to include, in FIELDS order. All of them if None.
+        :return:
+        """
+        return {field: self.format_field(field) for field in (self.FIELDS if fields is None else fields)}
+
+    def fragment(self, fragments: dict = None):
+        """
+        Every column of the entity, formatted. Within a request each entity is only formatted once, however
+        many times it is embedded in the response. The fragments are shared, so they must not be changed.
+        :param fragments: The request's fragments, as returned by request_fragments()
+        :return:
+        """
+        if fragments is None:
+            fragments = request_fragments()
+            if fragments is None:
+                return self.format_fields()
+
+        key = (self.__tablename__, self.id)
+        fragment = fragments.get(key)
+        if fragment is None:
+            fragment = fragments[key] = self.format_fields()
+
+        return fragment
+
+    def format(self, fields=None, include=True):
+        """
+        :param fields: The columns to include. All of them if None.
+        :param include: Whether to embed the related entities
+        :return:
+        """
+        fragments = request_fragments()
+        data = dict(self.fragment(fragments)) if fields is None else self.format_fields(fields)
+        if include:
+            data[self.RELATION] = [related.fragment(fragments) for related in getattr(self, self.RELATION)]
+
+        return data
 
     def __repr__(self):
         return json.dumps(self.format())
@@ -77,14 +337,209 @@ actors_movies = db.Table(
     db.Column('actor_id', db.Integer, db.ForeignKey('actors.id', onupdate='CASCADE', ondelete='CASCADE'),
               primary_key=True),
     db.Column('movie_id', db.Integer, db.ForeignKey('movies.id', onupdate='CASCADE', ondelete='CASCADE'),
-              primary_key=True)
+              primary_key=True, index=True)
+)
+
+
+def add_links(column: str, entity_id: int, related_column: str, related_ids: list):
+    """
+    links one entity to others straight in actors_movies, without loading either side's collection
+    Links that already exist are left alone. Does not commit.
+    EXAMPLE
+        add_links('movie_id', movie.id, 'actor_id', [1, 2])
+    :param column: The actors_movies column of the entity, actor_id or movie_id
+    :param entity_id:
+    :param related_column: The actors_movies column of the related entities
+    :param related_ids:
+    :return: The related ids that were not linked before
+    """
+    if not related_ids:
+        return []
+
+    rows = [{column: entity_id, related_column: related_id} for related_id in related_ids]
+    if db.session.get_bind().dialect.name == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+        statement = insert(actors_movies).values(rows).on_conflict_do_nothing() \
+            .returning(actors_movies.c[related_column])
+        added = [row[0] for row in db.session.execute(statement)]
+    else:
+        linked = {row[0] for row in db.session.execute(
+            select([actors_movies.c[related_column]])
+            .where(actors_movies.c[column] == entity_id)
+            .where(actors_movies.c[related_column].in_(related_ids))
+        )}
+        added = [related_id for related_id in related_ids if related_id not in linked]
+        if added:
+            db.session.execute(actors_movies.insert(), [row for row in rows if row[related_column] in added])
+
+    if added:
+        bump_table_versions(db.session, {actors_movies.name})
+    return added
+
+
+def remove_links(column: str, entity_id: int, related_column: str, related_ids: list):
+    """
+    unlinks one entity from others straight in actors_movies, without loading either side's collection
+    Does not commit.
+    :param column: The actors_movies column of the entity, actor_id or movie_id
+    :param entity_id:
+    :param related_column: The actors_movies column of the related entities
+    :param related_ids:
+    :return: The related ids that were linked before
+    """
+    if not related_ids:
+        return []
+
+    condition = (actors_movies.c[column] == entity_id) & actors_movies.c[related_column].in_(related_ids)
+    removed = [row[0] for row in db.session.execute(select([actors_movies.c[related_column]]).where(condition))]
+    if removed:
+        db.session.execute(actors_movies.delete().where(condition))
+        bump_table_versions(db.session, {actors_movies.name})
+    return removed
+
+
+def request_fragments():
+    """
+    The formatted entities of the current request, by table and id
+    :return: A dict, or None outside of a request
+    """
+    if not has_request_context():
+        return None
+    return g.setdefault('fragments', {})
+
+
+def format_datetime(value: datetime):
+    """
+    Format a date for the API. Movies often share dates, so each one is only formatted once.
+    :param value:
+    :return:
+    """
+    # Equal times in different time zones are formatted differently
+    return _format_datetime(value, value.utcoffset())
+
+
+@lru_cache(maxsize=4096)
+def _format_datetime(value: datetime, utcoffset):
+    return value.strftime('%c')
+
+
+@event.listens_for(db.session, 'after_flush')
+def forget_fragments(session, flush_context):
+    # Entities formatted before a write may have changed
+    if has_request_context():
+        g.pop('fragments', None)
+
+
+# Responses of create requests by the Idempotency-Key they were sent with, so that retries can be answered
+# without creating the entity again. body is NULL until the response is stored.
+idempotency_keys = db.Table(
+    'idempotency_keys',
+    db.Column('key', db.String(255), primary_key=True),
+    db.Column('owner', db.String(255), primary_key=True),
+    db.Column('fingerprint', db.String(64), nullable=False),
+    db.Column('status', db.SmallInteger),
+    db.Column('body', db.Text),
+    db.Column('expires_at', db.DateTime(timezone=True), nullable=False, index=True)
 )
 
 
+# Change counters for the tables behind the API responses, used to validate cached responses cheaply
+table_versions = db.Table(
+    'table_versions',
+    db.Column('name', db.String(50), primary_key=True),
+    db.Column('version', db.Integer, nullable=False, server_default='0'),
+    db.Column('changed_at', db.DateTime(timezone=True), server_default=func.now(), nullable=False)
+)
+
+VERSIONED_TABLES = ('actors', 'movies', 'actors_movies')
+
+# Called with the set of changed table names after each commit that wrote to versioned tables
+table_change_listeners = [committed_write]
+
+
+@event.listens_for(table_versions, 'after_create')
+def seed_table_versions(target, connection, **kw):
+    connection.execute(target.insert(), [{'name': name} for name in VERSIONED_TABLES])
+
+
+def changed_tables(session):
+    """
+    The versioned tables that flushing the session will write to
+    :param session:
+    :return:
+    """
+    tables = set()
+    for obj in chain(session.new, session.dirty, session.deleted):
+        if not isinstance(obj, Model):
+            continue
+
+        state = inspect(obj)
+        created_or_deleted = obj in session.new or obj in session.deleted
+        if created_or_deleted or any(attr.history.has_changes() for attr in state.attrs
+                                     if attr.key in state.mapper.column_attrs):
+            tables.add(obj.__table__.name)
+
+        # Deleting either side also deletes its links
+        if obj in session.deleted or state.attrs[obj.RELATION].history.has_changes():
+            tables.add(actors_movies.name)
+
+    return tables
+
+
+def bump_table_versions(session, tables):
+    """
+    Increment the change counters of tables within the session's transaction.
+    Writes that bypass the ORM, like inserts straight into actors_movies, have to call this themselves.
+    :param session:
+    :param tables: Names of the tables that changed
+    :return:
+    """
+    if not tables:
+        return
+
+    # Rolled back changes are not forgotten: telling listeners about a table that did not change is harmless
+    session.info.setdefault('changed_tables', set()).update(tables)
+    session.execute(
+        table_versions.update()
+        .where(table_versions.c.name.in_(sorted(tables)))
+        .values(version=table_versions.c.version + 1, changed_at=datetime.now(timezone.utc))
+    )
+
+
+@event.listens_for(db.session, 'before_flush')
+def track_table_versions(session, flush_context, instances):
+    bump_table_versions(session, changed_tables(session))
+
+
+track_writes(db.session)
+
+
+@event.listens_for(db.session, 'after_commit')
+def notify_table_changes(session):
+    tables = session.info.pop('changed_tables', None)
+    if tables:
+        for listener in table_change_listeners:
+            listener(tables)
+
+
+def get_table_versions():
+    """
+    :return: The change counter and last change time of each versioned table, by name
+    """
+    rows = db.session.execute(select([table_versions.c.name, table_versions.c.version, table_versions.c.changed_at]))
+    versions = {}
+    for name, version, changed_at in rows:
+        if changed_at.tzinfo is None:
+            changed_at = changed_at.replace(tzinfo=timezone.utc)
+        versions[name] = (version, changed_at)
+
+    return versions
+
+
 class Movies(Model, db.Model):
     id = Column(Integer, primary_key=True)
-    title = Column(String(100), nullable=False)
-    release_date = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
+    title = Column(String(100), nullable=False, index=True)
+    release_date = Column(DateTime(timezone=True), server_default=func.now(), nullable=False, index=True)
     actors = db.relationship(
         'Actors',
         secondary=actors_movies,
@@ -92,35 +547,56 @@ class Movies(Model, db.Model):
         backref=db.backref('movies', lazy=True)
     )
 
-    def format(self):
-        return {
-            'id': self.id,
-            'title': self.title,
-            'release_date': self.release_date.strftime('%c'),
-            'actors': [{
-                'id': actor.id,
-                'name': actor.name,
-                'gender': 'Male' if actor.gender is 'm' else 'Female',
-                'age': actor.age
-            } for actor in self.actors]
-        }
+    FIELDS = ('id', 'title', 'release_date')
+    RELATION = 'actors'
+    SORTS = ('id', 'title', 'release_date')
+
+    def format_field(self, field):
+        if field == 'release_date':
+            return format_datetime(self.release_date)
+        return getattr(self, field)
 
 
 class Actors(Model, db.Model):
     id = Column(Integer, primary_key=True)
-    name = Column(String(MAX_ACTOR_NAME_LENGTH), nullable=False)
+    name = Column(String(MAX_ACTOR_NAME_LENGTH), nullable=False, index=True)
     gender = Column(Enum('m', 'f', name='gender'), nullable=False, server_default='m')
     age = Column(SmallInteger, CheckConstraint(f'age > {MIN_ACTOR_AGE} AND age < {MAX_ACTOR_AGE}'), nullable=False)
 
-    def format(self):
-        return {
-            'id': self.id,
-            'name': self.name,
-            'gender': 'Male' if self.gender is 'm' else 'Female',
-            'age': self.age,
-            'movies': [{
-                'id': movie.id,
-                'title': movie.title,
-                'release_date': movie.release_date.strftime('%c')
-            } for movie in self.movies]
-        }
+    FIELDS = ('id', 'name', 'gender', 'age')
+    RELATION = 'movies'
+    SORTS = ('id', 'name', 'age')
+
+    def format_field(self, field):
+        if field == 'gender':
+            return 'Male' if self.gender == 'm' else 'Female'
+        return getattr(self, field)
+
+
+# Trigram indexes for GET /search: (index name, table, column). They need the pg_trgm extension, so they are
+# only created on PostgreSQL.
+SEARCH_INDEXES = (
+    ('ix_actors_name_trgm', 'actors', 'name'),
+    ('ix_movies_title_trgm', 'movies', 'title'),
+)
+
+event.listen(db.metadata, 'before_create', DDL('CREATE EXTENSION IF NOT EXISTS pg_trgm').execute_if(dialect='postgresql'))
+for index_name, table_name, column_name in SEARCH_INDEXES:
+    event.listen(
+        db.metadata.tables[table_name], 'after_create',
+        DDL(f'CREATE INDEX {index_name} ON {table_name} USING gin ({column_name} gin_trgm_ops)')
+        .execute_if(dialect='postgresql')
+    )
+
+# Indexes for the prefix filters, e.g. GET /movies?title_prefix=: (index name, table, column). LIKE 'x%' can only
+# use a plain index under the C collation, which databases rarely have, so these compare characters instead.
+PREFIX_INDEXES = (
+    ('ix_movies_title_pattern', 'movies', 'title'),
+)
+
+for index_name, table_name, column_name in PREFIX_INDEXES:
+    event.listen(
+        db.metadata.tables[table_name], 'after_create',
+        DDL(f'CREATE INDEX {index_name} ON {table_name} ({column_name} text_pattern_ops)')
+        .execute_if(dialect='postgresql')
+    )
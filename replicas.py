@@ -0,0 +1,319 @@
+"""
+Routing of the reads of read-only endpoints to database replicas
+"""
+import itertools
+import os
+import threading
+import time
+from functools import wraps
+
+from flask import g, request, current_app, has_request_context
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import event, orm, text
+
+from instrumentation import log_exception, logger
+
+# Seconds a replica that failed is left out before it is checked again
+DATABASE_REPLICA_RETRY = float(os.environ.get('DATABASE_REPLICA_RETRY', 30))
+# Seconds after a client's write during which its reads go to the primary, so it sees its own write
+DATABASE_PRIMARY_READ_WINDOW = int(os.environ.get('DATABASE_PRIMARY_READ_WINDOW', 5))
+# Where the recent writers are remembered: 'memory' for each worker, or a redis:// URL to share them between workers
+DATABASE_PRIMARY_READ_STORE = os.environ.get('DATABASE_PRIMARY_READ_STORE', 'memory')
+# Writers remembered per worker in memory
+MAX_RECENT_WRITERS = 10000
+PRIMARY_READ_COOKIE = 'read_primary_until'
+# Sent after a write, for clients to send back on their next reads
+PRIMARY_READ_HEADER = 'Read-Primary-Until'
+
+
+class RecentWriters:
+    """
+    The token subjects that wrote recently, and until when their reads go to the primary, in this process
+    """
+
+    def __init__(self, maxsize=MAX_RECENT_WRITERS):
+        self.maxsize = maxsize
+        self._until = {}
+        self._lock = threading.Lock()
+
+    def get(self, subject: str):
+        return self._until.get(subject, 0)
+
+    def set(self, subject: str, until: float):
+        with self._lock:
+            self._until[subject] = until
+            if len(self._until) > self.maxsize:
+                now = time.time()
+                self._until = {key: value for key, value in self._until.items() if value > now}
+
+
+class SharedRecentWriters:
+    """
+    The recent writers in a store shared by every worker, such as Redis
+    :param client: Any object with the get and set(ex=) methods of a redis.Redis client
+    """
+
+    def __init__(self, client):
+        self.client = client
+
+    @classmethod
+    def from_url(cls, url):
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError('The redis package is needed to share the recent writers: pip install redis')
+
+        return cls(redis.Redis.from_url(url))
+
+    @staticmethod
+    def key(subject):
+        return f'casting:read_primary:{subject}'
+
+    def get(self, subject: str):
+        return float(self.client.get(self.key(subject)) or 0)
+
+    def set(self, subject: str, until: float):
+        self.client.set(self.key(subject), str(until), ex=max(int(until - time.time()) + 1, 1))
+
+
+def create_recent_writers(setting):
+    """
+    :param setting: 'memory', a redis:// URL, or a store object
+    :return:
+    """
+    if setting == 'memory':
+        return RecentWriters()
+    if isinstance(setting, str):
+        return SharedRecentWriters.from_url(setting)
+
+    return setting
+
+
+class ReplicaRouter:
+    """
+    Picks replicas round-robin, leaving out those that recently failed
+    """
+
+    def __init__(self, db, app, bind_keys, retry=DATABASE_REPLICA_RETRY):
+        self.db = db
+        self.app = app
+        self.bind_keys = bind_keys
+        self.retry = retry
+        self._cycle = itertools.cycle(bind_keys)
+        self._lock = threading.Lock()
+        self._down_until = {}
+        self._engines = {}
+
+    def engine(self, bind_key):
+        engine = self._engines.get(bind_key)
+        if engine is None:
+            engine = self.db.get_engine(self.app, bind=bind_key)
+
+            @event.listens_for(engine, 'handle_error')
+            def handle_error(context):
+                # No connection means that the replica could not be connected to at all, which is not
+                # classified as a disconnect
+                if context.is_disconnect or context.connection is None:
+                    self.mark_down(bind_key)
+                    if has_request_context():
+                        g.db_replica_failed = True
+
+            self._engines[bind_key] = engine
+        return engine
+
+    def mark_down(self, bind_key):
+        with self._lock:
+            self._down_until[bind_key] = time.monotonic() + self.retry
+
+    def is_healthy(self, bind_key):
+        """
+        Whether a replica can be used, checking a replica that failed once its retry time has passed
+        :param bind_key:
+        :return:
+        """
+        down_until = self._down_until.get(bind_key)
+        if down_until is None:
+            return True
+        if time.monotonic() < down_until:
+            return False
+
+        try:
+            with self.engine(bind_key).connect() as connection:
+                connection.execute(text('SELECT 1'))
+        except Exception:
+            self.mark_down(bind_key)
+            return False
+
+        with self._lock:
+            self._down_until.pop(bind_key, None)
+        return True
+
+    def choose(self):
+        """
+        :return: The engine of the next healthy replica, or None if they are all down
+        """
+        for _ in range(len(self.bind_keys)):
+            with self._lock:
+                bind_key = next(self._cycle)
+            if self.is_healthy(bind_key):
+                return self.engine(bind_key)
+
+        return None
+
+
+def setup_replicas(app, db, replica_paths=None, recent_writers=None):
+    """
+    Register the replicas as binds of the app
+    :param app:
+    :param db:
+    :param replica_paths: Database URLs of the replicas. Read from the comma separated DATABASE_REPLICA_URLS
+    env variable if not given.
+    :param recent_writers: Where to remember the clients that wrote, see create_recent_writers(). Read from
+    DATABASE_PRIMARY_READ_STORE if not given.
+    :return: The ReplicaRouter, or None if there are no replicas
+    """
+    if replica_paths is None:
+        replica_paths = [path.strip() for path in os.environ.get('DATABASE_REPLICA_URLS', '').split(',')
+                         if path.strip()]
+    if not replica_paths:
+        return None
+
+    binds = {f'replica_{index}': path for index, path in enumerate(replica_paths)}
+    app.config['SQLALCHEMY_BINDS'] = {**app.config.get('SQLALCHEMY_BINDS', {}), **binds}
+    router = ReplicaRouter(db, app, list(binds))
+    app.extensions['replicas'] = router
+    app.extensions['recent_writers'] = create_recent_writers(recent_writers or DATABASE_PRIMARY_READ_STORE)
+    app.after_request(remember_write)
+
+    return router
+
+
+def read_replica():
+    """
+    The replica engine for the current request: chosen once per request, and only on read-only endpoints
+    that have not written anything and whose client has not written recently
+    :return: The engine, or None to use the primary
+    """
+    if not has_request_context() or not g.get('db_read_only') or g.get('db_wrote'):
+        return None
+
+    if 'db_replica' not in g:
+        router = current_app.extensions.get('replicas')
+        g.db_replica = router.choose() if router is not None else None
+
+    return g.db_replica
+
+
+def token_subject():
+    """
+    :return: The subject of the request's verified token, or None
+    """
+    verified = g.get('verified_token')
+    return verified.payload.get('sub') if verified is not None else None
+
+
+def primary_read_until():
+    """
+    Until when the client's reads go to the primary, the latest of what its token's subject, the
+    Read-Primary-Until header and the cookie tell
+    :return: A time.time() timestamp
+    """
+    until = [0.0]
+    for value in (request.headers.get(PRIMARY_READ_HEADER), request.cookies.get(PRIMARY_READ_COOKIE)):
+        try:
+            until.append(float(value or 0))
+        except ValueError:
+            pass
+
+    subject = token_subject()
+    if subject is not None:
+        try:
+            until.append(current_app.extensions['recent_writers'].get(subject))
+        except Exception:
+            log_exception('Could not read the recent writers')
+
+    return max(until)
+
+
+def read_only(f):
+    """
+    Mark an endpoint whose reads can be served by a replica
+    """
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        g.db_read_only = 'replicas' in current_app.extensions and primary_read_until() <= time.time()
+        try:
+            response = f(*args, **kwargs)
+        except Exception:
+            if not g.get('db_replica_failed'):
+                raise
+        else:
+            if not g.get('db_replica_failed'):
+                return response
+
+        # The replica went down during the request. It is left out from now on, and the reads are done again
+        # on the primary.
+        logger.warning('A replica failed in %s %s, reading from the primary instead', request.method, request.path)
+        g.pop('db_replica_failed')
+        g.db_replica = None
+        current_app.extensions['sqlalchemy'].db.session.rollback()
+        return f(*args, **kwargs)
+
+    return wrapper
+
+
+def remember_write(response):
+    """
+    After a request that committed a write, have the client read from the primary for a while. Token
+    subjects are remembered on the server, since API clients rarely keep cookies.
+    """
+    if g.get('db_committed'):
+        until = time.time() + DATABASE_PRIMARY_READ_WINDOW
+        subject = token_subject()
+        if subject is not None:
+            try:
+                current_app.extensions['recent_writers'].set(subject, until)
+            except Exception:
+                log_exception('Could not remember the recent writer')
+
+        response.headers[PRIMARY_READ_HEADER] = str(until)
+        response.set_cookie(PRIMARY_READ_COOKIE, str(until), max_age=DATABASE_PRIMARY_READ_WINDOW, httponly=True)
+    return response
+
+
+class RoutingSession(SignallingSession):
+    """
+    A session that sends the reads of read-only endpoints to a replica. Flushes, and every statement after
+    one, go to the primary.
+    """
+
+    def get_bind(self, mapper=None, clause=None):
+        if not self._flushing:
+            replica = read_replica()
+            if replica is not None:
+                return replica
+
+        return super().get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+def track_writes(session):
+    """
+    Listen to the sessions so that reads after a write in the same request stay on the primary
+    """
+    @event.listens_for(session, 'after_flush')
+    def after_flush(session, flush_context):
+        if has_request_context():
+            g.db_wrote = True
+
+
+def committed_write(tables):
+    """
+    A table change listener that has the client told to keep reading from the primary
+    """
+    if has_request_context():
+        g.db_committed = True
@@ -0,0 +1,167 @@
+"""
+Typeahead search over actor names and movie titles, for GET /search
+"""
+import os
+import re
+import threading
+
+from flask import current_app
+from sqlalchemy import text
+
+from caching import request_table_versions
+from models import db, Actors, Movies
+
+# Queries shorter than this match too much to be useful, and get no results
+SEARCH_MIN_LENGTH = int(os.environ.get('SEARCH_MIN_LENGTH', 2))
+# Milliseconds a search query may run on PostgreSQL before it is cancelled
+SEARCH_TIMEOUT = int(os.environ.get('SEARCH_TIMEOUT', 250))
+SEARCH_PAGE_SIZE = int(os.environ.get('SEARCH_PAGE_SIZE', 10))
+MAX_SEARCH_PAGE_SIZE = int(os.environ.get('MAX_SEARCH_PAGE_SIZE', 50))
+# Share of the query's trigrams a name or title must contain. The default of pg_trgm's
+# word_similarity_threshold, so that both backends match the same rows.
+SEARCH_THRESHOLD = 0.6
+
+# The searched column of each type of result
+SEARCH_COLUMNS = (
+    ('actor', Actors, 'name'),
+    ('movie', Movies, 'title'),
+)
+
+
+def escape_like(value: str):
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def trigram_search(q: str, limit: int, offset: int):
+    """
+    Search with the pg_trgm trigram indexes. Names and titles that start with the query rank first, then
+    the rest by word similarity.
+    :param q:
+    :param limit:
+    :param offset:
+    :return: (type, id, text, rank) rows
+    """
+    selects = [
+        f"SELECT '{kind}' AS type, id, {column} AS text, "
+        f"CAST({column} ILIKE :prefix AS INTEGER) + word_similarity(:q, {column}) AS rank "
+        f"FROM {model.__tablename__} WHERE :q <% {column} OR {column} ILIKE :prefix"
+        for kind, model, column in SEARCH_COLUMNS
+    ]
+    statement = text(' UNION ALL '.join(selects) + ' ORDER BY rank DESC, type, id LIMIT :limit OFFSET :offset')
+
+    # Only lasts until the end of the request's transaction
+    db.session.execute(text(f'SET LOCAL statement_timeout = {SEARCH_TIMEOUT:d}'))
+    return db.session.execute(statement, {
+        'q': q,
+        'prefix': escape_like(q) + '%',
+        'limit': limit,
+        'offset': offset
+    }).fetchall()
+
+
+def trigrams(value: str):
+    """
+    The trigrams of a string, as pg_trgm extracts them: from each lower case alphanumeric word, padded with
+    two spaces in front and one behind
+    :param value:
+    :return: A set of trigrams
+    """
+    grams = set()
+    for word in re.findall(r'[^\W_]+', value.lower()):
+        word = f'  {word} '
+        grams.update(word[i:i + 3] for i in range(len(word) - 2))
+
+    return grams
+
+
+class TrigramIndex:
+    """
+    An in-process trigram index of the names and titles, for databases without pg_trgm such as SQLite.
+    It ranks results like trigram_search(), with the share of the query's trigrams found in a name or title
+    standing in for word_similarity().
+    """
+
+    def __init__(self, rows):
+        """
+        :param rows: (type, id, text) tuples
+        """
+        self.texts = {}
+        self.postings = {}
+        for kind, entity_id, value in rows:
+            self.texts[(kind, entity_id)] = value
+            for gram in trigrams(value):
+                self.postings.setdefault(gram, set()).add((kind, entity_id))
+
+    @classmethod
+    def build(cls):
+        return cls(
+            (kind, entity_id, value)
+            for kind, model, column in SEARCH_COLUMNS
+            for entity_id, value in db.session.query(model.id, getattr(model, column))
+        )
+
+    def search(self, q: str, limit: int, offset: int):
+        query_grams = trigrams(q)
+        if not query_grams:
+            return []
+
+        prefix = q.lower()
+        candidates = set()
+        for gram in query_grams:
+            candidates.update(self.postings.get(gram, ()))
+
+        results = []
+        for kind, entity_id in candidates:
+            value = self.texts[(kind, entity_id)]
+            similarity = len(query_grams & trigrams(value)) / len(query_grams)
+            is_prefix = value.lower().startswith(prefix)
+            if similarity >= SEARCH_THRESHOLD or is_prefix:
+                results.append((kind, entity_id, value, int(is_prefix) + similarity))
+
+        results.sort(key=lambda result: (-result[3], result[0], result[1]))
+        return results[offset:offset + limit]
+
+
+_index_lock = threading.Lock()
+
+
+def fallback_index():
+    """
+    The app's TrigramIndex, rebuilt whenever the actors or movies tables have changed
+    :return:
+    """
+    versions = request_table_versions()
+    key = tuple(versions[model.__tablename__][0] for _, model, _ in SEARCH_COLUMNS)
+
+    with _index_lock:
+        built_key, index = current_app.extensions.get('search_index', (None, None))
+        if built_key != key:
+            index = TrigramIndex.build()
+            current_app.extensions['search_index'] = (key, index)
+
+    return index
+
+
+def search(q: str, limit: int = SEARCH_PAGE_SIZE, offset: int = 0):
+    """
+    Search actors and movies
+    :param q: The text typed so far
+    :param limit: The page size
+    :param offset: How many results to skip
+    :return: The ranked results as dicts
+    """
+    q = q.strip()
+    if len(q) < SEARCH_MIN_LENGTH:
+        return []
+
+    if db.session.get_bind().dialect.name == 'postgresql':
+        rows = trigram_search(q, limit, offset)
+    else:
+        rows = fallback_index().search(q, limit, offset)
+
+    return [{
+        'type': kind,
+        'id': entity_id,
+        'text': value,
+        'rank': round(float(rank), 3)
+    } for kind, entity_id, value, rank in rows]
@@ -1,21 +1,147 @@
+import asyncio
+import glob
+import gzip
 import os
 import json
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 import unittest
-from app import create_app
+from unittest import mock
 from urllib.request import urlopen
 from urllib.parse import urlencode
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
+import brotli
+import msgpack
+from werkzeug.exceptions import Unauthorized
 from werkzeug.wrappers import Response
+from sqlalchemy import event, create_engine
+from sqlalchemy.exc import DBAPIError, TimeoutError as SQLAlchemyTimeoutError
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import Pool
+
+import app as app_module
+from app import create_app
+import asgi
+from asgi import create_asgi_app
+import auth
+from auth import jwks_store, JWKSKeyStore, VerifiedTokenCache, VerifiedToken, check_permissions, all_of, any_of
+from caching import create_response_cache, SharedBackend
+from errors import JWKSUnavailable, PermissionsNotFound
+import idempotency
+import instrumentation
+from instrumentation import Metrics, RequestTiming, mark_process_dead, clear_metrics_dir
+from local_auth import LocalAuth
+import models
+from models import Actors, Movies, engine_options, InstrumentedQueuePool, idempotency_keys
+
+# Without Auth0 credentials the tests run offline, against SQLite and with tokens signed by a local key.
+# Set TEST_OFFLINE to true or false to choose.
+OFFLINE = os.environ.get('TEST_OFFLINE', str('AUTH0_CLIENT_ID' not in os.environ)).lower() in ('1', 'true', 'yes')
+TEMPORARY_DATABASE = None
+if OFFLINE:
+    if 'DATABASE_TEST_URL' not in os.environ:
+        TEMPORARY_DATABASE = os.path.join(tempfile.gettempdir(), f'casting_test_{os.getpid()}.db')
+        os.environ['DATABASE_TEST_URL'] = f'sqlite:///{TEMPORARY_DATABASE}'
+    os.environ.setdefault('AUTH0_DOMAIN', 'casting.local')
+    os.environ.setdefault('ALGORITHMS', 'RS256')
+    os.environ.setdefault('API_AUDIENCE', 'casting')
+
+
+def tearDownModule():
+    if TEMPORARY_DATABASE is not None and os.path.exists(TEMPORARY_DATABASE):
+        os.remove(TEMPORARY_DATABASE)
+
+
+def commits(test):
+    """
+    Mark a test whose writes other connections or threads must see. It runs on a freshly created schema
+    instead of in a transaction that is rolled back.
+    """
+    test.commits = True
+    return test
+
+
+def sqlite_connect(dbapi_connection, connection_record):
+    # Let SQLAlchemy emit BEGIN itself, so that pysqlite does not commit the savepoints away
+    dbapi_connection.isolation_level = None
+
+
+def sqlite_begin(connection):
+    connection.execute('BEGIN')
+
+
+def begin_savepoint(session, transaction, connection):
+    # Commits and rollbacks in the code under test end a savepoint, never the test's transaction
+    if transaction.parent is None and not transaction.nested:
+        session.begin_nested()
+
+
+def restart_savepoint(session, transaction):
+    if transaction.nested and transaction.parent is not None and not transaction.parent.nested:
+        session.expire_all()
+        session.begin_nested()
+
 
-from models import Actors, Movies
+class FakeRedis:
+    """
+    Local stand-in for the Redis client of a shared response cache
+    """
+
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def mget(self, keys):
+        return [self.data.get(key) for key in keys]
+
+    def set(self, key, value, ex=None):
+        self.data[key] = value
+
+    def incr(self, key):
+        self.data[key] = int(self.data.get(key, 0)) + 1
+        return self.data[key]
 
 
 class CastingTestCase(unittest.TestCase):
-    def setUp(self):
-        """Define test variables and initialize app."""
+    # Access tokens by user type, fetched or signed once per run
+    tokens = {}
+    local_auth = None
+    # On SQLite the schema is created once and each test runs in a transaction that is rolled back.
+    # Rolling back does not reset PostgreSQL sequences, so there every test gets a new schema.
+    transactional = False
+
+    @classmethod
+    def setUpClass(cls):
         if 'DATABASE_TEST_URL' not in os.environ:
             raise KeyError('Please set the DATABASE_TEST_URL env variable to the URL of an existing database')
 
+        if OFFLINE and CastingTestCase.local_auth is None:
+            CastingTestCase.local_auth = LocalAuth(os.environ['AUTH0_DOMAIN'], os.environ['API_AUDIENCE'])
+            jwks_store.load(CastingTestCase.local_auth.keys())
+
+        cls.transactional = make_url(os.environ['DATABASE_TEST_URL']).get_backend_name() == 'sqlite'
+        if cls.transactional:
+            app = create_app(test_config={'database_path': os.environ['DATABASE_TEST_URL']})
+            with app.app_context():
+                app.db.drop_all()
+                app.db.create_all()
+
+    @classmethod
+    def tearDownClass(cls):
+        if cls.transactional:
+            app = create_app(test_config={'database_path': os.environ['DATABASE_TEST_URL']})
+            with app.app_context():
+                app.db.drop_all()
+
+    def setUp(self):
+        """Define test variables and initialize app."""
         config = {
             'test_config': {
                 'database_path': os.environ['DATABASE_TEST_URL']
@@ -23,23 +149,83 @@ class CastingTestCase(unittest.TestCase):
         }
         self.app = create_app(**config)
         self.client = self.app.test_client
+        self.connection = None
 
-        # binds the app to the current context
-        with self.app.app_context():
-            self.app.db.create_all()
+        if self.transactional and not getattr(getattr(self, self._testMethodName), 'commits', False):
+            self.begin_transaction()
+        else:
+            # binds the app to the current context
+            with self.app.app_context():
+                self.app.db.create_all()
 
     def tearDown(self):
+        if self.connection is not None:
+            self.rollback_transaction()
+            return
+
         with self.app.app_context():
             self.app.db.drop_all()
+            if self.transactional:
+                self.app.db.create_all()
+
+    def begin_transaction(self):
+        """
+        Bind the session to a connection in a transaction that tearDown rolls back
+        :return:
+        """
+        engine = self.app.db.get_engine(self.app)
+        event.listen(engine, 'connect', sqlite_connect)
+        event.listen(engine, 'begin', sqlite_begin)
+        self.connection = engine.connect()
+        self.transaction = self.connection.begin()
+
+        session = self.app.db.session
+        session.remove()
+        self.session_options = dict(session.session_factory.kw)
+        session.configure(bind=self.connection, binds={})
+        event.listen(session, 'after_begin', begin_savepoint)
+        event.listen(session, 'after_transaction_end', restart_savepoint)
+
+    def rollback_transaction(self):
+        session = self.app.db.session
+        session.remove()
+        event.remove(session, 'after_begin', begin_savepoint)
+        event.remove(session, 'after_transaction_end', restart_savepoint)
+        session.session_factory.kw = self.session_options
+
+        self.transaction.rollback()
+        self.connection.close()
 
     @staticmethod
     def get_access_token(user=None):
         """
-        Get a user access token
+        Get a user access token, once per user type
         :param user: Either 'CD' or 'CA'
         :return:
         """
         user_type = user.upper()
+        if user_type not in CastingTestCase.tokens:
+            CastingTestCase.tokens[user_type] = CastingTestCase.request_access_token(user_type)
+
+        return CastingTestCase.tokens[user_type]
+
+    @staticmethod
+    def get_expired_token():
+        if OFFLINE:
+            return CastingTestCase.local_auth.mint_token('CA', expires_in=-60)
+
+        return os.environ['TEST_EXPIRED_TOKEN']
+
+    @staticmethod
+    def request_access_token(user_type):
+        """
+        Sign a token locally when offline, or get one from Auth0 for the test user
+        :param user_type:
+        :return:
+        """
+        if OFFLINE:
+            return CastingTestCase.local_auth.mint_token(user_type)
+
         data = {
             'grant_type': 'password',
             'username': os.environ[f"TEST_{user_type}_USER"],
@@ -145,7 +331,7 @@ class CastingTestCase(unittest.TestCase):
 
         for data_type in data:
             actors_response = self.user_get(user_type, data_type)
-            self.assertEqual(actors_response.json, {f'{data_type}': []})
+            self.assertEqual(actors_response.json, {f'{data_type}': [], 'next': None})
 
     def post(self, user_type):
         """"
@@ -319,10 +505,909 @@ class CastingTestCase(unittest.TestCase):
         movie1 = self.user_get('CA', 'movies')
         self.assertEqual(len(movie1.json['movies'][0]['actors']), 2)
 
+    def test_pagination(self):
+        for name in ['Carol', 'John', 'Jan']:
+            Actors(name=name, gender='f', age=30).insert()
+
+        first_page = self.client().get('/actors?limit=2', headers={
+            'Authorization': f'Bearer {CastingTestCase.get_access_token("CA")}'
+        })
+        self.assertEqual([actor['name'] for actor in first_page.json['actors']], ['Carol', 'John'])
+        self.assertEqual(first_page.json['next'], 2)
+
+        last_page = self.client().get(f'/actors?limit=2&after_id={first_page.json["next"]}', headers={
+            'Authorization': f'Bearer {CastingTestCase.get_access_token("CA")}'
+        })
+        self.assertEqual([actor['name'] for actor in last_page.json['actors']], ['Jan'])
+        self.assertIsNone(last_page.json['next'])
+
+        bad_limit = self.client().get('/actors?limit=zero', headers={
+            'Authorization': f'Bearer {CastingTestCase.get_access_token("CA")}'
+        })
+        self.assertEqual(bad_limit.json['code'], 422)
+
+    def test_filters(self):
+        with self.app.app_context():
+            for name, gender, age in [('Carol', 'f', 30), ('John', 'm', 20), ('Jan', 'f', 10), ('Ann', 'f', 30),
+                                      ('Beth', 'f', 40)]:
+                Actors(name=name, gender=gender, age=age).insert()
+            for title, release_date in [('The Way', '2019-05-01'), ('The Road', '2020-02-01'),
+                                        ('Ringer', '2020-08-01'), ('The_Ring', '2021-01-01')]:
+                Movies(title=title, release_date=datetime.fromisoformat(release_date)).insert()
+
+        token = CastingTestCase.get_access_token('CA')
+
+        def names(query):
+            response = self.client().get(f'/actors?{query}', headers={'Authorization': f'Bearer {token}'})
+            return [actor['name'] for actor in response.json['actors']], response.json['next']
+
+        def titles(query):
+            response = self.client().get(f'/movies?{query}', headers={'Authorization': f'Bearer {token}'})
+            return [movie['title'] for movie in response.json['movies']]
+
+        self.assertEqual(names('gender=f&age_min=20&age_max=35'), (['Carol', 'Ann'], None))
+        self.assertEqual(names('sort=-age&limit=10'), (['Beth', 'Carol', 'Ann', 'John', 'Jan'], None))
+
+        # Pages of a sorted collection continue after ties in the sort column
+        first_page, cursor = names('gender=f&sort=age&limit=2')
+        self.assertEqual(first_page, ['Jan', 'Carol'])
+        self.assertEqual(names(f'gender=f&sort=age&limit=2&after={cursor}'), (['Ann', 'Beth'], None))
+        self.assertEqual(names('gender=f&sort=age&limit=2&after_id=1'), (['Ann', 'Beth'], None))
+
+        # ...even once the last row of the previous page is deleted, since the cursor holds its age
+        with self.app.app_context():
+            Actors.query.get(1).delete()
+        self.assertEqual(names(f'gender=f&sort=age&limit=2&after={cursor}'), (['Ann', 'Beth'], None))
+        for query in ['sort=age&after_id=1', 'sort=age&after=garbage', f'sort=name&after={cursor}']:
+            response = self.client().get(f'/actors?{query}', headers={'Authorization': f'Bearer {token}'})
+            self.assertEqual(response.json['code'], 422)
+
+        response = self.client().get('/movies?release_after=2020-01-01&release_before=2021-01-01&sort=-release_date'
+                                     '&limit=1', headers={'Authorization': f'Bearer {token}'})
+        self.assertEqual([movie['title'] for movie in response.json['movies']], ['Ringer'])
+        self.assertEqual(titles(f'release_after=2020-01-01&sort=-release_date&after={response.json["next"]}'),
+                         ['The Road'])
+        self.assertEqual(titles(f'release_after=@{datetime(2020, 6, 1).timestamp():.0f}'), ['Ringer', 'The_Ring'])
+        self.assertEqual(titles('title_prefix=The_&fields=title'), ['The_Ring'])
+        self.assertEqual(titles('title_prefix=The%20&sort=-title'), ['The Way', 'The Road'])
+
+        for query in ['sort=gender', 'gender=x', 'age_min=old']:
+            response = self.client().get(f'/actors?{query}', headers={'Authorization': f'Bearer {token}'})
+            self.assertEqual(response.json['code'], 422)
+        for query in ['release_after=soon', 'release_after=2020', 'release_before=1584915791']:
+            response = self.client().get(f'/movies?{query}', headers={'Authorization': f'Bearer {token}'})
+            self.assertEqual(response.json['code'], 422)
+
+    def test_search(self):
+        with self.app.app_context():
+            for name in ['Carol Reed', 'Jan Carter', 'John Smith']:
+                Actors(name=name, gender='f', age=30).insert()
+            for title in ['Carrie', 'The Road']:
+                Movies(title=title, release_date=datetime.fromisoformat('2020-03-22 22:23:11')).insert()
+
+        token = CastingTestCase.get_access_token('CA')
+
+        def search(query):
+            return self.client().get(f'/search?{query}', headers={'Authorization': f'Bearer {token}'}).json
+
+        response = search('q=car')
+        self.assertEqual([(result['type'], result['text']) for result in response['results']],
+                         [('actor', 'Carol Reed'), ('movie', 'Carrie'), ('actor', 'Jan Carter')])
+        self.assertIsNone(response['next'])
+
+        first_page = search('q=car&limit=2')
+        self.assertEqual(len(first_page['results']), 2)
+        self.assertEqual(search(f'q=car&limit=2&offset={first_page["next"]}')['results'][0]['text'], 'Jan Carter')
+
+        self.assertEqual(search('q=roa')['results'][0]['text'], 'The Road')
+        self.assertEqual(search('q=c')['results'], [])
+        self.assertEqual(search('')['code'], 422)
+
+        # New rows are found straight away
+        self.user_post('CD', 'actors', {"name": "Cary Grant", "gender": "m", "age": 82})
+        self.assertIn('Cary Grant', [result['text'] for result in search('q=car')['results']])
+
+    def test_fragments(self):
+        """"
+        Within a request, an actor in several movies is formatted once, until it changes
+        """
+        with self.app.app_context():
+            actor = Actors(name='Carol', gender='f', age=30)
+            for title in ['The Way', 'The Road']:
+                Movies(title=title, release_date=datetime.fromisoformat('2020-03-22 22:23:11'),
+                       actors=[actor]).insert()
+
+            with self.app.test_request_context():
+                first, second = [movie.format() for movie in Movies.query.order_by(Movies.id)]
+                self.assertIs(first['actors'][0], second['actors'][0])
+                self.assertEqual(first['release_date'], 'Sun Mar 22 22:23:11 2020')
+
+                actor.name = 'Amanda'
+                self.app.db.session.commit()
+                self.assertEqual(Movies.query.get(1).format()['actors'][0]['name'], 'Amanda')
+
+    @commits
+    def test_idempotency_key(self):
+        token = CastingTestCase.get_access_token('CD')
+        actor = {"name": "Clarece", "gender": "f", "age": 88}
+
+        def post_actor(key, data, client=None):
+            return (client or self.client()).post('/actors', json=data, headers={
+                'Authorization': f'Bearer {token}',
+                'Idempotency-Key': key
+            })
+
+        first = post_actor('first', actor)
+        retry = post_actor('first', actor)
+        self.assertEqual(retry.status_code, 200)
+        self.assertEqual(retry.json, first.json)
+        self.assertEqual(retry.headers.get('Idempotent-Replayed'), 'true')
+        self.assertIn('Accept', retry.vary)
+
+        self.assertEqual(post_actor('first', {**actor, "age": 89}).json['code'], 422)
+
+        # Concurrent duplicates wait for the first request, then get its response
+        responses = []
+        threads = [
+            threading.Thread(target=lambda: responses.append(post_actor('second', actor, self.app.test_client())))
+            for _ in range(4)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len({response.json['actors'][0]['id'] for response in responses}), 1)
+
+        with self.app.app_context():
+            self.assertEqual(Actors.query.count(), 2)
+
+        # On PostgreSQL the lock on the key is released when the entities are committed, before the response is
+        # stored. A duplicate that gets in between waits for the response rather than failing.
+        def set_key(key, **values):
+            with self.app.app_context():
+                self.app.db.session.execute(idempotency_keys.update().where(idempotency_keys.c.key == key)
+                                            .values(**values))
+                self.app.db.session.commit()
+
+        stored = post_actor('third', actor)
+        set_key('third', body=None)
+        responses = []
+        duplicate = threading.Thread(target=lambda: responses.append(post_actor('third', actor, self.app.test_client())))
+        duplicate.start()
+        time.sleep(0.2)
+        set_key('third', body=json.dumps(stored.json))
+        duplicate.join()
+        self.assertEqual(responses[0].status_code, 200)
+        self.assertEqual(responses[0].json, stored.json)
+        self.assertEqual(responses[0].headers.get('Idempotent-Replayed'), 'true')
+
+        set_key('third', body=None)
+        with mock.patch.object(idempotency, 'IDEMPOTENCY_RESPONSE_WAIT', 0.1):
+            pending = post_actor('third', actor)
+        self.assertEqual(pending.status_code, 409)
+        self.assertEqual(pending.json['message'], 'idempotency_request_in_progress')
+        self.assertEqual(pending.headers.get('Retry-After'), '1')
+
+        # Long after the entities were created, the response is taken to be lost
+        set_key('third', expires_at=datetime.now(timezone.utc) + timedelta(seconds=idempotency.IDEMPOTENCY_KEY_TTL - 60))
+        self.assertEqual(post_actor('third', actor).json['message'], 'idempotency_outcome_unknown')
+
+        with self.app.app_context():
+            self.assertEqual(Actors.query.count(), 3)
+
+    def test_metrics(self):
+        self.app = create_app(test_config={
+            'database_path': os.environ['DATABASE_TEST_URL'],
+            'metrics': True
+        })
+        client = self.app.test_client()
+        self.add_cast(3)
+
+        response = client.get('/actors', headers={
+            'Authorization': f'Bearer {CastingTestCase.get_access_token("CA")}'
+        })
+        phases = {metric.split(';')[0] for metric in response.headers['Server-Timing'].split(', ')}
+        self.assertEqual(phases, {'auth', 'db', 'serialization', 'total'})
+
+        client.get('/actors')
+        metrics = client.get('/metrics').get_data(as_text=True)
+        self.assertIn('casting_requests_total{route="/actors",method="GET",status="200"} 1', metrics)
+        self.assertIn('casting_requests_total{route="/actors",method="GET",status="401"} 1', metrics)
+        self.assertIn('casting_request_duration_seconds_count{route="/actors",method="GET",phase="db"} 2', metrics)
+        self.assertNotIn('route="/metrics"', metrics)
+        self.assertIn('casting_jwks_lookups_total{result="hit"}', metrics)
+        self.assertIn('casting_token_cache_lookups_total{result="miss"}', metrics)
+        self.assertIn('casting_token_cache_size ', metrics)
+
+        queries = [line for line in metrics.splitlines() if line.startswith('casting_db_queries_total')]
+        self.assertGreater(int(queries[0].split()[-1]), 0)
+
+    def test_metrics_across_workers(self):
+        """"
+        Each worker writes its metrics to METRICS_DIR, and /metrics adds up the counters of all of them, those of
+        exited workers included, and reports the gauges of the live ones by pid
+        """
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+
+        def worker(pid, requests):
+            with mock.patch.object(instrumentation.os, 'getpid', return_value=pid):
+                metrics = Metrics(directory=directory)
+                metrics.add_collector(lambda: [
+                    ('things_total', 'counter', 'Things', [({'kind': 'a'}, requests)]),
+                    ('connections', 'gauge', 'Connections', [({}, pid % 100)])
+                ])
+                for _ in range(requests):
+                    metrics.observe('/actors', 'GET', 200, RequestTiming())
+                metrics.write_snapshot()
+                return metrics
+
+        worker(101, 2)
+        serving = worker(102, 3)
+        with mock.patch.object(instrumentation.os, 'getpid', return_value=102):
+            metrics = serving.render()
+        self.assertIn('casting_requests_total{route="/actors",method="GET",status="200"} 5', metrics)
+        self.assertIn('casting_request_duration_seconds_count{route="/actors",method="GET",phase="total"} 5', metrics)
+        self.assertIn('casting_things_total{kind="a"} 5', metrics)
+        self.assertIn('casting_connections{pid="101"} 1', metrics)
+        self.assertIn('casting_connections{pid="102"} 2', metrics)
+
+        # The counters of an exited worker are kept, its gauges dropped
+        mark_process_dead(101, directory)
+        mark_process_dead(101, directory)
+        with mock.patch.object(instrumentation.os, 'getpid', return_value=102):
+            metrics = serving.render()
+        self.assertIn('casting_requests_total{route="/actors",method="GET",status="200"} 5', metrics)
+        self.assertIn('casting_things_total{kind="a"} 5', metrics)
+        self.assertNotIn('pid="101"', metrics)
+
+        clear_metrics_dir(directory)
+        self.assertEqual(glob.glob(os.path.join(directory, '*.json')), [])
+
+    def count_queries(self, user_type, entity_type, headers=None, status=200):
+        """
+        Count the SQL statements run by a GET request
+        :return:
+        """
+        token = CastingTestCase.get_access_token(user_type)
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        with self.app.app_context():
+            engine = self.app.db.engine
+        event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            response = self.client().get(f'/{entity_type}', headers={
+                'Authorization': f'Bearer {token}',
+                **(headers or {})
+            })
+        finally:
+            event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+
+        self.assertEqual(response.status_code, status)
+        return len(statements)
+
+    def add_cast(self, count):
+        """
+        Add actors who each play in a movie of their own
+        :return:
+        """
+        with self.app.app_context():
+            for i in range(count):
+                movie = Movies(title=f'Movie {i}', release_date=datetime.fromisoformat('2020-03-22 22:23:11'))
+                Actors(name=f'Actor {i}', gender='m', age=30, movies=[movie]).insert()
+
+    def test_constant_query_count(self):
+        """"
+        Listing actors or movies takes the same number of queries however many rows there are
+        """
+        self.add_cast(2)
+        counts = {entity_type: self.count_queries('CA', entity_type) for entity_type in ['actors', 'movies']}
+
+        self.add_cast(8)
+        for entity_type in ['actors', 'movies']:
+            self.assertEqual(self.count_queries('CA', entity_type), counts[entity_type])
+
+    def test_stream(self):
+        """"
+        Streamed collections hold the same rows as a page that covers the whole table
+        """
+        self.add_cast(5)
+        for entity_type in ['actors', 'movies']:
+            page = self.client().get(f'/{entity_type}?limit=100', headers={
+                'Authorization': f'Bearer {CastingTestCase.get_access_token("CA")}'
+            })
+            streamed = self.client().get(f'/{entity_type}?stream=1', headers={
+                'Authorization': f'Bearer {CastingTestCase.get_access_token("CA")}'
+            })
+            self.assertTrue(streamed.is_streamed)
+            self.assertEqual(json.loads(streamed.get_data()), page.json)
+
+            streamed = self.client().get(f'/{entity_type}?stream=1&after_id=3', headers={
+                'Authorization': f'Bearer {CastingTestCase.get_access_token("CA")}'
+            })
+            self.assertEqual([entity['id'] for entity in json.loads(streamed.get_data())[entity_type]], [4, 5])
+
+    def test_content_negotiation(self):
+        """"
+        Responses are compressed and encoded as the client asks, errors included
+        """
+        self.add_cast(30)
+        headers = {
+            'Authorization': f'Bearer {CastingTestCase.get_access_token("CA")}'
+        }
+
+        plain = self.client().get('/movies', headers=headers)
+        compressed = self.client().get('/movies', headers={**headers, 'Accept-Encoding': 'gzip, deflate'})
+        self.assertIsNone(plain.content_encoding)
+        self.assertEqual(compressed.content_encoding, 'gzip')
+        self.assertIn('Accept-Encoding', compressed.vary)
+        self.assertLess(len(compressed.get_data()), len(plain.get_data()))
+        self.assertEqual(gzip.decompress(compressed.get_data()), plain.get_data())
+
+        # brotli is preferred when the client takes both
+        compressed = self.client().get('/movies', headers={**headers, 'Accept-Encoding': 'gzip, br'})
+        self.assertEqual(compressed.content_encoding, 'br')
+        self.assertEqual(brotli.decompress(compressed.get_data()), plain.get_data())
+
+        streamed = self.client().get('/movies?stream=1', headers={**headers, 'Accept-Encoding': 'gzip'})
+        self.assertEqual(json.loads(gzip.decompress(streamed.get_data())), plain.json)
+
+        # Too small to be worth compressing
+        error = self.client().get('/movies?limit=0', headers={**headers, 'Accept-Encoding': 'gzip'})
+        self.assertEqual(error.status_code, 422)
+        self.assertIsNone(error.content_encoding)
+
+        headers['Accept'] = 'application/msgpack'
+        encoded = self.client().get('/movies', headers=headers)
+        error = self.client().get('/movies?limit=0', headers=headers)
+        self.assertEqual(encoded.mimetype, 'application/msgpack')
+        self.assertIn('Accept', encoded.vary)
+        self.assertEqual(msgpack.unpackb(encoded.get_data()), plain.json)
+        self.assertEqual(error.mimetype, 'application/msgpack')
+        self.assertEqual(msgpack.unpackb(error.get_data())['code'], 422)
+
+    def test_sparse_fields(self):
+        self.add_cast(3)
+        headers = {
+            'Authorization': f'Bearer {CastingTestCase.get_access_token("CA")}'
+        }
+
+        actors_response = self.client().get('/actors?fields=id,name', headers=headers)
+        self.assertEqual(actors_response.json['actors'][0], {'id': 1, 'name': 'Actor 0'})
+
+        movies_response = self.client().get('/movies?fields=title&include=actors', headers=headers)
+        self.assertEqual(movies_response.json['movies'][0], {
+            'title': 'Movie 0',
+            'actors': [{'id': 1, 'name': 'Actor 0', 'gender': 'Male', 'age': 30}]
+        })
+
+        movies_response = self.client().get('/movies?include=', headers=headers)
+        self.assertNotIn('actors', movies_response.json['movies'][0])
+
+        # Without the association there is nothing to load besides the page itself
+        self.assertLess(self.count_queries('CA', 'actors?fields=id,name'), self.count_queries('CA', 'actors'))
+
+        bad_fields = self.client().get('/actors?fields=id,salary', headers=headers)
+        self.assertEqual(bad_fields.json['code'], 422)
+
+    def test_conditional_get(self):
+        """"
+        Unchanged collections are answered with 304 Not Modified until something is written
+        """
+        self.add_cast(2)
+        headers = {
+            'Authorization': f'Bearer {CastingTestCase.get_access_token("CA")}'
+        }
+
+        for entity_type in ['actors', 'movies']:
+            response = self.client().get(f'/{entity_type}', headers=headers)
+            etag = response.headers['ETag']
+            self.assertTrue(etag.startswith('W/'))
+
+            response = self.client().get(f'/{entity_type}', headers={**headers, 'If-None-Match': etag})
+            self.assertEqual(response.status_code, 304)
+            self.assertEqual(set(response.vary), {'Accept', 'Accept-Encoding'})
+
+            response = self.client().get(f'/{entity_type}?limit=1', headers={**headers, 'If-None-Match': etag})
+            self.assertEqual(response.status_code, 200)
+
+        etags = {
+            entity_type: self.client().get(f'/{entity_type}', headers=headers).headers['ETag']
+            for entity_type in ['actors', 'movies']
+        }
+        self.user_patch('CD', 'movies', 1, {"title": "The Little One"})
+        for entity_type in ['actors', 'movies']:
+            response = self.client().get(f'/{entity_type}', headers={**headers, 'If-None-Match': etags[entity_type]})
+            self.assertEqual(response.status_code, 200)
+
+        # Streamed collections are JSON whatever the client asks for, and so are their ETags
+        streamed = [self.client().get('/actors?stream=1', headers={**headers, 'Accept': accept})
+                    for accept in ['application/json', 'application/msgpack']]
+        self.assertEqual([response.mimetype for response in streamed], ['application/json'] * 2)
+        self.assertEqual(json.loads(streamed[1].get_data()), json.loads(streamed[0].get_data()))
+        self.assertEqual(streamed[0].headers['ETag'], streamed[1].headers['ETag'])
+        self.assertIn('Accept', streamed[1].vary)
+
+        # Only the version lookup runs for a 304
+        etag = self.client().get('/actors', headers=headers).headers['ETag']
+        self.assertEqual(self.count_queries('CA', 'actors', {'If-None-Match': etag}, status=304), 1)
+
+    def test_response_cache(self):
+        """"
+        Cached responses are served without querying the data again, and writes to either side of the
+        casting invalidate them
+        """
+        self.add_cast(2)
+        for backend, queries_per_hit in [('memory', 1), (SharedBackend(FakeRedis()), 0)]:
+            self.app.response_cache = create_response_cache(backend)
+
+            self.count_queries('CA', 'actors')
+            self.assertEqual(self.count_queries('CA', 'actors'), queries_per_hit)
+            self.assertEqual(self.app.response_cache.hits, 1)
+
+            title = f'Retitled {queries_per_hit}'
+            self.user_patch('CD', 'movies', 1, {"title": title})
+            actors_response = self.user_get('CA', 'actors')
+            self.assertEqual(actors_response.json['actors'][0]['movies'][0]['title'], title)
+
+            self.user_get('CA', 'movies')
+            self.user_post('CD', 'actors', {
+                "name": f'Cast {queries_per_hit}',
+                "gender": 'f',
+                "age": 40,
+                "movies": [2]
+            })
+            movies_response = self.user_get('CA', 'movies')
+            cast = [actor['name'] for actor in movies_response.json['movies'][1]['actors']]
+            self.assertIn(f'Cast {queries_per_hit}', cast)
+
+        self.app.response_cache = None
+
+    def test_bulk_create(self):
+        release_date = datetime.fromisoformat('2020-03-22 22:23:11').timestamp()
+        movies = [
+            {"title": 'The Way', "release_date": release_date},
+            {"title": '', "release_date": release_date},
+            {"title": 'The Road', "release_date": release_date}
+        ]
+
+        movies_response = self.user_post('EP', 'movies/bulk', {"movies": movies})
+        self.assertEqual(movies_response.status_code, 422)
+        self.assertEqual([error['index'] for error in movies_response.json['errors']], [1])
+        with self.app.app_context():
+            self.assertEqual(self.app.db.session.query(Movies).count(), 0)
+
+        movies_response = self.user_post('EP', 'movies/bulk', {"movies": movies, "atomic": False})
+        self.assertFalse(movies_response.json['success'])
+        self.assertEqual([movie['title'] for movie in movies_response.json['movies']], ['The Way', 'The Road'])
+        movie_ids = [movie['id'] for movie in movies_response.json['movies']]
+
+        actors_response = self.user_post('CD', 'actors/bulk', {"actors": [
+            {"name": 'Carol', "gender": 'f', "age": 30, "movies": movie_ids},
+            {"name": 'John', "gender": 'm', "age": 20, "movies": [movie_ids[0]]}
+        ]})
+        self.assertTrue(actors_response.json['success'])
+        self.assertEqual(len(actors_response.json['actors'][0]['movies']), 2)
+
+        actors_response = self.user_post('CD', 'actors/bulk', {"actors": [
+            {"name": 'Jan', "gender": 'f', "age": 10, "movies": [100]}
+        ]})
+        self.assertEqual(actors_response.json['errors'][0]['description'], 'movies not found: 100')
+
+        movies_response = self.user_get('CA', 'movies')
+        self.assertEqual([len(movie['actors']) for movie in movies_response.json['movies']], [2, 1])
+
+        self.assertEqual(self.user_post('CA', 'actors/bulk', {"actors": []}).json['code'], 401)
+
+        # Entities that the database refuses are reported by their position too
+        actors = [{"name": 'Old', "gender": 'f', "age": 30}, {"name": 'Older', "gender": 'f', "age": 200}]
+        actors_response = self.user_post('CD', 'actors/bulk', {"actors": actors, "atomic": False})
+        self.assertEqual([error['index'] for error in actors_response.json['errors']], [1])
+        with mock.patch.object(app_module, 'MAX_ACTOR_AGE', 1000):
+            actors_response = self.user_post('CD', 'actors/bulk', {"actors": actors})
+            self.assertEqual(actors_response.status_code, 422)
+            self.assertEqual(actors_response.json['errors'], [
+                {'index': 1, 'description': 'The database refused the entity'}
+            ])
+
+            actors_response = self.user_post('CD', 'actors/bulk', {"actors": actors, "atomic": False})
+            self.assertEqual([actor['name'] for actor in actors_response.json['actors']], ['Old'])
+            self.assertEqual([error['index'] for error in actors_response.json['errors']], [1])
+        with self.app.app_context():
+            self.assertEqual(self.app.db.session.query(Actors).filter(Actors.name == 'Old').count(), 2)
+
+    def test_links(self):
+        """"
+        Casts can be changed one actor at a time, from either side
+        """
+        self.add_cast(2)
+        token = CastingTestCase.get_access_token('CD')
+
+        response = self.client().post('/movies/1/actors', json={"actors": [1, 2]}, headers={
+            'Authorization': f'Bearer {token}'
+        })
+        self.assertEqual(response.json, {'success': True, 'id': 1, 'added': [2]})
+
+        response = self.client().delete('/actors/1/movies', json={"movies": [1, 2]}, headers={
+            'Authorization': f'Bearer {token}'
+        })
+        self.assertEqual(response.json, {'success': True, 'id': 1, 'removed': [1]})
+
+        movies_response = self.user_get('CA', 'movies')
+        self.assertEqual([[actor['id'] for actor in movie['actors']] for movie in movies_response.json['movies']],
+                         [[2], [2]])
+
+        response = self.client().post('/actors/1/movies', json={"movies": [100]}, headers={
+            'Authorization': f'Bearer {token}'
+        })
+        self.assertEqual(response.json['code'], 422)
+
+        response = self.client().post('/movies/100/actors', json={"actors": [1]}, headers={
+            'Authorization': f'Bearer {token}'
+        })
+        self.assertEqual(response.json['code'], 404)
+
+        response = self.client().post('/movies/1/actors', json={"actors": [1]}, headers={
+            'Authorization': f'Bearer {CastingTestCase.get_access_token("CA")}'
+        })
+        self.assertEqual(response.json['code'], 401)
+
+    @commits
+    def test_asgi(self):
+        """"
+        The ASGI mode serves the same responses, from bodies that arrive in parts and to streamed responses
+        """
+        application = create_asgi_app(self.app, threads=2, refresh_keys=False)
+
+        def call(method, path, query=b'', body_parts=(b'',), user_type='EP'):
+            messages = [{'type': 'http.request', 'body': part, 'more_body': index < len(body_parts) - 1}
+                        for index, part in enumerate(body_parts)]
+            sent = []
+
+            async def receive():
+                return messages.pop(0) if messages else {'type': 'http.disconnect'}
+
+            async def send(message):
+                sent.append(message)
+
+            asyncio.run(application({
+                'type': 'http', 'http_version': '1.1', 'method': method, 'path': path, 'query_string': query,
+                'headers': [(b'authorization', f'Bearer {CastingTestCase.get_access_token(user_type)}'.encode()),
+                            (b'content-type', b'application/json')]
+            }, receive, send))
+            return sent[0]['status'], json.loads(b''.join(message.get('body', b'') for message in sent[1:]))
+
+        body = json.dumps({"name": "Clarece", "gender": "f", "age": 88}).encode()
+        status, response = call('POST', '/actors', body_parts=(body[:10], body[10:]))
+        self.assertEqual(status, 200)
+        self.assertEqual(response['actors'][0]['name'], 'Clarece')
+
+        self.add_cast(3)
+        status, response = call('GET', '/actors', b'stream=true', user_type='CA')
+        self.assertEqual(status, 200)
+        self.assertEqual(response, self.user_get('CA', 'actors').json)
+
+        status, response = call('DELETE', '/actors/100')
+        self.assertEqual((status, response['code']), (404, 404))
+        application.executor.shutdown()
+
+    def test_asgi_key_refresh(self):
+        """"
+        The background refresh fetches the keys again at 80% of the TTL, and soon after a failed fetch, before
+        requests would find the stale keys expired and fetch them themselves
+        """
+        jwks = {'one': {'kid': 'one'}}
+
+        def fetch():
+            if not jwks:
+                raise OSError('JWKS unreachable')
+            return dict(jwks)
+
+        store = JWKSKeyStore(ttl=600, min_refresh_interval=10)
+        store.fetch = fetch
+        application = create_asgi_app(self.app, threads=1)
+        with mock.patch.object(asgi, 'jwks_store', store):
+            self.assertAlmostEqual(asyncio.run(application.fetch_keys()), 480, delta=1)
+            jwks.clear()
+            self.assertAlmostEqual(asyncio.run(application.fetch_keys()), 8, delta=1)
+            self.assertLess(asyncio.run(application.fetch_keys()) + 1, store.expires_in())
+            jwks['one'] = {'kid': 'one'}
+            self.assertAlmostEqual(asyncio.run(application.fetch_keys()), 480, delta=1)
+
+        # Without any keys, the fetch is retried as soon
+        with mock.patch.object(asgi, 'jwks_store', JWKSKeyStore(ttl=600, min_refresh_interval=10)) as empty:
+            empty.fetch = fetch
+            jwks.clear()
+            self.assertAlmostEqual(asyncio.run(application.fetch_keys()), 8, delta=1)
+        application.executor.shutdown()
+
+    def test_app_factory(self):
+        """"
+        Importing the app reads no settings and builds nothing, and warming up opens a connection ahead of
+        the first request
+        """
+        environ = {name: value for name, value in os.environ.items() if name != 'DATABASE_URL'}
+        imported = subprocess.run(
+            [sys.executable, '-c', "import sys, app; print('flask_migrate' in sys.modules, 'APP' in vars(app))"],
+            env=environ, capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__))
+        )
+        self.assertEqual(imported.stdout.split(), ['False', 'False'], imported.stderr)
+
+        connections = []
+
+        def connect(dbapi_connection, connection_record):
+            connections.append(dbapi_connection)
+        event.listen(Pool, 'connect', connect)
+        try:
+            create_app(test_config={'database_path': os.environ['DATABASE_TEST_URL'], 'warm_up': True})
+        finally:
+            event.remove(Pool, 'connect', connect)
+        self.assertGreater(len(connections), 0)
+
+    def test_engine_options(self):
+        options = engine_options('postgres://postgres@localhost/casting', pool_size=5, max_overflow=0,
+                                 pool_pre_ping=True, statement_timeout=3000)
+        self.assertEqual(options, {
+            'poolclass': InstrumentedQueuePool,
+            'pool_size': 5,
+            'max_overflow': 0,
+            'pool_pre_ping': True,
+            'connect_args': {'options': '-c statement_timeout=3000'}
+        })
+
+        # SQLite pools are not sized and have no statement timeout
+        self.assertEqual(engine_options('sqlite://', pool_size=5, pool_recycle=60, statement_timeout=3000),
+                         {'pool_recycle': 60})
+
+    def test_pool_metrics(self):
+        """"
+        The pool stats of every engine are on /metrics, and only checkouts that ran out of time count as timeouts
+        """
+        pool = create_engine('sqlite://', poolclass=InstrumentedQueuePool, pool_size=1, max_overflow=0,
+                             pool_timeout=0.05)
+        broken = create_engine('sqlite://', poolclass=InstrumentedQueuePool,
+                               creator=mock.Mock(side_effect=sqlite3.OperationalError('unreachable')))
+        connection = pool.connect()
+        with self.assertRaises(SQLAlchemyTimeoutError):
+            pool.connect()
+        with self.assertRaises(DBAPIError):
+            broken.connect()
+
+        app = create_app(test_config={'database_path': os.environ['DATABASE_TEST_URL'], 'metrics': True})
+        with mock.patch.object(models, 'named_engines', return_value=[('primary', pool), ('replica_0', broken)]):
+            metrics = app.test_client().get('/metrics').get_data(as_text=True)
+        connection.close()
+        pool.dispose()
+
+        self.assertIn('casting_db_pool_checked_out{engine="primary"} 1', metrics)
+        self.assertIn('casting_db_pool_checkouts_total{engine="primary"} 2', metrics)
+        self.assertIn('casting_db_pool_timeouts_total{engine="primary"} 1', metrics)
+        self.assertIn('casting_db_pool_checkouts_total{engine="replica_0"} 1', metrics)
+        self.assertIn('casting_db_pool_timeouts_total{engine="replica_0"} 0', metrics)
+
+    @commits
+    def test_read_replicas(self):
+        """"
+        Reads go to the replica, except for a client that has just written
+        """
+        self.app = create_app(test_config={
+            'database_path': os.environ['DATABASE_TEST_URL'],
+            'replica_paths': [os.environ['DATABASE_TEST_URL']]
+        })
+        with self.app.app_context():
+            engines = {
+                'primary': self.app.db.get_engine(self.app),
+                'replica': self.app.db.get_engine(self.app, bind='replica_0')
+            }
+
+        statements = {name: [] for name in engines}
+        listeners = {
+            name: lambda conn, cursor, statement, *args, name=name: statements[name].append(statement)
+            for name in engines
+        }
+        for name, engine in engines.items():
+            event.listen(engine, 'before_cursor_execute', listeners[name])
+
+        # Like API clients, which keep no cookies
+        client = self.app.test_client(use_cookies=False)
+        try:
+            client.get('/actors', headers={'Authorization': f'Bearer {CastingTestCase.get_access_token("CD")}'})
+            self.assertEqual(len(statements['primary']), 0)
+            self.assertGreater(len(statements['replica']), 0)
+
+            created = client.post('/actors', json={"name": "Clarece", "gender": "f", "age": 88}, headers={
+                'Authorization': f'Bearer {CastingTestCase.get_access_token("CD")}'
+            })
+            statements['replica'].clear()
+            actors_response = client.get('/actors', headers={
+                'Authorization': f'Bearer {CastingTestCase.get_access_token("CD")}'
+            })
+            self.assertEqual(len(actors_response.json['actors']), 1)
+            self.assertEqual(len(statements['replica']), 0)
+
+            # Other users still read from the replica, unless they send the header back
+            client.get('/actors', headers={'Authorization': f'Bearer {CastingTestCase.get_access_token("CA")}'})
+            self.assertGreater(len(statements['replica']), 0)
+            statements['replica'].clear()
+            client.get('/actors', headers={
+                'Authorization': f'Bearer {CastingTestCase.get_access_token("CA")}',
+                'Read-Primary-Until': created.headers['Read-Primary-Until']
+            })
+            self.assertEqual(len(statements['replica']), 0)
+        finally:
+            for name, engine in engines.items():
+                event.remove(engine, 'before_cursor_execute', listeners[name])
+
+    def test_replica_down(self):
+        """"
+        A replica that cannot be connected to is left out, and the read that found it down is done on the primary
+        """
+        self.app = create_app(test_config={
+            'database_path': os.environ['DATABASE_TEST_URL'],
+            'replica_paths': [f'sqlite:///{os.path.join(tempfile.mkdtemp(), "missing", "replica.db")}']
+        })
+        self.add_cast(2)
+        router = self.app.extensions['replicas']
+        client = self.app.test_client(use_cookies=False)
+        headers = {'Authorization': f'Bearer {CastingTestCase.get_access_token("CA")}'}
+
+        responses = [client.get('/actors', headers=headers) for _ in range(4)]
+        self.assertEqual([response.status_code for response in responses], [200] * 4)
+        self.assertEqual(len(responses[0].json['actors']), 2)
+        self.assertIn('replica_0', router._down_until)
+        self.assertFalse(router.is_healthy('replica_0'))
+
+    def explain(self, statement, **params):
+        """
+        Get the query plan of a statement as text
+        :return:
+        """
+        with self.app.app_context():
+            session = self.app.db.session
+            if session.bind.dialect.name == 'postgresql':
+                # The test tables are so small that a sequential scan would always win
+                session.execute('SET LOCAL enable_seqscan = off')
+                rows = session.execute(f'EXPLAIN {statement}', params)
+            else:
+                rows = session.execute(f'EXPLAIN QUERY PLAN {statement}', params)
+            plan = '\n'.join(str(row[-1]) for row in rows)
+            session.rollback()
+
+        return plan
+
+    def test_indexes(self):
+        """"
+        The planner uses the indexes for movie lookups in actors_movies and the filter and sort columns
+        """
+        self.add_cast(20)
+        plans = {
+            'ix_actors_movies_movie_id': self.explain('SELECT actor_id FROM actors_movies WHERE movie_id = :id', id=3),
+            'ix_actors_name': self.explain('SELECT id FROM actors WHERE name = :name', name='Actor 3'),
+            'ix_movies_title': self.explain('SELECT id FROM movies WHERE title = :title', title='Movie 3'),
+            'ix_movies_release_date': self.explain('SELECT id FROM movies ORDER BY release_date LIMIT 5')
+        }
+        with self.app.app_context():
+            if self.app.db.engine.dialect.name == 'postgresql':
+                plans['ix_movies_title_pattern'] = self.explain("SELECT id FROM movies WHERE title LIKE :prefix",
+                                                                prefix='Movie 1%')
+        for index, plan in plans.items():
+            self.assertIn(index, plan)
+
     def test_expired_token(self):
-        movies_response = self.user_get('CA', 'movies', True, os.environ['TEST_EXPIRED_TOKEN'])
+        movies_response = self.user_get('CA', 'movies', True, CastingTestCase.get_expired_token())
         self.assertEqual(movies_response.json['message'], 'token_expired')
 
+    def test_jwks_key_store(self):
+        """"
+        Keys are fetched again after the TTL and for unknown kids, stale keys are served when a fetch fails, and
+        concurrent lookups share one fetch, failed or not
+        """
+        fetches = []
+        jwks = {'one': {'kid': 'one'}}
+
+        def fetch():
+            fetches.append(time.monotonic())
+            time.sleep(0.1)
+            if not jwks:
+                raise OSError('JWKS unreachable')
+            return dict(jwks)
+
+        store = JWKSKeyStore(ttl=60, min_refresh_interval=0)
+        store.fetch = fetch
+        self.assertEqual(store.get_key('one'), {'kid': 'one'})
+        self.assertEqual(store.get_key('one'), {'kid': 'one'})
+        self.assertEqual(len(fetches), 1)
+
+        jwks['two'] = {'kid': 'two'}
+        self.assertEqual(store.get_key('two'), {'kid': 'two'})
+        self.assertEqual(len(fetches), 2)
+
+        def look_up_concurrently():
+            results = []
+            threads = [threading.Thread(target=lambda: results.append(store.get_key('one'))) for _ in range(5)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            return results
+
+        store.min_refresh_interval = 60
+        for outcome in ['failure', 'success']:
+            if outcome == 'failure':
+                jwks.clear()
+            else:
+                jwks['one'] = {'kid': 'one'}
+            # Past the TTL
+            store._expires_at = 0
+            fetched = len(fetches)
+            self.assertEqual(look_up_concurrently(), [{'kid': 'one'}] * 5)
+            self.assertEqual(len(fetches), fetched + 1, outcome)
+
+        stats = store.stats()
+        self.assertEqual((stats['refreshes'], stats['refresh_failures']), (3, 1))
+
+        # Nothing to fall back on
+        jwks.clear()
+        store = JWKSKeyStore()
+        store.fetch = fetch
+        with self.assertRaises(JWKSUnavailable):
+            store.get_key('one')
+
+    def test_token_cache(self):
+        """"
+        Verified tokens skip verification until they expire or are evicted
+        """
+        headers = {
+            'Authorization': f'Bearer {CastingTestCase.get_access_token("CA")}'
+        }
+        for size, decodes in [(8, 1), (0, 3)]:
+            with mock.patch.object(auth, 'token_cache', VerifiedTokenCache(size)), \
+                    mock.patch.object(auth.jwt, 'decode', wraps=auth.jwt.decode) as decode:
+                for _ in range(3):
+                    self.assertEqual(self.client().get('/actors', headers=headers).status_code, 200)
+                self.assertEqual(decode.call_count, decodes)
+
+        cache = VerifiedTokenCache(2)
+        for token in ['a', 'b']:
+            cache.put(token, VerifiedToken({'exp': time.time() + 60}))
+        cache.get('a')
+        cache.put('c', VerifiedToken({'exp': time.time() + 60}))
+        # The least recently used token goes
+        self.assertIsNone(cache.get('b'))
+        self.assertIsNotNone(cache.get('a'))
+        self.assertIsNotNone(cache.get('c'))
+
+        cache.put('expiring', VerifiedToken({'exp': time.time() + 0.1}))
+        self.assertIsNotNone(cache.get('expiring'))
+        time.sleep(0.15)
+        self.assertIsNone(cache.get('expiring'))
+        self.assertEqual(cache.stats()['evictions'], 2)
+        self.assertEqual(cache.stats()['expirations'], 1)
+
+    def test_permission_requirements(self):
+        reader = VerifiedToken({'permissions': ['get:actors', 'get:movies']})
+        actors_reader = VerifiedToken({'permissions': ['get:actors']})
+
+        self.assertTrue(check_permissions(all_of('get:actors', 'get:movies'), reader))
+        self.assertTrue(check_permissions(any_of('get:actors', 'post:actors'), actors_reader))
+        for requirement in [all_of('get:actors', 'get:movies'), any_of('post:actors', 'post:movies')]:
+            with self.assertRaises(Unauthorized):
+                check_permissions(requirement, actors_reader)
+
+        # A token without a permissions claim is refused, whatever the requirement
+        for requirement in [all_of(), any_of('get:actors')]:
+            with self.assertRaises(PermissionsNotFound):
+                check_permissions(requirement, VerifiedToken({'sub': 'user'}))
+
+        if OFFLINE:
+            token = CastingTestCase.local_auth.mint_token(permissions=['get:actors'])
+            response = self.client().get('/search?q=Actor', headers={'Authorization': f'Bearer {token}'})
+            self.assertEqual(response.status_code, 401)
+            self.assertEqual(response.json['description'], 'Permission get:actors and get:movies not found.')
+
     def test_not_found(self):
         movies_response = self.user_delete('EP', 'movies', 100)
         self.assertEqual(movies_response.json['code'], 404)